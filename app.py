@@ -12,7 +12,7 @@ import os
 import asyncio
 
 from ultrasonics import database, plugins, scheduler
-from ultrasonics.webapp import server_start
+from ultrasonics.webapp.server import server_start
 
 _ultrasonics = {
     "version": "1.0.0-rc.1",
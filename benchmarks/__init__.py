@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+
+"""
+benchmarks
+Throughput and peak memory benchmarks for the ultrasonics matching and sync hot paths.
+
+Run from the repository root with `python -m benchmarks`. No network access is needed;
+all songs are generated synthetically by `benchmarks.songs`.
+
+McLain Cronin, 2025
+"""
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+benchmarks
+Runs all benchmark cases, reporting throughput and peak memory for each number of tracks.
+
+    python -m benchmarks --sizes 1000 10000 --filter fuzzymatch --json benchmarks.jsonl
+
+Results can be appended to a JSON lines file with --json, to compare runs over time.
+
+McLain Cronin, 2025
+"""
+
+import argparse
+import json
+import logging
+import platform
+import re
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+
+def measure(case, repeat, memory=True):
+    """
+    Times the best of `repeat` runs, then optionally runs once more with tracemalloc to find peak memory.
+
+    @return: best time in seconds, peak memory in bytes (or None)
+    """
+    times = []
+
+    for _ in range(repeat):
+        args = case.prepare()
+
+        start = time.perf_counter()
+        case.run(*args)
+        times.append(time.perf_counter() - start)
+
+    peak = None
+
+    if memory:
+        args = case.prepare()
+
+        tracemalloc.start()
+        case.run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+def commit():
+    """
+    The current git commit, if available.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Benchmark the ultrasonics matching and sync hot paths.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="number of tracks to benchmark with")
+    parser.add_argument("--filter", default="",
+                        help="only run cases with names matching this regex")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="number of timed runs, the best is reported")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the extra run used to measure peak memory")
+    parser.add_argument("--json", help="append results to this JSON lines file")
+    args = parser.parse_args()
+
+    # Plugins log every song they process, and some errors per song, which would dominate the results
+    logging.disable(logging.CRITICAL)
+
+    # Plugins which store data should do so in a throwaway config directory
+    from app import _ultrasonics
+    _ultrasonics["config_dir"] = tempfile.mkdtemp()
+
+    from benchmarks.cases import cases
+
+    revision = commit()
+    print(f"{'benchmark':<40} {'tracks':>8} {'seconds':>10} {'items/s':>12} {'peak MiB':>10}")
+
+    for name, setup in cases.items():
+        if not re.search(args.filter, name):
+            continue
+
+        for size in args.sizes:
+            case = setup(size)
+            seconds, peak = measure(case, args.repeat, not args.no_memory)
+            throughput = case.items / seconds if seconds else float("inf")
+            peak_mib = "-" if peak is None else f"{peak / 2 ** 20:.1f}"
+
+            print(
+                f"{name:<40} {size:>8} {seconds:>10.3f} {throughput:>12.1f} {peak_mib:>10}")
+
+            if args.json:
+                with open(args.json, "a") as f:
+                    f.write(json.dumps({
+                        "benchmark": name,
+                        "tracks": size,
+                        "items": case.items,
+                        "seconds": seconds,
+                        "throughput": throughput,
+                        "peak_bytes": peak,
+                        "commit": revision,
+                        "python": platform.python_version(),
+                        "time": datetime.now().isoformat(timespec="seconds")
+                    }) + "\n")
+
+
+if __name__ == "__main__":
+    main()
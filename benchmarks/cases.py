@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+cases
+Benchmark cases for the matching and sync hot paths.
+
+Each case is registered with `@case(name)`, and is a function which takes the number of tracks and returns a `Case`.
+`prepare` is called before every run and is not timed, so inputs which are modified by a run can be rebuilt.
+
+McLain Cronin, 2025
+"""
+
+import copy
+import importlib
+import os
+import tempfile
+from collections import namedtuple
+
+from benchmarks.songs import songs_dict
+
+Case = namedtuple("Case", ["run", "items", "prepare"], defaults=[tuple])
+
+cases = {}
+
+# Number of songs checked by benchmarks which are quadratic in the number of tracks
+queries = 100
+
+# Maximum playlist size matched against the local music database
+local_playlist_size = 1000
+
+
+def case(name):
+    """
+    Register a benchmark case under `name`.
+    """
+    def register(function):
+        cases[name] = function
+        return function
+
+    return register
+
+
+def plugin(name):
+    """
+    Import an official plugin by its (space separated) name.
+    """
+    return importlib.import_module(f"ultrasonics.official_plugins.up_{name}")
+
+
+@case("fuzzymatch.similarity")
+def similarity(size):
+    from ultrasonics.tools import fuzzymatch
+
+    playlist_a, playlist_b = [playlist["songs"]
+                              for playlist in songs_dict(playlists=2, size=size)]
+
+    def run():
+        for a, b in zip(playlist_a, playlist_b):
+            fuzzymatch.similarity(a, b)
+
+    return Case(run, size)
+
+
+@case("fuzzymatch.duplicate")
+def duplicate(size):
+    from ultrasonics.tools import fuzzymatch
+
+    playlist_a, playlist_b = [playlist["songs"]
+                              for playlist in songs_dict(playlists=2, size=size)]
+
+    def run():
+        for song in playlist_a[:queries]:
+            fuzzymatch.duplicate(song, playlist_b, 90)
+
+    return Case(run, min(queries, size))
+
+
+@case("fuzzymatch.SongIndex.contains_many")
+def contains_many(size):
+    from ultrasonics.tools import fuzzymatch
+
+    playlist_a, playlist_b = [playlist["songs"]
+                              for playlist in songs_dict(playlists=2, size=size)]
+
+    def run():
+        fuzzymatch.SongIndex(playlist_b).contains_many(playlist_a, 90)
+
+    return Case(run, size)
+
+
+@case("fuzzymatch.SongIndex.match_many")
+def match_many(size):
+    from ultrasonics.tools import fuzzymatch
+
+    playlist_a, playlist_b = [playlist["songs"]
+                              for playlist in songs_dict(playlists=2, size=size)]
+
+    def run():
+        fuzzymatch.SongIndex(playlist_b).match_many(playlist_a, 90)
+
+    return Case(run, size)
+
+
+@case("up_playlist merger.run")
+def playlist_merger(size):
+    merger = plugin("playlist merger")
+
+    # Two input playlists with the same name, making up `size` tracks in total
+    original = songs_dict(playlists=2, size=size // 2, names=1)
+
+    def prepare():
+        return (copy.deepcopy(original),)
+
+    def run(songs):
+        merger.run({"fuzzy_ratio": ""}, database={
+                   "fuzzy_ratio": "90"}, songs_dict=songs)
+
+    return Case(run, size, prepare)
+
+
+@case("up_local music database.run")
+def local_music_database(size):
+    local_music_database = plugin("local music database")
+
+    # Library of `size` tracks, and an incoming playlist partly made of songs from that library
+    library, playlist = songs_dict(
+        playlists=2, size=size, duplicate_rate=0.5, seed=1)
+
+    library = library["songs"]
+    for i, song in enumerate(library):
+        song["location"] = f"/music/{i}.flac"
+
+        # Songs without artists are logged as errors by the plugin, which would dominate the results
+        song.setdefault("artists", [f"Artist {i}"])
+
+    playlist["songs"] = [song for song in playlist["songs"]
+                         if "location" not in song][:local_playlist_size]
+
+    # Start with only the synthetic library in the database, and an empty music directory to scan
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.isfile(local_music_database.db_file + suffix):
+            os.remove(local_music_database.db_file + suffix)
+
+    local_music_database.Database().update_songs(library, [0] * len(library))
+    music_dir = tempfile.mkdtemp()
+
+    def prepare():
+        return ([copy.deepcopy(playlist)],)
+
+    def run(songs):
+        local_music_database.run({}, database={"music_dir": music_dir, "fuzzy_ratio": "90"}, global_settings={},
+                                 component="modifiers", applet_id="benchmark", songs_dict=songs)
+
+    return Case(run, len(playlist["songs"]), prepare)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+songs
+Synthetic songs_dict generator for benchmarks.
+
+Songs look like those received from real input plugins: titles and albums made of a few words,
+one or two artists, dates in either year or full format, and sometimes an ISRC or service ID.
+Duplicates are copies of a shared song with added noise (feat. / prod. credits, case changes,
+missing exact IDs), so they can only be matched with fuzzy matching.
+
+McLain Cronin, 2025
+"""
+
+import random
+import string
+
+# Credits which should be removed by fuzzymatch before comparing titles
+noise_suffixes = [
+    " (feat. {})",
+    " [feat. {}]",
+    " - feat. {}",
+    " (prod. {})",
+    " - Original Mix",
+    " (ft. {})"
+]
+
+
+def _word(rng):
+    syllables = rng.randint(1, 3)
+    return "".join(rng.choice(string.ascii_lowercase[:21]) + rng.choice("aeiouy")
+                   for _ in range(syllables))
+
+
+def _words(rng, vocabulary, minimum, maximum):
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(minimum, maximum))).title()
+
+
+def song(rng, vocabulary, artists, missing_rate=0.1):
+    """
+    Generate a single song in standard ultrasonics song_dict format.
+    """
+    item = {
+        "title": _words(rng, vocabulary, 1, 4),
+        "artists": rng.sample(artists, rng.choice([1, 1, 1, 2])),
+        "album": _words(rng, vocabulary, 1, 3),
+        "date": str(rng.randint(1970, 2025)) if rng.random() < 0.5 else
+        f"{rng.randint(1970, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    }
+
+    if rng.random() < 0.3:
+        item["isrc"] = "".join(rng.choices(
+            string.ascii_uppercase + string.digits, k=12))
+
+    if rng.random() < 0.3:
+        item["id"] = {"spotify": "".join(rng.choices(
+            string.ascii_letters + string.digits, k=22))}
+
+    for key in ["artists", "album", "date"]:
+        if rng.random() < missing_rate:
+            item.pop(key)
+
+    return item
+
+
+def noisy_copy(rng, item, artists, noise_rate=0.2):
+    """
+    Copy a song so it is still the same song, but can only be matched using fuzzy fields.
+    """
+    item = {key: value for key, value in item.items()
+            if key not in ["isrc", "id"]}
+
+    if rng.random() < noise_rate:
+        item["title"] += rng.choice(noise_suffixes).format(rng.choice(artists))
+
+    if rng.random() < noise_rate:
+        item["title"] = item["title"].lower()
+
+    if "album" in item and rng.random() < noise_rate:
+        item["album"] += rng.choice(noise_suffixes).format(rng.choice(artists))
+
+    return item
+
+
+def songs_dict(playlists=2, size=1000, names=None, duplicate_rate=0.3, missing_rate=0.1, noise_rate=0.2, seed=0):
+    """
+    Generate a songs_dict with `playlists` playlists of `size` songs.
+
+    names:              number of distinct playlist names; playlists are named round robin,
+                        so names=1 gives duplicate playlists for the playlist merger. Default: all distinct.
+    duplicate_rate:     fraction of each playlist which is a noisy copy of a song shared by all playlists.
+    missing_rate:       chance of each of artists, album and date being missing from a song.
+    noise_rate:         chance of each noise modification being applied to a duplicate song.
+    """
+    rng = random.Random(seed)
+    names = names or playlists
+
+    vocabulary = [_word(rng) for _ in range(max(200, size // 5))]
+    artists = [_words(rng, vocabulary, 1, 2)
+               for _ in range(max(20, size // 10))]
+
+    shared = [song(rng, vocabulary, artists, missing_rate)
+              for _ in range(int(size * duplicate_rate))]
+
+    result = []
+
+    for i in range(playlists):
+        songs = [noisy_copy(rng, item, artists, noise_rate) for item in shared]
+        songs.extend(song(rng, vocabulary, artists, missing_rate)
+                     for _ in range(size - len(songs)))
+        rng.shuffle(songs)
+
+        result.append({
+            "name": f"Playlist {i % names}",
+            "id": {"benchmark": str(i)},
+            "songs": songs
+        })
+
+    return result
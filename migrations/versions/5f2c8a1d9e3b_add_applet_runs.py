@@ -0,0 +1,39 @@
+"""Add applet run history
+
+Revision ID: 5f2c8a1d9e3b
+Revises: ccb974d801aa
+Create Date: 2025-04-06 19:42:11.208113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5f2c8a1d9e3b'
+down_revision: Union[str, None] = 'ccb974d801aa'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('applet_runs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('applet_id', sa.String(length=100), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('duration', sa.Float(), nullable=True),
+    sa.Column('cpu', sa.Float(), nullable=True),
+    sa.Column('success', sa.Boolean(), nullable=True),
+    sa.Column('stats', sa.JSON(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_applet_runs_applet_id'), 'applet_runs', ['applet_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_applet_runs_applet_id'), table_name='applet_runs')
+    op.drop_table('applet_runs')
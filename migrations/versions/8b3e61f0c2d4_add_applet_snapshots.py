@@ -0,0 +1,38 @@
+"""Add applet snapshots
+
+Revision ID: 8b3e61f0c2d4
+Revises: 5f2c8a1d9e3b
+Create Date: 2025-04-13 11:05:37.614209
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b3e61f0c2d4'
+down_revision: Union[str, None] = '5f2c8a1d9e3b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('applet_snapshots',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('applet_id', sa.String(length=100), nullable=False),
+    sa.Column('playlist_key', sa.String(length=767), nullable=False),
+    sa.Column('hash', sa.String(length=40), nullable=False),
+    sa.Column('songs', sa.JSON(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_applet_snapshots_applet_id'), 'applet_snapshots', ['applet_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_applet_snapshots_applet_id'), table_name='applet_snapshots')
+    op.drop_table('applet_snapshots')
@@ -29,6 +29,13 @@ class Config:
     
     SQLALCHEMY_DATABASE_URI = f'mysql+aiomysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Database connection pool settings
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 20)
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 3600)
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'True') == 'True'
+    DB_ECHO = DEBUG and os.environ.get('DB_ECHO', 'True') == 'True'
     
     # Plugin settings
     PLUGIN_DIRS = [
@@ -38,6 +45,31 @@ class Config:
     
     # Scheduler settings
     TRIGGER_POLL = int(os.environ.get('TRIGGER_POLL') or 120)
+    TRIGGER_WORKERS = int(os.environ.get('TRIGGER_WORKERS') or 64)
+    SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS') or 4)
+
+    # Applet execution settings
+    APPLET_CONCURRENT = os.environ.get('APPLET_CONCURRENT') == 'True'
+
+    # Playlists buffered between each stage of a streaming applet
+    STREAM_BUFFER = int(os.environ.get('STREAM_BUFFER') or 4)
+
+    # Plugin execution settings
+    PLUGIN_WORKERS = int(os.environ.get('PLUGIN_WORKERS') or 8)
+    PLUGIN_PROCESS_WORKERS = int(os.environ.get('PLUGIN_PROCESS_WORKERS') or 2)
+
+    # Processes used to read tags when scanning a local music library
+    LIBRARY_SCAN_WORKERS = int(os.environ.get('LIBRARY_SCAN_WORKERS') or os.cpu_count() or 4)
+
+    # Shared HTTP client settings for web service plugins
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE') or 10)
+    HTTP_HOST_CONCURRENCY = int(os.environ.get('HTTP_HOST_CONCURRENCY') or 8)
+    HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES') or 4)
+    HTTP_TIMEOUT = int(os.environ.get('HTTP_TIMEOUT') or 30)
+
+    # Seconds to keep songs resolved to service ids, and songs which could not be found
+    RESOLVE_CACHE_TTL = int(os.environ.get('RESOLVE_CACHE_TTL') or 30 * 86400)
+    RESOLVE_CACHE_MISS_TTL = int(os.environ.get('RESOLVE_CACHE_MISS_TTL') or 86400)
     
     # API settings
     API_URL = os.environ.get('API_URL') or 'http://localhost:3000/api/' 
\ No newline at end of file
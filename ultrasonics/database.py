@@ -8,18 +8,23 @@ Original work by XDGFX, 2020
 Updated and modernized by McLain Cronin, 2025
 """
 
+import copy
 import os
 import json
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
 from typing import Optional, Dict, Any, List
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import select, update, insert, delete
+from sqlalchemy import bindparam, select, update, insert, delete
 from dotenv import load_dotenv
 
 from ultrasonics import logs
-from ultrasonics.models import Base, User, Playlist, Song, Plugin
+from ultrasonics.config import Config
+from ultrasonics.models import Base, User, Playlist, Song, AppletRun, AppletSnapshot
+from ultrasonics.models import Plugin as PluginModel
 
 log = logs.create_log(__name__)
 
@@ -35,9 +40,73 @@ DB_NAME = os.getenv("DB_NAME", "ultrasonics")
 
 # Create async engine
 DATABASE_URL = f"mysql+aiomysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-engine = create_async_engine(DATABASE_URL, echo=True)
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=Config.DB_ECHO,
+    pool_size=Config.DB_POOL_SIZE,
+    max_overflow=Config.DB_MAX_OVERFLOW,
+    pool_recycle=Config.DB_POOL_RECYCLE,
+    pool_pre_ping=Config.DB_POOL_PRE_PING
+)
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Connection of the transaction open in the current task, shared by all database calls made inside it
+connection: ContextVar = ContextVar("connection", default=None)
+
+# In-process cache of the values read on every applet run: global settings, plugin configs and applet plans.
+# Each is loaded from the database on first use, then kept up to date by the functions below which write to it.
+# Changes made to the database outside of this process are only seen after `invalidate()`.
+cache: Dict[str, Any] = {
+    "core": None,
+    "plugins": {},
+    "applets": {}
+}
+
+
+def invalidate() -> None:
+    """
+    Clear the settings cache, so all values are reloaded from the database.
+    """
+    cache["core"] = None
+    cache["plugins"].clear()
+    cache["applets"].clear()
+    log.debug("Settings cache invalidated")
+
+
+@asynccontextmanager
+async def transaction():
+    """
+    Unit of work: database calls made inside this block use one pooled connection and one transaction,
+    which is committed when the outermost block exits, or rolled back if it raises.
+
+        async with database.transaction():
+            if await database.Applet().get(applet_id) is None:
+                await database.Applet().new(applet_id, data)
+
+    Every database function uses this, so it is also safe to call them on their own.
+    """
+    conn = connection.get()
+
+    # Already inside a transaction
+    if conn is not None:
+        yield conn
+        return
+
+    try:
+        async with engine.begin() as conn:
+            token = connection.set(conn)
+
+            try:
+                yield conn
+            finally:
+                connection.reset(token)
+
+    except BaseException:
+        # The cache may have been updated by writes which were rolled back
+        invalidate()
+        raise
+
+
 class Core:
     """
     Core ultrasonics database functions.
@@ -88,25 +157,27 @@ class Core:
         """
         Initial connection to database to create tables.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             await conn.run_sync(Base.metadata.create_all)
             log.info("Database connection successful")
 
+            from app import _ultrasonics
+
             if await self.new_install():
-                from app import _ultrasonics
                 _ultrasonics["new_install"] = True
 
                 # Create tuple with default settings
                 global_settings_database = [(item["name"], item["value"])
                                          for item in self.settings if item["type"] in ["text", "radio", "select"]]
 
-                # Insert initial settings
-                for key, value in list(_ultrasonics.items()) + global_settings_database:
-                    await conn.execute(
-                        insert(User).values(username=key, email=value)
-                    )
+                # Insert initial settings in a single executemany
+                await conn.execute(
+                    insert(User),
+                    [{"username": key, "email": value}
+                     for key, value in list(_ultrasonics.items()) + global_settings_database]
+                )
 
-                await conn.commit()
+                invalidate()
 
             # Version check
             result = await conn.execute(
@@ -122,12 +193,15 @@ class Core:
         """
         Check if this is a new installation of ultrasonics.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             if update:
                 await conn.execute(
                     update(User).where(User.username == 'new_install').values(email='0')
                 )
-                await conn.commit()
+
+                if cache["core"] is not None:
+                    cache["core"]["new_install"] = '0'
+
                 log.info("Welcome to ultrasonics! 🔊")
                 return False
             else:
@@ -138,29 +212,34 @@ class Core:
                 row = result.first()
                 return row is None
 
+    async def _values(self) -> Dict[str, str]:
+        """
+        All global settings as a key: value dict, from the cache if loaded.
+        """
+        if cache["core"] is None:
+            async with transaction() as conn:
+                result = await conn.execute(select(User))
+                cache["core"] = {row.username: row.email for row in result.fetchall()}
+
+        return cache["core"]
+
     async def load(self, raw: bool = False) -> Dict[str, Any]:
         """
         Return all the current global settings in full dict format.
         If raw, return only key: value dict
         """
-        async with engine.begin() as conn:
-            result = await conn.execute(select(User))
-            rows = result.fetchall()
+        values = await self._values()
 
-            if raw:
-                return {row.username: row.email for row in rows}
-            else:
-                data = self.settings.copy()
-                db_compatible_settings = [
-                    item["name"] for item in data if item["type"] in ["text", "radio", "select"]]
-
-                for row in rows:
-                    if row.username in db_compatible_settings:
-                        for i, item in enumerate(data):
-                            if "name" in item and item["name"] == row.username:
-                                item["value"] = row.email
-                                data[i] = item
-                return data
+        if raw:
+            return dict(values)
+        else:
+            data = copy.deepcopy(self.settings)
+
+            for item in data:
+                if item["type"] in ["text", "radio", "select"] and item["name"] in values:
+                    item["value"] = values[item["name"]]
+
+            return data
 
     async def save(self, settings: Dict[str, Any]) -> None:
         """
@@ -170,27 +249,32 @@ class Core:
         if settings["api_url"][-1] != "/":
             settings["api_url"] = settings["api_url"] + "/"
 
-        async with engine.begin() as conn:
-            for key, value in settings.items():
-                if key != "action":
-                    await conn.execute(
-                        update(User)
-                        .where(User.username == key)
-                        .values(email=value)
-                    )
-            await conn.commit()
+        values = [{"key": key, "value": value}
+                  for key, value in settings.items() if key != "action"]
+
+        if not values:
+            return
+
+        async with transaction() as conn:
+            # Single executemany for all settings
+            await conn.execute(
+                update(User)
+                .where(User.username == bindparam("key"))
+                .values(email=bindparam("value")),
+                values
+            )
             log.info("Settings database updated")
 
+        # Only keys which already exist are updated in the database
+        if cache["core"] is not None:
+            cache["core"].update({key: value for key, value in settings.items()
+                                  if key in cache["core"]})
+
     async def get(self, key: str) -> Optional[str]:
         """
         Get a specific value from the ultrasonics core database.
         """
-        async with engine.begin() as conn:
-            result = await conn.execute(
-                select(User.email).where(User.username == key)
-            )
-            row = result.first()
-            return row[0] if row else None
+        return (await self._values()).get(key)
 
 
 class Plugin:
@@ -202,56 +286,63 @@ class Plugin:
         """
         Create a database entry for a given plugin.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             await conn.execute(
-                insert(Plugin).values(
+                insert(PluginModel).values(
                     name=name,
                     version=version,
                     enabled=True,
                     config={}
                 )
             )
-            await conn.commit()
             log.info("Plugin database entry created")
 
+        cache["plugins"][name] = {}
+
     async def set(self, name: str, version: str, settings: Dict[str, Any]) -> None:
         """
         Update an existing plugin entry in the database.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             await conn.execute(
-                update(Plugin)
-                .where(Plugin.name == name)
+                update(PluginModel)
+                .where(PluginModel.name == name)
                 .values(
                     version=version,
                     config=settings
                 )
             )
-            await conn.commit()
             log.info("Plugin database entry updated")
 
+        cache["plugins"][name] = copy.deepcopy(settings)
+
     async def get(self, name: str) -> Optional[Dict[str, Any]]:
         """
         Get plugin settings from the database.
         """
-        async with engine.begin() as conn:
-            result = await conn.execute(
-                select(Plugin).where(Plugin.name == name)
-            )
-            plugin = result.first()
-            return plugin.config if plugin else None
+        if name not in cache["plugins"]:
+            async with transaction() as conn:
+                result = await conn.execute(
+                    select(PluginModel.config).where(PluginModel.name == name)
+                )
+                plugin = result.first()
+                cache["plugins"][name] = plugin.config if plugin else None
+
+        # Plugins are free to modify their settings, so never hand out the cached copy
+        return copy.deepcopy(cache["plugins"][name])
 
     async def delete(self, name: str) -> None:
         """
         Delete a plugin from the database.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             await conn.execute(
-                delete(Plugin).where(Plugin.name == name)
+                delete(PluginModel).where(PluginModel.name == name)
             )
-            await conn.commit()
             log.info("Plugin database entry deleted")
 
+        cache["plugins"][name] = None
+
 
 class Applet:
     """
@@ -262,7 +353,7 @@ class Applet:
         """
         Create a new applet in the database.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             await conn.execute(
                 insert(Playlist).values(
                     name=applet_id,
@@ -270,40 +361,154 @@ class Applet:
                     extra_data=data
                 )
             )
-            await conn.commit()
             log.info("Applet database entry created")
 
+        cache["applets"][applet_id] = copy.deepcopy(data)
+
     async def update(self, applet_id: str, data: Dict[str, Any]) -> None:
         """
         Update an existing applet in the database.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             await conn.execute(
                 update(Playlist)
                 .where(Playlist.name == applet_id)
                 .values(extra_data=data)
             )
-            await conn.commit()
             log.info("Applet database entry updated")
 
+        cache["applets"][applet_id] = copy.deepcopy(data)
+
     async def get(self, applet_id: str) -> Optional[Dict[str, Any]]:
         """
         Get applet data from the database.
         """
-        async with engine.begin() as conn:
+        if applet_id not in cache["applets"]:
+            async with transaction() as conn:
+                result = await conn.execute(
+                    select(Playlist.extra_data).where(Playlist.name == applet_id)
+                )
+                applet = result.first()
+
+            # Missing applets aren't cached, as ids come from unauthenticated requests (e.g. webhooks)
+            if applet is None:
+                return None
+
+            cache["applets"][applet_id] = applet.extra_data
+
+        return copy.deepcopy(cache["applets"][applet_id])
+
+    async def get_all(self) -> List[Dict[str, Any]]:
+        """
+        Get all applets from the database, each with its applet_id.
+        """
+        async with transaction() as conn:
             result = await conn.execute(
-                select(Playlist).where(Playlist.name == applet_id)
+                select(Playlist.name, Playlist.extra_data).where(Playlist.description == "Applet")
             )
-            applet = result.first()
-            return applet.extra_data if applet else None
+            rows = result.fetchall()
+
+        for row in rows:
+            cache["applets"][row.name] = row.extra_data
+
+        return [{**copy.deepcopy(row.extra_data), "applet_id": row.name} for row in rows]
 
     async def delete(self, applet_id: str) -> None:
         """
         Delete an applet from the database.
         """
-        async with engine.begin() as conn:
+        async with transaction() as conn:
             await conn.execute(
                 delete(Playlist).where(Playlist.name == applet_id)
             )
-            await conn.commit()
             log.info("Applet database entry deleted")
+
+        cache["applets"].pop(applet_id, None)
+
+
+class Run:
+    """
+    Functions specific to applet run history.
+    """
+
+    async def add(self, applet_id: str, started_at: datetime, duration: float, cpu: float,
+                  success: bool, stats: Dict[str, Any]) -> None:
+        """
+        Save the result of an applet run, with the stats for each plugin stage.
+        """
+        async with transaction() as conn:
+            await conn.execute(
+                insert(AppletRun).values(
+                    applet_id=applet_id,
+                    started_at=started_at,
+                    duration=duration,
+                    cpu=cpu,
+                    success=success,
+                    stats=stats
+                )
+            )
+
+    async def get(self, applet_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Get the most recent runs of an applet, newest first.
+        """
+        async with transaction() as conn:
+            result = await conn.execute(
+                select(AppletRun)
+                .where(AppletRun.applet_id == applet_id)
+                .order_by(AppletRun.started_at.desc())
+                .limit(limit)
+            )
+            return [
+                {
+                    "started_at": row.started_at.isoformat(),
+                    "duration": row.duration,
+                    "cpu": row.cpu,
+                    "success": row.success,
+                    "stats": row.stats
+                }
+                for row in result.fetchall()
+            ]
+
+
+class Snapshot:
+    """
+    Functions specific to applet snapshots, used for incremental sync.
+    """
+
+    async def get(self, applet_id: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the last synced snapshot of an applet, as {playlist_key: {"hash", "songs"}}.
+        """
+        async with transaction() as conn:
+            result = await conn.execute(
+                select(AppletSnapshot.playlist_key, AppletSnapshot.hash, AppletSnapshot.songs)
+                .where(AppletSnapshot.applet_id == applet_id)
+            )
+            return {row.playlist_key: {"hash": row.hash, "songs": row.songs} for row in result.fetchall()}
+
+    async def save(self, applet_id: str, snapshot: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Replace the snapshot of an applet.
+        """
+        async with transaction() as conn:
+            await conn.execute(
+                delete(AppletSnapshot).where(AppletSnapshot.applet_id == applet_id)
+            )
+
+            if snapshot:
+                await conn.execute(
+                    insert(AppletSnapshot),
+                    [{"applet_id": applet_id, "playlist_key": key, "hash": item["hash"], "songs": item["songs"]}
+                     for key, item in snapshot.items()]
+                )
+
+    async def delete(self, applet_id: str) -> None:
+        """
+        Delete the snapshot of an applet, so its next run is a full sync.
+        """
+        async with transaction() as conn:
+            await conn.execute(
+                delete(AppletSnapshot).where(AppletSnapshot.applet_id == applet_id)
+            )
+            log.info("Applet snapshot deleted")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+metrics
+Counters and timers used to instrument applet runs.
+
+Each plugin run gets a Collector, which plugins and tools record into with `count` and `api_call`.
+The collector is held in a context variable, so recording is a no-op when nothing is collecting
+(e.g. a plugin test, or fuzzymatch used outside of an applet).
+
+Cpu time is measured per thread, so work handed to a pool is only counted if it runs through `worker`
+(threads) or `timed` (processes).
+
+McLain Cronin, 2025
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Collector for the plugin running in the current thread or process
+collector = ContextVar("collector", default=None)
+
+# List of stage records for the applet run in the current asyncio task
+applet_run = ContextVar("applet_run", default=None)
+
+
+class Collector:
+    """
+    Holds the counters and external api call timings for one plugin run.
+    Thread safe, so plugins can record from their own worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.api = {}
+        self.cpu = 0.0
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_cpu(self, seconds):
+        with self.lock:
+            self.cpu += seconds
+
+    def api_call(self, service, seconds, error=False):
+        with self.lock:
+            stats = self.api.setdefault(
+                service, {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "api": {service: dict(stats) for service, stats in self.api.items()}
+            }
+
+
+def count(name, n=1):
+    """
+    Add `n` to the counter `name` for the current plugin run, if there is one.
+    """
+    current = collector.get()
+    if current is not None:
+        current.count(name, n)
+
+
+def add_cpu(seconds):
+    """
+    Add cpu time used outside of the plugin's own thread to the current plugin run, if there is one.
+    """
+    current = collector.get()
+    if current is not None:
+        current.add_cpu(seconds)
+
+
+@contextmanager
+def api_call(service):
+    """
+    Context manager which records one call to an external api, and its latency.
+    """
+    current = collector.get()
+    if current is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    error = True
+
+    try:
+        yield
+        error = False
+    finally:
+        current.api_call(service, time.perf_counter() - start, error)
+
+
+def worker(function, *args, **kwargs):
+    """
+    Call `function` from a pool thread, adding the cpu time it uses to the current plugin run.
+    The thread must be running in a copy of the plugin's context.
+    """
+    cpu = time.thread_time()
+
+    try:
+        return function(*args, **kwargs)
+    finally:
+        add_cpu(time.thread_time() - cpu)
+
+
+def timed(function, *args, **kwargs):
+    """
+    Call `function`, measuring the cpu time used by the calling thread.
+    For process pools, where there is no collector; the caller adds the time with `add_cpu`.
+
+    @return: the function response, and its cpu time in seconds.
+    """
+    cpu = time.thread_time()
+    response = function(*args, **kwargs)
+
+    return response, time.thread_time() - cpu
+
+
+def measure(function, *args, **kwargs):
+    """
+    Call `function` with a new Collector, also measuring the cpu time used by the calling thread
+    and any pool workers which recorded theirs.
+
+    @return: the function response, and a dict of measurements.
+    """
+    current = Collector()
+    token = collector.set(current)
+    cpu = time.thread_time()
+
+    try:
+        response = function(*args, **kwargs)
+        cpu = time.thread_time() - cpu
+
+        return response, {"cpu": cpu + current.cpu, **current.to_dict()}
+    finally:
+        collector.reset(token)
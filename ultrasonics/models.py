@@ -8,7 +8,7 @@ McLain Cronin, 2025
 """
 
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Float, ForeignKey, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -71,4 +71,27 @@ class Plugin(Base):
     enabled = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    config = Column(JSON) 
\ No newline at end of file
+    config = Column(JSON)
+
+class AppletRun(Base):
+    """Applet run history, with timings and counters for each plugin stage."""
+    __tablename__ = 'applet_runs'
+
+    id = Column(Integer, primary_key=True)
+    applet_id = Column(String(100), nullable=False, index=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    duration = Column(Float)  # Wall time in seconds
+    cpu = Column(Float)  # CPU time in seconds, summed over all plugin stages
+    success = Column(Boolean)
+    stats = Column(JSON)
+
+class AppletSnapshot(Base):
+    """The songs of each playlist last synced by an applet, used to send only changes to incremental outputs."""
+    __tablename__ = 'applet_snapshots'
+
+    id = Column(Integer, primary_key=True)
+    applet_id = Column(String(100), nullable=False, index=True)
+    playlist_key = Column(String(767), nullable=False)
+    hash = Column(String(40), nullable=False)
+    songs = Column(JSON)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
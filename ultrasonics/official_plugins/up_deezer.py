@@ -12,14 +12,12 @@ XDGFX, 2020
 import json
 import os
 import re
-import time
 
-import requests
 from tqdm import tqdm
 
 from app import _ultrasonics
-from ultrasonics import logs
-from ultrasonics.tools import api_key, fuzzymatch, name_filter
+from ultrasonics import logs, metrics
+from ultrasonics.tools import api_key, fuzzymatch, http_client, name_filter, resolve_cache
 
 log = logs.create_log(__name__)
 
@@ -98,30 +96,12 @@ def run(settings_dict, **kwargs):
 
             @return: response JSON if successful
             """
-            if method == "GET":
-                r = requests.get(url, params=params)
-
-                if r.status_code == 4:
-                    time.sleep(5)
-                    r = requests.get(url, params=params)
-
-            elif method == "POST":
-                r = requests.post(url, data=data)
-
-                if r.status_code == 4:
-                    time.sleep(5)
-                    r = requests.post(url, data=data)
-
-            elif method == "DELETE":
-                r = requests.delete(url, params=params)
-
-                if r.status_code == 4:
-                    time.sleep(5)
-                    r = requests.post(url, data=data)
-
-            else:
+            if method not in ["GET", "POST", "DELETE"]:
                 raise Exception(f"Unknown api method: {method}")
 
+            r = http_client.request(method, url, service="deezer", params=params, data=data,
+                                    retry_if=self.quota_exceeded)
+
             if r.status_code != 200:
                 log.error(f"Unexpected status code: {r.status_code}")
                 log.error(r.text)
@@ -137,6 +117,17 @@ def run(settings_dict, **kwargs):
 
             return r.json()
 
+        def quota_exceeded(self, r):
+            """
+            Deezer reports its rate limit as error code 4 in a successful response, so these are retried.
+            """
+            try:
+                error = r.json().get("error")
+            except (ValueError, AttributeError):
+                return False
+
+            return isinstance(error, dict) and error.get("code") == 4
+
         def search(self, track):
             """
             Used to search the Deezer API for a song, supplied in standard songs_dict format.
@@ -146,11 +137,6 @@ def run(settings_dict, **kwargs):
             Deezer ID, confidence score
             """
 
-            cutoff_regex = [
-                "[([](feat|ft|featuring|original|prod).+?[)\]]",
-                "[ (\- )\-]+(feat|ft|featuring|original|prod).+?(?=[(\n])"
-            ]
-
             # 1. Deezer ID
             try:
                 deezer_id = track["id"]["deezer"]
@@ -162,7 +148,12 @@ def run(settings_dict, **kwargs):
                 # Deezer ID was not supplied
                 pass
 
-            # 2. Other fields
+            # 2. Previously resolved
+            cached = resolve_cache.lookup("deezer", track)
+            if cached is not None:
+                return cached
+
+            # 3. Other fields
             # Multiple searches are made as Deezer is more likely to return false negative (missing songs)
             # than false positive, when specifying many query parameters.
 
@@ -183,20 +174,12 @@ def run(settings_dict, **kwargs):
                 # If no ISRC, try all additional queries
                 queries = []
                 try:
-                    title = re.sub(cutoff_regex[0], "",
-                                   track['title'], flags=re.IGNORECASE) + "\n"
-
-                    title = re.sub(cutoff_regex[1], " ",
-                                   title, flags=re.IGNORECASE).strip()
+                    title = fuzzymatch.clean(track["title"])
                 except KeyError:
                     pass
 
                 try:
-                    album = re.sub(cutoff_regex[0], "",
-                                   track['album'], flags=re.IGNORECASE) + "\n"
-
-                    album = re.sub(cutoff_regex[1], " ",
-                                   album, flags=re.IGNORECASE).strip()
+                    album = fuzzymatch.clean(track["album"])
                 except KeyError:
                     pass
 
@@ -231,12 +214,13 @@ def run(settings_dict, **kwargs):
 
             if not results_list:
                 # No items were found
+                resolve_cache.store("deezer", track, "", 0)
                 return "", 0
 
             # Check results with fuzzy matching
             confidence = 0
 
-            for item in results_list:
+            for compared, item in enumerate(results_list, 1):
                 score = fuzzymatch.similarity(track, item)
                 if score > confidence:
                     matched_track = item
@@ -244,7 +228,11 @@ def run(settings_dict, **kwargs):
                     if confidence > 100:
                         break
 
+            metrics.count("comparisons", compared)
+
             deezer_id = matched_track["id"]["deezer"]
+            resolve_cache.store("deezer", track, deezer_id, confidence,
+                                accepted=confidence > float(database.get("fuzzy_ratio") or 90))
 
             return deezer_id, confidence
 
@@ -457,24 +445,21 @@ def run(settings_dict, **kwargs):
                 existing_ids = [str(item["id"]["deezer"])
                                 for item in existing_tracks]
 
+            existing_index = fuzzymatch.SongIndex(existing_tracks)
+
             # Add songs which don't already exist in the playlist
             new_ids = []
             duplicate_ids = []
 
-            log.info("Searching for matching songs in Deezer.")
-            for song in tqdm(playlist["songs"], desc=f"Searching Deezer for songs from {playlist['name']}"):
-                # First check for fuzzy duplicate without Deezer api search
-                duplicate = False
-                for item in existing_tracks:
-                    score = fuzzymatch.similarity(song, item)
-
-                    if score > float(database.get("fuzzy_ratio") or 90):
-                        # Duplicate was found
-                        duplicate_ids.append(item['id']['deezer'])
-                        duplicate = True
-                        break
+            # First check for fuzzy duplicates without Deezer api search
+            existing_matches = existing_index.match_many(
+                playlist["songs"], float(database.get("fuzzy_ratio") or 90))
 
-                if duplicate:
+            log.info("Searching for matching songs in Deezer.")
+            for song, item in tqdm(zip(playlist["songs"], existing_matches), total=len(existing_matches), desc=f"Searching Deezer for songs from {playlist['name']}"):
+                if item is not None:
+                    # Duplicate was found
+                    duplicate_ids.append(item['id']['deezer'])
                     continue
 
                 try:
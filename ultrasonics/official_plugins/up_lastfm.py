@@ -11,10 +11,10 @@ XDGFX, 2020
 
 import json
 
-import requests
 from tqdm import tqdm
 
 from ultrasonics import logs
+from ultrasonics.tools import http_client
 
 log = logs.create_log(__name__)
 
@@ -87,13 +87,7 @@ def run(settings_dict, **kwargs):
             params["page"] = page
             params["limit"] = 50
 
-            r = requests.get(url, params=params)
-
-            if r.status_code == 429:
-                import time
-                log.warning("Rate limit reached, sleeping for a while...")
-                time.sleep(60)
-                r = requests.get(url, params=params)
+            r = http_client.get(url, service="lastfm", params=params)
 
             if r.status_code != 200:
                 log.error(f"Unexpected status code: {r.status_code}")
@@ -158,13 +152,7 @@ def run(settings_dict, **kwargs):
                 params["track"] = song["name"]
                 params["artist"] = temp_dict["artists"][0]
 
-                r = requests.get(url, params=params)
-
-                if r.status_code == 429:
-                    import time
-                    log.warning("Rate limit reached, sleeping for a while...")
-                    time.sleep(60)
-                    r = requests.get(url, params=params)
+                r = http_client.get(url, service="lastfm", params=params)
 
                 if r.status_code != 200:
                     log.error(f"Unexpected status code: {r.status_code}")
@@ -264,7 +252,7 @@ def test(database, **kwargs):
     log.info(f"Trying last.fm api at url: {url}")
     log.info(f"Using username: {params['user']}")
 
-    r = requests.get(url, params=params)
+    r = http_client.get(url, service="lastfm", params=params)
 
     if r.status_code != 200:
         log.error(f"Unexpected status code: {r.status_code}")
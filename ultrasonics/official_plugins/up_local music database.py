@@ -15,11 +15,19 @@ import json
 import math
 import os
 import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-from tqdm import tqdm
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    # Watch mode falls back to polling
+    Observer = None
 
 from app import _ultrasonics
-from ultrasonics import logs
+from ultrasonics import logs, metrics
+from ultrasonics.config import Config
 from ultrasonics.tools import fuzzymatch, local_tags
 
 log = logs.create_log(__name__)
@@ -48,6 +56,17 @@ extension_skiplist = [".jpg", ".png", ".bak", ".dat", ".lrc",
 log.debug(
     f"This plugin will automatically skip any files matching the following extensions: {extension_skiplist}")
 
+# Number of songs to read tags for and save to the database at once
+scan_batch = 1000
+
+# Below this many new or modified songs, tags are read without starting a process pool
+scan_pool_minimum = 50
+
+# In watch mode, seconds to wait for more changes before updating the database,
+# or between scans if filesystem events are not available
+watch_delay = 5
+watch_poll_interval = 300
+
 handshake = {
     "name": "local music database",
     "description": "allow connections between your online and offline (local music) services.",
@@ -58,6 +77,8 @@ handshake = {
         "playlists"
     ],
     "version": "0.1",
+    # Applets share one library database, so only scan and match for one at a time
+    "concurrency": 1,
     "settings": [
         {
             "type": "string",
@@ -87,44 +108,143 @@ handshake = {
             "name": "fuzzy_ratio",
             "value": "Recommended: 90"
         },
+        {
+            "type": "string",
+            "value": "Only folders which have changed since the last scan are searched for new songs. Songs with tags edited in place don't change their folder, so every folder is checked again after this many hours."
+        },
+        {
+            "type": "text",
+            "label": "Full Rescan Interval",
+            "name": "full_scan_hours",
+            "value": "Recommended: 24"
+        },
+        {
+            "type": "string",
+            "value": "In watch mode, your music directory is kept up to date in the background as files change, so applets can start matching straight away. Filesystem events need the watchdog package (and a local disk), otherwise the directory is scanned every few minutes instead."
+        },
+        {
+            "type": "radio",
+            "label": "Library Updates",
+            "name": "library_updates",
+            "id": "library_updates",
+            "options": [
+                "Scan Each Run",
+                "Watch"
+            ]
+        },
     ]
 }
 
 
 class Database:
+    # Fields with a full text (trigram) index, so substring lookups don't scan the whole library
+    indexed_fields = ["title", "artists", "album"]
+
     def __init__(self):
         """
-        Create the database for storing music tags.
+        Open the database for storing music tags, creating tables and indexes if needed.
+        One connection is kept open for the lifetime of this object.
         """
         self.database_fields = "location,title,artists,album,date,isrc,modified"
 
-        with sqlite3.connect(db_file) as conn:
-            cursor = conn.cursor()
-            log.info("Database connection successful")
-            query = """
-            CREATE TABLE IF NOT EXISTS songs
-            (
-                location TEXT PRIMARY KEY,
-                title TEXT,
-                artists TEXT,
-                album TEXT,
-                date TEXT,
-                isrc TEXT,
-                modified INTEGER
-            )
-            """
-            cursor.execute(query)
-            conn.commit()
+        self.conn = sqlite3.connect(db_file, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        # REPLACE INTO only fires the delete trigger (keeping the index in sync) with recursive triggers on
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+
+        cursor = self.conn.cursor()
+        log.info("Database connection successful")
+        query = """
+        CREATE TABLE IF NOT EXISTS songs
+        (
+            location TEXT PRIMARY KEY,
+            title TEXT,
+            artists TEXT,
+            album TEXT,
+            date TEXT,
+            isrc TEXT,
+            modified INTEGER
+        )
+        """
+        cursor.execute(query)
+        cursor.execute("CREATE INDEX IF NOT EXISTS songs_isrc ON songs (isrc)")
+
+        # Modified time and subdirectories of each scanned directory, so unchanged ones aren't listed again
+        query = """
+        CREATE TABLE IF NOT EXISTS directories
+        (
+            path TEXT PRIMARY KEY,
+            modified INTEGER,
+            subdirs TEXT
+        )
+        """
+        cursor.execute(query)
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+
+        try:
+            self.fts = self.create_index(cursor)
+        except sqlite3.OperationalError as e:
+            # SQLite was built without FTS5, or is older than 3.34 (trigram tokenizer)
+            log.warning(f"Could not create full text index, lookups will be slower: {e}")
+            self.fts = False
+
+        self.conn.commit()
+
+    def create_index(self, cursor):
+        """
+        Create the trigram index over `indexed_fields`, and triggers to keep it in sync with the songs table.
+        Existing libraries are indexed the first time this runs.
+        """
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='songs_fts'")
+        exists = cursor.fetchone()
+
+        fields = ", ".join(self.indexed_fields)
+        old_fields = ", ".join(f"old.{field}" for field in self.indexed_fields)
+        new_fields = ", ".join(f"new.{field}" for field in self.indexed_fields)
+
+        cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts
+        USING fts5({fields}, content='songs', content_rowid='rowid', tokenize='trigram')
+        """)
+
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS songs_fts_insert AFTER INSERT ON songs BEGIN
+            INSERT INTO songs_fts (rowid, {fields}) VALUES (new.rowid, {new_fields});
+        END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS songs_fts_delete AFTER DELETE ON songs BEGIN
+            INSERT INTO songs_fts (songs_fts, rowid, {fields}) VALUES ('delete', old.rowid, {old_fields});
+        END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS songs_fts_update AFTER UPDATE ON songs BEGIN
+            INSERT INTO songs_fts (songs_fts, rowid, {fields}) VALUES ('delete', old.rowid, {old_fields});
+            INSERT INTO songs_fts (rowid, {fields}) VALUES (new.rowid, {new_fields});
+        END
+        """)
+
+        if not exists:
+            log.info("Indexing your local music database, this may take a while...")
+            cursor.execute("INSERT INTO songs_fts (songs_fts) VALUES ('rebuild')")
+
+        return True
+
+    def close(self):
+        self.conn.close()
 
     def item_exists(self, location):
         """
         Checks if an item already exists in the database. If true, returns the `modified` time.
         """
-        with sqlite3.connect(db_file) as conn:
-            cursor = conn.cursor()
-            query = "SELECT modified FROM songs WHERE location=?"
-            cursor.execute(query, (location,))
-            return cursor.fetchone()
+        cursor = self.conn.cursor()
+        query = "SELECT modified FROM songs WHERE location=?"
+        cursor.execute(query, (location,))
+        return cursor.fetchone()
 
     def update_songs(self, songs_dict, mtimes):
         """
@@ -156,82 +276,158 @@ class Database:
 
             sql_data.append(data)
 
-        with sqlite3.connect(db_file) as conn:
-            cursor = conn.cursor()
-            query = f"REPLACE INTO songs ({self.database_fields}) VALUES (?,?,?,?,?,?,?)"
-            cursor.executemany(query, tuple(sql_data))
-            conn.commit()
-            log.info("Database is up to date!")
+        cursor = self.conn.cursor()
+        query = f"REPLACE INTO songs ({self.database_fields}) VALUES (?,?,?,?,?,?,?)"
+        cursor.executemany(query, tuple(sql_data))
+        self.conn.commit()
+        log.info("Database is up to date!")
+
+    def songs_in(self, directory):
+        """
+        Return a dict of location: modified time for songs directly inside `directory`.
+        """
+        start, end = prefix_range(directory)
+
+        cursor = self.conn.cursor()
+        query = "SELECT location, modified FROM songs WHERE location >= ? AND location < ?"
+        cursor.execute(query, (start, end))
+
+        return {location: modified for location, modified in cursor.fetchall()
+                if os.path.dirname(location) == directory}
+
+    def delete_songs(self, locations):
+        """
+        Remove songs which no longer exist from the database.
+        """
+        cursor = self.conn.cursor()
+        query = "DELETE FROM songs WHERE location=?"
+        cursor.executemany(query, [(location,) for location in locations])
+        self.conn.commit()
+
+    def delete_tree(self, directory):
+        """
+        Remove a directory which no longer exists, and all songs and directories inside it.
+        """
+        start, end = prefix_range(directory)
+
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "DELETE FROM songs WHERE location >= ? AND location < ?", (start, end))
+        cursor.execute(
+            "DELETE FROM directories WHERE path=? OR (path >= ? AND path < ?)", (directory, start, end))
+        self.conn.commit()
+
+    def get_directories(self):
+        """
+        Return a dict of path: (modified time, subdirectories) for all scanned directories.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT path, modified, subdirs FROM directories")
+
+        return {path: (modified, json.loads(subdirs)) for path, modified, subdirs in cursor.fetchall()}
+
+    def update_directories(self, directories):
+        """
+        Save the modified time and subdirectories of scanned directories.
+        """
+        cursor = self.conn.cursor()
+        query = "REPLACE INTO directories (path, modified, subdirs) VALUES (?,?,?)"
+        cursor.executemany(query, [(path, modified, json.dumps(subdirs))
+                                   for path, (modified, subdirs) in directories.items()])
+        self.conn.commit()
+
+    def get_info(self, key):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT value FROM info WHERE key=?", (key,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set_info(self, key, value):
+        self.conn.execute(
+            "REPLACE INTO info (key, value) VALUES (?,?)", (key, str(value)))
+        self.conn.commit()
+
 
     def get_song(self, field, value):
         """
         Return a songs_dict style list of songs which match the requested field:value.
+        ISRCs must match exactly, other fields match if they contain `value`.
         """
-        with sqlite3.connect(db_file) as conn:
-            cursor = conn.cursor()
+        value = value.strip().lower()
+
+        if field == "isrc":
+            query = "SELECT * FROM songs WHERE isrc=?"
+
+        elif self.fts and field in self.indexed_fields and len(value) >= 3:
+            # Trigram index lookup, quoting the value as a phrase so it's matched literally
+            query = f"""
+            SELECT songs.* FROM songs_fts JOIN songs ON songs.rowid=songs_fts.rowid
+            WHERE songs_fts.{field} MATCH ?
+            """
+            value = '"' + value.replace('"', '""') + '"'
+
+        else:
+            # Values shorter than a trigram can't use the index
             query = f"SELECT * FROM songs WHERE instr({field}, ?) > 0"
-            cursor.execute(query, (value.lower(),))
-            rows = cursor.fetchall()
 
-            if rows == []:
-                return
+        cursor = self.conn.cursor()
+        cursor.execute(query, (value,))
+        rows = cursor.fetchall()
 
-            found_songs = []
+        if rows == []:
+            return
 
-            for song in rows:
-                # Convert to songs_dict format
-                try:
-                    item = {
-                        "title": song[1],
-                        "artists": json.loads(song[2]),
-                        "album": song[3],
-                        "date": song[4],
-                        "isrc": song[5],
-                        "location": song[0]
-                    }
+        found_songs = []
 
-                    # Remove any empty fields
-                    item = {k: v for k, v in item.items() if v}
+        for song in rows:
+            # Convert to songs_dict format
+            try:
+                item = {
+                    "title": song[1],
+                    "artists": json.loads(song[2]),
+                    "album": song[3],
+                    "date": song[4],
+                    "isrc": song[5],
+                    "location": song[0]
+                }
 
-                    found_songs.append(item)
-                except TypeError:
-                    log.error("Error parsing JSON, skipping song:")
-                    log.error(song)
+                # Remove any empty fields
+                item = {k: v for k, v in item.items() if v}
 
-            return found_songs
+                found_songs.append(item)
+            except TypeError:
+                log.error("Error parsing JSON, skipping song:")
+                log.error(song)
 
+        return found_songs
 
-def run(settings_dict, **kwargs):
+
+def prefix_range(directory):
     """
-    1. Update local music database.
-    2. Loop over each song without a local path.
-    3. Attempt to match that song with a local file.
-    4. Update the songs_dict if possible.
+    Bounds of the locations inside `directory`, so they can be found with a range query on the primary key.
     """
+    start = os.path.join(directory, "")
+    return start, start[:-1] + chr(ord(start[-1]) + 1)
 
-    database = kwargs["database"]
-    global_settings = kwargs["global_settings"]
-    component = kwargs["component"]
-    applet_id = kwargs["applet_id"]
-    songs_dict = kwargs["songs_dict"]
 
-    db = Database()
+def list_directory(path):
+    """
+    List a directory, returning its subdirectories and a dict of supported music files with their modified times.
+    """
+    subdirs = []
+    files = {}
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    # Like os.walk, symlinked directories are not followed
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
 
-    def update_database():
-        """
-        Checks for modified directories since last scan.
-        Walks over all modified music files in the supplied directory and extracts their tags where supported.
-        Saves all tags to the database.
-        """
-        # Create list of all found music files
-        songs = []
-        mtimes = []
-        songs_length = 0
-        log.info("Searching your local music directory for music files...")
-        for root, _, files in tqdm(os.walk(database["music_dir"]), desc="Searching for new songs"):
-            for item in files:
                 # Check extension is supported
-                _, ext = os.path.splitext(item)
+                _, ext = os.path.splitext(entry.name)
                 ext = ext.lower()
                 if ext in extension_skiplist:
                     # Silently skip the file
@@ -239,50 +435,361 @@ def run(settings_dict, **kwargs):
 
                 if ext not in supported_audio_extensions:
                     # Skip the file
-                    log.debug(item)
+                    log.debug(entry.name)
                     log.debug(
                         f"Unsupported extension for local music file: {ext}")
                     continue
 
-                location = os.path.join(root, item)
+                files[entry.path] = math.floor(entry.stat().st_mtime)
 
-                # Check if file is already in database
-                mtime = db.item_exists(location)
-                new_mtime = math.floor(
-                    os.path.getmtime(location)
-                )
+            except OSError as e:
+                # File was removed while scanning, or is unreadable
+                log.debug(e)
 
-                if mtime == (new_mtime,):
-                    # File already exists in database
-                    continue
+    return subdirs, files
 
-                try:
-                    song = local_tags.tags(location)
-                except NotImplementedError as e:
-                    # Skip the file
-                    log.debug(e)
-                    log.debug(
-                        f"Unsupported extension for local music file: {ext}")
+
+def read_tags(files, executor=None):
+    """
+    Read tags of music files, from the local_tags cache where possible, otherwise using `executor` if supplied.
+
+    @return: list of songs, list of their modified times
+    """
+    cached = local_tags.cached_many(files)
+    unread = [location for location in files if location not in cached]
+
+    if executor is None:
+        results = []
+        for location in unread:
+            try:
+                results.append(local_tags.read_signed(location))
+            except Exception as e:
+                results.append(e)
+    else:
+        futures = [executor.submit(metrics.timed, local_tags.read_signed, location) for location in unread]
+        results = []
+
+        for future in futures:
+            if future.exception():
+                results.append(future.exception())
+                continue
+
+            # Worker processes can't see the collector, so their cpu time is added here
+            result, cpu = future.result()
+            metrics.add_cpu(cpu)
+            results.append(result)
+
+    read = {location: result if isinstance(result, Exception) else result[1]
+            for location, result in zip(unread, results)}
+    local_tags.store_many(
+        [result for result in results if not isinstance(result, Exception)])
+
+    songs = []
+    mtimes = []
+
+    for location, mtime in files.items():
+        song = cached.get(location) or read[location]
+
+        if isinstance(song, Exception):
+            # Skip the file
+            log.warning(f"Could not read tags from {location}: {song}")
+            continue
+
+        songs.append(song)
+        mtimes.append(mtime)
+
+    return songs, mtimes
+
+
+def scan(db, music_dir, full=False, refresh=None):
+    """
+    Brings the database up to date with the music directory.
+
+    Directories are only listed if their modified time has changed since the last scan (or if `full` is True),
+    otherwise their subdirectories are taken from the database. Files in listed directories are compared against
+    the database, so new and modified files have their tags read in a process pool and saved in batches, and
+    deleted files and directories are removed.
+
+    If `refresh` is supplied, only those directories (which are always listed) and their subdirectories are scanned.
+    """
+    known = db.get_directories()
+    scanned = {}
+    changed = {}
+    deleted = []
+    stack = [music_dir.rstrip(os.sep) or os.sep]
+
+    if refresh is not None:
+        refresh = {path.rstrip(os.sep) or os.sep for path in refresh}
+        stack = [path for path in sorted(refresh)
+                 if path == stack[0] or path.startswith(prefix_range(stack[0])[0])]
+
+        # Subdirectories of another refreshed directory are reached from it
+        stack = [path for path in stack
+                 if not any(path.startswith(prefix_range(other)[0]) for other in stack)]
+    else:
+        refresh = set()
+
+    log.info("Searching your local music directory for new songs...")
+
+    while stack:
+        path = stack.pop()
+
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except OSError:
+            # Directory was removed, its parent will have changed
+            continue
+
+        previous = known.get(path)
+        if previous and previous[0] == modified and not full and path not in refresh:
+            # Nothing was added or removed in this directory
+            stack.extend(previous[1])
+            continue
+
+        try:
+            subdirs, files = list_directory(path)
+        except OSError as e:
+            log.warning(f"Could not read directory {path}: {e}")
+            continue
+
+        existing = db.songs_in(path)
+        changed.update({location: mtime for location, mtime in files.items()
+                        if existing.get(location) != mtime})
+        deleted.extend(location for location in existing if location not in files)
+
+        if previous:
+            for subdir in previous[1]:
+                if subdir not in subdirs:
+                    log.debug(f"Directory removed: {subdir}")
+                    db.delete_tree(subdir)
+
+        scanned[path] = (modified, subdirs)
+        stack.extend(subdirs)
+
+    log.info(
+        f"Found {len(changed)} new or modified song(s) and {len(deleted)} removed song(s) in {len(scanned)} changed folder(s).")
+
+    if deleted:
+        db.delete_songs(deleted)
+        local_tags.forget(deleted)
+
+    if changed:
+        locations = list(changed)
+        executor = None
+
+        if len(locations) >= scan_pool_minimum:
+            executor = ProcessPoolExecutor(max_workers=Config.LIBRARY_SCAN_WORKERS)
+
+        try:
+            for i in range(0, len(locations), scan_batch):
+                batch = {location: changed[location] for location in locations[i:i + scan_batch]}
+                db.update_songs(*read_tags(batch, executor))
+
+                log.info(f"Read tags from {min(i + scan_batch, len(locations))} of {len(locations)} song(s).")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    # Directories are only marked as scanned once their songs are saved
+    db.update_directories(scanned)
+
+
+def update_database(db, database):
+    """
+    Scan the music directory, listing every directory if the full rescan interval has passed.
+    """
+    try:
+        full_scan_hours = float(database.get("full_scan_hours") or 24)
+    except ValueError:
+        full_scan_hours = 24
+
+    last_full_scan = float(db.get_info("last_full_scan") or 0)
+    full = last_full_scan + full_scan_hours * 3600 < time.time()
+
+    scan(db, database["music_dir"], full)
+
+    if full:
+        db.set_info("last_full_scan", time.time())
+
+
+class Watcher:
+    """
+    Keeps the database up to date with a music directory in a background thread, shared by all applets.
+
+    Filesystem events mark the directories they happened in, which are rescanned once no more events have
+    arrived for `watch_delay` seconds. Without watchdog, or if the directory can't be watched, it is scanned
+    every `watch_poll_interval` seconds instead.
+    """
+
+    def __init__(self, database):
+        self.database = dict(database)
+        self.music_dir = database["music_dir"]
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+
+        # Set once the first scan has finished, so runs can match against a complete database
+        self.ready = threading.Event()
+
+        self.observer = None
+        self.thread = threading.Thread(
+            target=self.loop, name=f"watch {self.music_dir}", daemon=True)
+        self.thread.start()
+
+    def dispatch(self, event):
+        """
+        Called by the watchdog observer for each filesystem event.
+        """
+        with self.lock:
+            for path in [event.src_path, getattr(event, "dest_path", None)]:
+                if path:
+                    path = os.fsdecode(path)
+                    self.dirty.add(os.path.dirname(path))
+                    if event.is_directory:
+                        self.dirty.add(path)
+
+        self.changed.set()
+
+    def observe(self):
+        """
+        Start watching for filesystem events, returning False if they are not available.
+        """
+        if Observer is None:
+            log.info("watchdog is not installed, your music directory will be scanned periodically instead.")
+            return False
+
+        try:
+            self.observer = Observer()
+            self.observer.schedule(self, self.music_dir, recursive=True)
+            self.observer.start()
+            return True
+
+        except OSError as e:
+            # e.g. too many directories for the inotify watch limit
+            log.warning(f"Could not watch {self.music_dir}, it will be scanned periodically instead: {e}")
+            self.observer = None
+            return False
+
+    def loop(self):
+        db = Database()
+
+        try:
+            # Start observing first, so nothing changed during the first scan is missed
+            observing = self.observe()
+            update_database(db, self.database)
+            self.ready.set()
+
+            while not self.stopped.is_set():
+                if not observing:
+                    self.stopped.wait(watch_poll_interval)
+                    if not self.stopped.is_set():
+                        update_database(db, self.database)
                     continue
 
-                songs.append(song)
-                mtimes.append(new_mtime)
+                self.changed.wait()
+
+                # Wait for a burst of changes (e.g. copying an album) to finish
+                while self.changed.is_set() and not self.stopped.is_set():
+                    self.changed.clear()
+                    self.stopped.wait(watch_delay)
+
+                with self.lock:
+                    dirty, self.dirty = self.dirty, set()
+
+                if dirty and not self.stopped.is_set():
+                    scan(db, self.music_dir, refresh=dirty)
+
+        except Exception as e:
+            log.error(f"Stopped watching {self.music_dir}")
+            log.error(e, exc_info=True)
 
-                current_songs_length = len(mtimes)
-                if current_songs_length >= 100 + songs_length:
-                    log.info(
-                        f"Found {current_songs_length} songs not in the database.")
-                    songs_length += 100
+        finally:
+            self.stop()
+            self.ready.set()
+            db.close()
 
-        db.update_songs(songs, mtimes)
+    def stop(self):
+        self.stopped.set()
+        self.changed.set()
+
+        if self.observer is not None:
+            self.observer.stop()
+
+    @property
+    def running(self):
+        return self.thread.is_alive() and not self.stopped.is_set()
+
+
+# Background watcher for the music directory, if watch mode is enabled
+watcher = None
+watcher_lock = threading.Lock()
+
+
+def watch(database):
+    """
+    Return the running watcher for the music directory, starting or restarting it if needed.
+    """
+    global watcher
+
+    with watcher_lock:
+        if watcher is not None and (not watcher.running or watcher.database != database):
+            watcher.stop()
+            watcher = None
+
+        if watcher is None:
+            log.info(f"Watching {database['music_dir']} for changes.")
+            watcher = Watcher(database)
+
+        return watcher
+
+
+def unwatch():
+    """
+    Stop the watcher, if one is running.
+    """
+    global watcher
+
+    with watcher_lock:
+        if watcher is not None:
+            watcher.stop()
+            watcher = None
+
+
+def run(settings_dict, **kwargs):
+    """
+    1. Update local music database.
+    2. Loop over each song without a local path.
+    3. Attempt to match that song with a local file.
+    4. Update the songs_dict if possible.
+    """
+
+    database = kwargs["database"]
+    global_settings = kwargs["global_settings"]
+    component = kwargs["component"]
+    applet_id = kwargs["applet_id"]
+    songs_dict = kwargs["songs_dict"]
+
+    db = Database()
 
     # 1. Update the database with any new songs added.
-    update_database()
+    if database.get("library_updates") == "Watch":
+        # The watcher keeps the database up to date, so only wait for its first scan
+        current = watch(database)
+        current.ready.wait()
+
+        if not current.running:
+            # Watcher failed, fall back to scanning this run
+            update_database(db, database)
+    else:
+        unwatch()
+        update_database(db, database)
 
     preferred_order = ["isrc", "title", "artists", "album"]
 
     total_count = 0
     matched_count = 0
+    fuzzy_ratio = float(database.get("fuzzy_ratio") or 90)
 
     for i, playlist in enumerate(songs_dict):
         for j, song in enumerate(playlist["songs"]):
@@ -290,48 +797,45 @@ def run(settings_dict, **kwargs):
                 # Location already exists
                 continue
 
-            checked_songs = []
+            checked_locations = set()
             found = False
 
-            # Loop over available keys in order of preference
+            # Loop over available keys in order of preference, fetching candidates through the indexes
             for key in [key for key in preferred_order if key in song]:
-                if key == "id":
-                    continue
-                elif key == "artists":
-                    resp = [db.get_song(key, value) for value in song[key]]
-
-                    # Remove None from items
-                    resp = [item for item in resp if item != None]
-
-                    if resp:
-                        # Flatten list response
-                        resp = [item for sublist in resp for item in sublist]
+                if key == "artists":
+                    resp = []
+                    for value in song[key]:
+                        resp.extend(db.get_song(key, value) or [])
                 else:
-                    resp = db.get_song(key, song[key])
+                    resp = db.get_song(key, song[key]) or []
 
-                if resp:
-                    for item in resp:
-                        if item in checked_songs:
-                            continue
+                for item in resp:
+                    if item["location"] in checked_locations:
+                        continue
 
-                        score = fuzzymatch.similarity(song, item)
-                        if score > float(database.get("fuzzy_ratio") or 90):
-                            # Match found
-                            songs_dict[i]["songs"][j]["location"] = item["location"]
-                            found = True
-                            break
+                    checked_locations.add(item["location"])
 
-                    checked_songs.extend(resp)
+                    score = fuzzymatch.similarity(song, item)
+                    if score > fuzzy_ratio:
+                        # Match found
+                        songs_dict[i]["songs"][j]["location"] = item["location"]
+                        found = True
+                        break
 
                 if found:
                     matched_count += 1
                     total_count += 1
                     break
 
+            # Every checked location was compared once
+            metrics.count("comparisons", len(checked_locations))
+
             if not found:
                 log.info(f"No local match was found for {song}")
                 total_count += 1
 
+    db.close()
+
     log.info(f"{matched_count} songs out of a total of {total_count} were matched with your local library, or already had a local path.")
 
     return songs_dict
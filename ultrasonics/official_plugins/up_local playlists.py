@@ -248,6 +248,8 @@ def run(settings_dict, **kwargs):
         playlists = [
             item for item in playlists if item["name"] in filter_titles]
 
+        song_paths = []
+
         for playlist in playlists:
 
             # Initialise entry for this playlist
@@ -261,10 +263,12 @@ def run(settings_dict, **kwargs):
             songs = io.open(playlist["path"], 'r',
                             encoding='utf8').read().splitlines()
 
+            paths = []
+
             for song in songs:
 
-                # Skip .m3u tags beginning with "#"
-                if song.startswith("#"):
+                # Skip blank lines and .m3u tags beginning with "#"
+                if not song.strip() or song.startswith("#"):
                     continue
 
                 # Convert path to be usable by ultrasonics
@@ -273,27 +277,20 @@ def run(settings_dict, **kwargs):
                 song_path = os.path.join(
                     database["ultrasonics_prepend"], song_path)
 
-                # Skip files which don't exist
-                if not os.path.isfile(song_path):
-                    continue
-
-                try:
-                    temp_song_dict = local_tags.tags(song_path)
+                paths.append(song_path)
 
-                except NotImplementedError:
-                    log.warning(
-                        f"The file {song_path} is not a supported filetype")
-                    continue
-
-                except Exception as e:
-                    log.error(f"Could not load tags from song: {song_path}")
-                    log.error(e)
+            songs_dict.append(songs_dict_entry)
+            song_paths.append(paths)
 
-                # Add entry to the full songs dict for this playlist
-                songs_dict_entry["songs"].append(temp_song_dict)
+        # Read tags for songs in all playlists at once, skipping files which don't exist or can't be read
+        all_tags = local_tags.tags_many(
+            [path for paths in song_paths for path in paths])
 
-            # Add previous playlist to full songs_dict
-            songs_dict.append(songs_dict_entry)
+        i = 0
+        for songs_dict_entry, paths in zip(songs_dict, song_paths):
+            songs_dict_entry["songs"] = [
+                song for song in all_tags[i:i + len(paths)] if song is not None]
+            i += len(paths)
 
         return songs_dict
 
@@ -99,9 +99,9 @@ def run(settings_dict, **kwargs):
 
         output_playlist = copy.deepcopy(playlist_b)
 
-        for song in playlist_a:
-            is_duplicate = fuzzymatch.duplicate(song, playlist_b, fuzzy_ratio)
+        index = fuzzymatch.SongIndex(playlist_b)
 
+        for song, is_duplicate in zip(playlist_a, index.contains_many(playlist_a, fuzzy_ratio)):
             if not is_duplicate:
                 output_playlist.append(song)
 
@@ -24,8 +24,8 @@ import plexapi.server
 import plexapi.exceptions
 import plexapi.playlist
 from tqdm import tqdm
-from ultrasonics import logs
-from ultrasonics.tools import local_tags, fuzzymatch
+from ultrasonics import logs, metrics
+from ultrasonics.tools import local_tags, fuzzymatch, resolve_cache
 
 log = logs.create_log(__name__)
 
@@ -158,6 +158,9 @@ def run(settings_dict, **kwargs):
         if preferred_library:
             libraries.insert(0, preferred_library)
 
+        # Plex ids are only valid for this server
+        service = f"plex:{plex.machineIdentifier}"
+
         # Loop over supplied songs_dict and check for pre-existing playlists on Plex
         # If a playlist exists, add songs to it. If not, create it.
         for playlist in tqdm(songs_dict, desc="Processing playlists"):
@@ -175,6 +178,22 @@ def run(settings_dict, **kwargs):
             songs_to_add = []
             for song in tqdm(playlist["songs"], desc="Adding songs"):
 
+                # Check if song was previously resolved
+                cached = resolve_cache.lookup(service, song)
+                if cached is not None:
+                    plex_key, confidence = cached
+
+                    if not plex_key or confidence < float(settings_dict["fuzzy_ratio"]):
+                        log.warning(f"Song {song['title']} not found on Plex. Skipping...")
+                        continue
+
+                    try:
+                        songs_to_add.append(plex.fetchItem(plex_key))
+                        continue
+                    except plexapi.exceptions.NotFound:
+                        # Song was removed from Plex since it was resolved
+                        resolve_cache.forget(service, song)
+
                 # Check if song exists on Plex
                 plex_songs = preferred_library.search(
                     title=song["title"], libtype="track", maxresults=10
@@ -189,6 +208,7 @@ def run(settings_dict, **kwargs):
 
                 # If still no match is found, log it and skip it
                 if not plex_songs:
+                    resolve_cache.store(service, song, "", 0)
                     log.warning(f"Song {song['title']} not found on Plex. Skipping...")
                     continue
 
@@ -202,6 +222,12 @@ def run(settings_dict, **kwargs):
                     fuzzymatch.similarity(song, plex_song)
                     for plex_song in plex_songs_ultrasonics
                 ]
+                metrics.count("comparisons", len(scores))
+
+                resolve_cache.store(
+                    service, song, plex_songs[scores.index(max(scores))].key, max(scores),
+                    accepted=max(scores) >= float(settings_dict["fuzzy_ratio"])
+                )
 
                 # If there's a match, add it to the playlist
                 if max(scores) >= float(settings_dict["fuzzy_ratio"]):
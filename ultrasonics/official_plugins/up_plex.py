@@ -19,11 +19,8 @@ from collections import OrderedDict
 from urllib.parse import urlencode
 from xml.etree import ElementTree
 
-import requests
-from tqdm import tqdm
-
 from ultrasonics import logs
-from ultrasonics.tools import local_tags
+from ultrasonics.tools import http_client, local_tags
 
 log = logs.create_log(__name__)
 
@@ -107,9 +104,12 @@ def run(settings_dict, **kwargs):
     songs_dict = kwargs["songs_dict"]
 
     def fetch_playlist(key):
+        """
+        Fetch a playlist from Plex, returning its title and the ultrasonics paths of its songs.
+        """
         url = f"{database['server_url']}{key}?X-Plex-Token={database['plex_token']}"
 
-        resp = requests.get(url, timeout=30, verify=check_ssl)
+        resp = http_client.get(url, service="plex", timeout=30, verify=check_ssl)
 
         if resp.status_code != 200:
             raise Exception(
@@ -119,8 +119,8 @@ def run(settings_dict, **kwargs):
 
         title = root.get("title")
 
-        playlist = []
-        for document in tqdm(root.findall("Track"), desc=f"Fetching songs from playlist: {title}"):
+        paths = []
+        for document in root.findall("Track"):
             song = document[0][0].get('file')
 
             # Convert path to be usable by ultrasonics
@@ -129,15 +129,9 @@ def run(settings_dict, **kwargs):
             song_path = os.path.join(
                 database["ultrasonics_prepend"], song_path)
 
-            try:
-                song_dict = local_tags.tags(song_path)
-            except Exception as e:
-                log.error(f"Could not load tags from song: {song_path}")
-                log.error(e)
+            paths.append(song_path)
 
-            playlist.append(song_dict)
-
-        return title, playlist
+        return title, paths
 
     def remove_prepend(path, invert=False):
         """
@@ -179,7 +173,7 @@ def run(settings_dict, **kwargs):
     log.info(
         f"Requesting playlists from endpoint: {url.replace(database['plex_token'], '***********')}")
 
-    resp = requests.get(url, timeout=30, verify=check_ssl)
+    resp = http_client.get(url, service="plex", timeout=30, verify=check_ssl)
 
     if resp.status_code != 200:
         raise Exception(
@@ -206,9 +200,11 @@ def run(settings_dict, **kwargs):
     if component == "inputs":
         songs_dict = []
 
+        song_paths = []
+
         # Copies Plex playlists to .ultrasonics_tmp folder in music directory
         for key in keys:
-            name, playlist = fetch_playlist(key)
+            name, paths = fetch_playlist(key)
 
             # Check if title matches regex setting
             if re.match(settings_dict["filter"], name, re.IGNORECASE):
@@ -217,10 +213,21 @@ def run(settings_dict, **kwargs):
                 songs_dict_entry = {
                     "name": name,
                     "id": {},
-                    "songs": playlist
+                    "songs": []
                 }
 
                 songs_dict.append(songs_dict_entry)
+                song_paths.append(paths)
+
+        # Read tags for songs in all matching playlists at once
+        all_tags = local_tags.tags_many(
+            [path for paths in song_paths for path in paths])
+
+        i = 0
+        for songs_dict_entry, paths in zip(songs_dict, song_paths):
+            songs_dict_entry["songs"] = [
+                song for song in all_tags[i:i + len(paths)] if song is not None]
+            i += len(paths)
 
         return songs_dict
 
@@ -290,8 +297,8 @@ def run(settings_dict, **kwargs):
             querystring = urlencode(OrderedDict(
                 [("sectionID", section_id), ("path", playlist_path_plex), ("X-Plex-Token", database["plex_token"])]))
 
-            response = requests.post(
-                url, data="", headers=headers, params=querystring, verify=check_ssl)
+            response = http_client.post(
+                url, service="plex", data="", headers=headers, params=querystring, verify=check_ssl)
 
             # Should return nothing but if there's an issue there may be an error shown
             if not response.text == '':
@@ -311,7 +318,7 @@ def test(database, **kwargs):
     url = f"{database['server_url']}/playlists/?X-Plex-Token={database['plex_token']}"
     check_ssl = database["check_ssl"] == "Yes"
 
-    resp = requests.get(url, timeout=5, verify=check_ssl)
+    resp = http_client.get(url, service="plex", timeout=5, verify=check_ssl)
 
     if resp.status_code == 200:
         log.debug("Test successful.")
@@ -357,7 +364,7 @@ def builder(**kwargs):
     url = f"{database['server_url']}/library/sections/?X-Plex-Token={database['plex_token']}"
     check_ssl = "check_ssl" in database.keys()
 
-    resp = requests.get(url, timeout=30, verify=check_ssl)
+    resp = http_client.get(url, service="plex", timeout=30, verify=check_ssl)
 
     if resp.status_code != 200:
         raise Exception(
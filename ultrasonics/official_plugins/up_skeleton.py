@@ -14,6 +14,10 @@ handshake = {
         "songs"
     ],
     "version": "0.0",  # Optionally, "0.0.0"
+    # "executor": "process",  # Optionally, run in a separate process (for CPU heavy plugins)
+    # "concurrency": 1,  # Optionally, limit how many instances of this plugin can run at once
+    # "incremental": True,  # Outputs only: receive only changed playlists, each with a "diff" of added, removed and moved songs
+    # "trigger": "time",  # Triggers only: "time" if the plugin has a next_fire function, or "event" if runs are pushed to the scheduler
     "settings": [
         {
             "type": "text",
@@ -67,6 +71,35 @@ def run(settings_dict, **kwargs):
     pass
 
 
+def stream(settings_dict, **kwargs):
+    """
+    An optional streaming version of `run`. If present, it is used instead of `run`, so playlists can flow
+    through the applet one at a time without waiting for every plugin to finish.
+
+    Inputs are the same as `run`, except modifiers and outputs receive `playlists`,
+    an iterator of playlists in songs_dict format, instead of `songs_dict`.
+
+    @return:
+    If an input or modifier, yield each playlist as soon as it is ready.
+    """
+
+    for playlist in kwargs["playlists"]:
+        yield playlist
+
+
+def validate(settings_dict, **kwargs):
+    """
+    An optional validation function, called with this plugin instance's settings when an applet is saved.
+    Raise ValueError if the settings can never work (e.g. an invalid schedule), and the applet will not be saved.
+
+    Inputs:
+    settings_dict      Settings specific to this plugin instance
+    component          Either "inputs", "modifiers", "outputs", or "trigger"
+    """
+
+    pass
+
+
 def test(database, **kwargs):
     """
     An optional test function. Used to validate persistent settings supplied in database.
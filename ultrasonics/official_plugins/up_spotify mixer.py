@@ -8,21 +8,16 @@ Creates new playlists based on a seed input.
 XDGFX, 2020
 """
 
-import bz2
 import json
-import os
-import pickle
 import random
-import re
-from urllib.parse import urlencode, urljoin
+import threading
+from urllib.parse import urlencode
 
-import requests
 import spotipy
 from tqdm import tqdm
 
-from app import _ultrasonics
-from ultrasonics import logs
-from ultrasonics.tools import api_key, fuzzymatch
+from ultrasonics import logs, metrics
+from ultrasonics.tools import fuzzymatch, resolve_cache, spotify_token
 
 log = logs.create_log(__name__)
 
@@ -81,122 +76,58 @@ def run(settings_dict, **kwargs):
         """
 
         def __init__(self):
-            # Use same cache as up_spotify
-            self.cache_file = os.path.join(
-                _ultrasonics["config_dir"], "up_spotify", "up_spotify.bz2")
+            # Only one thread replaces the client at a time
+            self.lock = threading.Lock()
 
-            log.info(f"Credentials will be cached in: {self.cache_file}")
+            self.token = None
+            self.sp = None
 
-            # Create the containing folder if it doesn't already exist
-            try:
-                os.mkdir(os.path.dirname(self.cache_file))
-            except FileExistsError:
-                # Folder already exists
-                pass
-
-        def token_get(self, force=False):
-            """
-            Updates the global access_token variable, in the following order of preference:
-            1. A locally saved access token.
-            2. Renews token using the database refresh_token.
-
-            If #2, the access token is saved to a .cache file.
-            """
-            log.debug("Fetching your Spotify token")
-            if os.path.isfile(self.cache_file) and not force:
-                with bz2.BZ2File(self.cache_file, "r") as f:
-                    raw = json.loads(pickle.load(f))
-                    token = raw["access_token"]
-
-                # Checks that the cached token is valid
-                if self.token_validate(token):
-                    log.debug("Returning cached token")
-                    return token
-
-            # In all other cases, renew the token
-            log.debug("Returning renewed token")
-            return self.token_renew()
-
-        def token_validate(self, token):
+        def token_get(self, stale=None):
             """
-            Checks if an auth token is valid, by making a request to the Spotify api.
+            Gets an access token from the token cache shared with up_spotify, which renews it if it is close to expiry.
+            If `stale` is supplied, that token was rejected by Spotify so is renewed.
             """
-            url = f"https://api.spotify.com/v1/search"
-            params = {
-                "q": "Flume",
-                "type": "artist"
-            }
-            headers = {
-                "Authorization": f"Bearer {token}"
-            }
+            return spotify_token.get(self.refresh_token, self.api_url, stale=stale)
 
-            resp = requests.get(url, headers=headers, params=params)
-
-            if resp.status_code == 200:
-                log.debug("Token is valid.")
-                return True
-
-            elif resp.status_code == 401:
-                log.debug("Token is not valid.")
-                return False
-
-            else:
-                log.error(f"Unexpected status code: {resp.status_code}")
-                raise Exception(resp.text)
-
-        def token_renew(self):
-            """
-            Using refresh_token, requests and saves a new access token.
+        def client(self):
             """
+            The spotipy client, rebuilt whenever the access token has been renewed.
 
-            url = urljoin(self.api_url, "spotify/auth/renew")
-            data = {
-                "refresh_token": self.refresh_token,
-                "ultrasonics_auth_hash": api_key.get_hash(True)
-            }
-
-            log.info(
-                "Requesting a new Spotify token, this may take a few seconds...")
-
-            # Request with a long timeout to account for free Heroku start-up 😉
-            resp = requests.post(url, data=data, timeout=60)
-
-            if resp.status_code == 200:
-                token = resp.json()["access_token"]
-
-                log.debug(
-                    f"Spotify renew data: {resp.text.replace(token, '***************')}")
+            @returns:
+            access token, spotipy client
+            """
+            token = self.token_get()
 
-                with bz2.BZ2File(self.cache_file, "w") as f:
-                    pickle.dump(resp.text, f)
+            with self.lock:
+                if token != self.token:
+                    self.token = token
+                    self.sp = spotipy.Spotify(auth=token, requests_timeout=60)
 
-                return token
-
-            else:
-                log.error(resp.text)
-                raise Exception(
-                    f"The response `when renewing Spotify token was unexpected: {resp.status_code}")
+                return self.token, self.sp
 
         def request(self, sp_func, *args, **kwargs):
             """
             Used to call a spotipy function, with automatic catching and renewing on access token errors.
             """
-            errors = 0
+            # The token is shared by every applet, so it is only renewed if Spotify rejected it
+            for attempt in range(2):
+                token, sp = self.client()
+
+                # Call the function on the current client, in case the token was renewed
+                sp_func = getattr(sp, sp_func.__name__)
 
-            while errors <= 1:
                 try:
-                    return sp_func(*args, **kwargs)
+                    with metrics.api_call("spotify"):
+                        return sp_func(*args, **kwargs)
 
                 except spotipy.exceptions.SpotifyException as e:
-                    # Renew token
-                    log.error(e)
-                    self.sp = spotipy.Spotify(auth=self.token_get(force=True))
-                    errors += 1
-                    continue
+                    if e.http_status != 401 or attempt:
+                        log.error(f"An error occurred while trying to contact the Spotify api: {e}")
+                        raise
 
-            log.error(
-                "An error occurred while trying to contact the Spotify api.")
-            raise Exception(e)
+                    # Renew token, unless another applet already has
+                    log.warning(f"Spotify access token was rejected, renewing it: {e}")
+                    self.token_get(stale=token)
 
         def search(self, track):
             """
@@ -207,11 +138,6 @@ def run(settings_dict, **kwargs):
             Spotify URI, confidence score
             """
 
-            cutoff_regex = [
-                "[([](feat|ft|featuring|original|prod).+?[)\]]",
-                "[ (\- )\-]+(feat|ft|featuring|original|prod).+?(?=[(\n])"
-            ]
-
             # 1. Spotify ID
             try:
                 spotify_id = track["id"]["spotify"]
@@ -223,7 +149,12 @@ def run(settings_dict, **kwargs):
                 # Spotify ID was not supplied
                 pass
 
-            # 2. Other fields
+            # 2. Previously resolved
+            cached = resolve_cache.lookup("spotify", track)
+            if cached is not None:
+                return cached
+
+            # 3. Other fields
             # Multiple searches are made as Spotify is more likely to return false negative (missing songs)
             # than false positive, when specifying many query parameters.
 
@@ -235,20 +166,12 @@ def run(settings_dict, **kwargs):
             except KeyError:
                 # If no ISRC, add all additional queries
                 try:
-                    title = re.sub(cutoff_regex[0], "",
-                                   track['title'], flags=re.IGNORECASE) + "\n"
-
-                    title = re.sub(cutoff_regex[1], " ",
-                                   title, flags=re.IGNORECASE).strip()
+                    title = fuzzymatch.clean(track["title"])
                 except KeyError:
                     pass
 
                 try:
-                    album = re.sub(cutoff_regex[0], "",
-                                   track['album'], flags=re.IGNORECASE) + "\n"
-
-                    album = re.sub(cutoff_regex[1], " ",
-                                   album, flags=re.IGNORECASE).strip()
+                    album = fuzzymatch.clean(track["album"])
                 except KeyError:
                     pass
 
@@ -283,12 +206,13 @@ def run(settings_dict, **kwargs):
 
             if not results_list:
                 # No items were found
+                resolve_cache.store("spotify", track, "", 0)
                 return "", 0
 
             # Check results with fuzzy matching
             confidence = 0
 
-            for item in results_list:
+            for compared, item in enumerate(results_list, 1):
                 score = fuzzymatch.similarity(track, item)
                 if score > confidence:
                     matched_track = item
@@ -296,7 +220,11 @@ def run(settings_dict, **kwargs):
                     if confidence > 100:
                         break
 
+            metrics.count("comparisons", compared)
+
             spotify_id = matched_track['id']['spotify']
+            resolve_cache.store("spotify", track, spotify_id, confidence,
+                                accepted=confidence > float(database.get("fuzzy_ratio") or 90))
 
             return spotify_id, confidence
 
@@ -354,7 +282,7 @@ def run(settings_dict, **kwargs):
     auth = json.loads(database["auth"])
     s.refresh_token = auth["refresh_token"]
 
-    s.sp = spotipy.Spotify(auth=s.token_get(), requests_timeout=60)
+    s.client()
 
     playlist_titles = settings_dict["playlist_titles"].split(",")
 
@@ -9,22 +9,20 @@ Will not overwrite songs already in a playlist, so stuff like date added are kep
 XDGFX, 2020
 """
 
-import bz2
+import contextvars
 import json
 import os
-import pickle
-import re
 import sqlite3
+import threading
 import time
-from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 import spotipy
 from tqdm import tqdm
 
 from app import _ultrasonics
-from ultrasonics import logs
-from ultrasonics.tools import api_key, fuzzymatch, name_filter
+from ultrasonics import logs, metrics
+from ultrasonics.tools import fuzzymatch, name_filter, resolve_cache, spotify_token
 
 log = logs.create_log(__name__)
 
@@ -33,7 +31,8 @@ handshake = {
     "description": "sync your playlists to and from spotify",
     "type": ["inputs", "outputs"],
     "mode": ["playlists"],
-    "version": "0.5",
+    "version": "0.6",
+    "incremental": True,
     "settings": [
         {"type": "auth", "label": "Authorise Spotify", "path": "/spotify/auth/request"},
         {
@@ -65,6 +64,42 @@ handshake = {
 }
 
 
+# Number of Spotify requests made at once, when searching for songs or fetching pages of results
+request_workers = 8
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` requests per second on average, in bursts of up to `burst`.
+    Thread safe; callers which are over the limit sleep until their turn.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Take a token now, or reserve the next one and wait for it
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+# Spotify limits requests per app over a rolling 30 second window, so every run in this process shares one limiter.
+# Anything over the limit is answered with 429 and Retry-After, which spotipy waits for before retrying.
+limiter = RateLimiter(rate=20, burst=40)
+
+
 def run(settings_dict, **kwargs):
     """
     Runs the up_spotify plugin.
@@ -86,117 +121,82 @@ def run(settings_dict, **kwargs):
         """
 
         def __init__(self):
-            self.cache_file = os.path.join(
-                _ultrasonics["config_dir"], "up_spotify", "up_spotify.bz2"
-            )
+            # Folder for the plugin database, created if it doesn't already exist
+            os.makedirs(os.path.join(_ultrasonics["config_dir"], "up_spotify"), exist_ok=True)
 
-            log.info(f"Credentials will be cached in: {self.cache_file}")
+            # Only one thread replaces the client at a time
+            self.lock = threading.Lock()
 
-            # Create the containing folder if it doesn't already exist
-            try:
-                os.mkdir(os.path.dirname(self.cache_file))
-            except FileExistsError:
-                # Folder already exists
-                pass
+            self.token = None
+            self.sp = None
 
-        def token_get(self, force=False):
+        def token_get(self, stale=None):
             """
-            Updates the global access_token variable, in the following order of preference:
-            1. A locally saved access token.
-            2. Renews token using the database refresh_token.
-
-            If #2, the access token is saved to a .cache file.
+            Gets an access token from the shared token cache, which renews it if it is close to expiry.
+            If `stale` is supplied, that token was rejected by Spotify so is renewed.
             """
-            log.debug("Fetching your Spotify token")
-            if os.path.isfile(self.cache_file) and not force:
-                with bz2.BZ2File(self.cache_file, "r") as f:
-                    raw = json.loads(pickle.load(f))
-                    token = raw["access_token"]
-
-                # Checks that the cached token is valid
-                if self.token_validate(token):
-                    log.debug("Returning cached token")
-                    return token
-
-            # In all other cases, renew the token
-            log.debug("Returning renewed token")
-            return self.token_renew()
+            return spotify_token.get(self.refresh_token, self.api_url, stale=stale)
 
-        def token_validate(self, token):
+        def client(self):
             """
-            Checks if an auth token is valid, by making a request to the Spotify api.
-            """
-            url = f"https://api.spotify.com/v1/search"
-            params = {"q": "Flume", "type": "artist"}
-            headers = {"Authorization": f"Bearer {token}"}
-
-            resp = requests.get(url, headers=headers, params=params)
+            The spotipy client, rebuilt whenever the access token has been renewed.
 
-            if resp.status_code == 200:
-                log.debug("Token is valid.")
-                return True
+            @returns:
+            access token, spotipy client
+            """
+            token = self.token_get()
 
-            elif resp.status_code == 401:
-                log.debug("Token is not valid.")
-                return False
+            with self.lock:
+                if token != self.token:
+                    self.token = token
+                    self.sp = spotipy.Spotify(auth=token, requests_timeout=60)
 
-            else:
-                log.error(f"Unexpected status code: {resp.status_code}")
-                raise Exception(resp.text)
+                return self.token, self.sp
 
-        def token_renew(self):
+        def request(self, sp_func, *args, **kwargs):
             """
-            Using refresh_token, requests and saves a new access token.
+            Used to call a spotipy function, with automatic catching and renewing on access token errors.
             """
+            # The token is shared by every applet, so it is only renewed if Spotify rejected it
+            for attempt in range(2):
+                token, sp = self.client()
 
-            url = urljoin(self.api_url, "spotify/auth/renew")
-            data = {
-                "refresh_token": self.refresh_token,
-                "ultrasonics_auth_hash": api_key.get_hash(True),
-            }
-
-            log.info("Requesting a new Spotify token, this may take a few seconds...")
-
-            # Request with a long timeout to account for free Heroku start-up 😉
-            resp = requests.post(url, data=data, timeout=60)
+                # Call the function on the current client, in case the token was renewed
+                sp_func = getattr(sp, sp_func.__name__)
 
-            if resp.status_code == 200:
-                token = resp.json()["access_token"]
-
-                log.debug(
-                    f"Spotify renew data: {resp.text.replace(token, '***************')}"
-                )
-
-                with bz2.BZ2File(self.cache_file, "w") as f:
-                    pickle.dump(resp.text, f)
+                try:
+                    limiter.acquire()
+                    with metrics.api_call("spotify"):
+                        return sp_func(*args, **kwargs)
 
-                return token
+                except spotipy.exceptions.SpotifyException as e:
+                    if e.http_status != 401 or attempt:
+                        log.error(f"An error occurred while trying to contact the Spotify api: {e}")
+                        raise
 
-            else:
-                log.error(resp.text)
-                raise Exception(
-                    f"The response `when renewing Spotify token was unexpected: {resp.status_code}"
-                )
+                    # Renew token, unless another thread or applet already has
+                    log.warning(f"Spotify access token was rejected, renewing it: {e}")
+                    self.token_get(stale=token)
 
-        def request(self, sp_func, *args, **kwargs):
+        def search_many(self, tracks):
             """
-            Used to call a spotipy function, with automatic catching and renewing on access token errors.
+            Search for many songs concurrently, sharing the rate limit.
+
+            @returns:
+            list of (Spotify URI, confidence score), in the same order as `tracks`
             """
-            errors = 0
+            if not tracks:
+                return []
 
-            while errors <= 1:
-                try:
-                    return sp_func(*args, **kwargs)
+            # Each search runs in its own copy of this context, so api calls and cpu time are recorded for this run
+            context = contextvars.copy_context()
 
-                except spotipy.exceptions.SpotifyException as e:
-                    # Renew token
-                    log.error(e)
-                    self.sp = spotipy.Spotify(auth=self.token_get(force=True))
-                    errors += 1
-                    continue
+            def search(track):
+                return context.copy().run(metrics.worker, self.search, track)
 
-            log.error("An error occurred while trying to contact the Spotify api.")
-            raise Exception(e)
+            with ThreadPoolExecutor(max_workers=min(request_workers, len(tracks))) as executor:
+                return list(tqdm(executor.map(search, tracks), total=len(tracks),
+                                 desc="Searching Spotify"))
 
         def search(self, track):
             """
@@ -207,11 +207,6 @@ def run(settings_dict, **kwargs):
             Spotify URI, confidence score
             """
 
-            cutoff_regex = [
-                "[([](feat|ft|featuring|original|prod).+?[)\]]",
-                "[ (\- )\-]+(feat|ft|featuring|original|prod).+?(?=[(\n])",
-            ]
-
             # 1. Spotify ID
             try:
                 spotify_id = track["id"]["spotify"]
@@ -224,7 +219,13 @@ def run(settings_dict, **kwargs):
                 # Spotify ID was not supplied
                 pass
 
-            # 2. Other fields
+            # 2. Previously resolved
+            cached = resolve_cache.lookup("spotify", track)
+            if cached is not None:
+                spotify_id, confidence = cached
+                return (f"spotify:track:{spotify_id}" if spotify_id else ""), confidence
+
+            # 3. Other fields
             # Multiple searches are made as Spotify is more likely to return false negative (missing songs)
             # than false positive, when specifying many query parameters.
 
@@ -236,26 +237,12 @@ def run(settings_dict, **kwargs):
             except KeyError:
                 # If no ISRC, add all additional queries
                 try:
-                    title = (
-                        re.sub(cutoff_regex[0], "", track["title"], flags=re.IGNORECASE)
-                        + "\n"
-                    )
-
-                    title = re.sub(
-                        cutoff_regex[1], " ", title, flags=re.IGNORECASE
-                    ).strip()
+                    title = fuzzymatch.clean(track["title"])
                 except KeyError:
                     pass
 
                 try:
-                    album = (
-                        re.sub(cutoff_regex[0], "", track["album"], flags=re.IGNORECASE)
-                        + "\n"
-                    )
-
-                    album = re.sub(
-                        cutoff_regex[1], " ", album, flags=re.IGNORECASE
-                    ).strip()
+                    album = fuzzymatch.clean(track["album"])
                 except KeyError:
                     pass
 
@@ -289,12 +276,13 @@ def run(settings_dict, **kwargs):
 
             if not results_list:
                 # No items were found
+                resolve_cache.store("spotify", track, "", 0)
                 return "", 0
 
             # Check results with fuzzy matching
             confidence = 0
 
-            for item in results_list:
+            for compared, item in enumerate(results_list, 1):
                 score = fuzzymatch.similarity(track, item)
                 if score > confidence:
                     matched_track = item
@@ -302,31 +290,50 @@ def run(settings_dict, **kwargs):
                     if confidence > 100:
                         break
 
+            metrics.count("comparisons", compared)
+
+            resolve_cache.store("spotify", track, matched_track["id"]["spotify"], confidence,
+                                accepted=confidence > float(database.get("fuzzy_ratio") or 90))
             spotify_uri = f"spotify:track:{matched_track['id']['spotify']}"
 
             return spotify_uri, confidence
 
-        def current_user_playlists(self):
+        def request_pages(self, sp_func, *args, limit, convert=None, **kwargs):
             """
-            Wrapper for Spotify `current_user_playlists` which overcomes the request item limit.
+            Fetch every page of results from a paginated spotipy function.
+            The first page gives the total, so the remaining pages are then fetched concurrently, sharing the rate limit.
+            If supplied, `convert` is applied to the items of each page as it arrives.
+
+            @returns:
+            list of items from all pages, in order
             """
-            limit = 50
-            playlists = self.request(
-                self.sp.current_user_playlists, limit=limit, offset=0
-            )["items"]
 
-            playlist_count = len(playlists)
-            i = 1
+            def fetch(offset):
+                response = self.request(sp_func, *args, limit=limit, offset=offset, **kwargs)
+                items = response["items"]
+
+                return response["total"], convert(items) if convert else items
 
-            # Get all playlists from the user
-            while playlist_count == limit:
-                buffer = self.request(
-                    self.sp.current_user_playlists, limit=limit, offset=limit * i
-                )["items"]
+            total, items = fetch(0)
+            offsets = range(limit, total, limit)
 
-                playlists.extend(buffer)
-                playlist_count = len(buffer)
-                i += 1
+            if offsets:
+                context = contextvars.copy_context()
+
+                def page(offset):
+                    return context.copy().run(metrics.worker, fetch, offset)
+
+                with ThreadPoolExecutor(max_workers=min(request_workers, len(offsets))) as executor:
+                    for _, buffer in executor.map(page, offsets):
+                        items.extend(buffer)
+
+            return items
+
+        def current_user_playlists(self):
+            """
+            Wrapper for Spotify `current_user_playlists` which overcomes the request item limit.
+            """
+            playlists = self.request_pages(self.sp.current_user_playlists, limit=50)
 
             log.info(f"Found {len(playlists)} playlist(s) on Spotify.")
 
@@ -347,57 +354,49 @@ def run(settings_dict, **kwargs):
 
             return spotify_ids, tracks
 
-        def playlist_tracks(self, playlist_id):
+        def playlist_tracks(self, playlist_id, snapshot_id=None):
             """
             Wrapper for Spotipy `playlist_tracks` which overcomes the request item limit.
+            Tracks are converted to ultrasonics format as each page arrives.
+
+            If the playlist's `snapshot_id` is supplied, tracks are read from the playlist cache when the playlist
+            has not changed since it was last fetched, and saved to it otherwise.
             """
-            limit = 100
-            fields = "items(track(album(name,release_date),artists,id,name,track_number,external_ids))"
-            tracks = self.request(
-                self.sp.playlist_tracks,
-                playlist_id,
-                limit=limit,
-                offset=0,
-                fields=fields,
-            )
+            if snapshot_id:
+                tracks = db.playlist_cache_get(playlist_id, snapshot_id)
+                if tracks is not None:
+                    log.info(f"Playlist {playlist_id} is unchanged, using cached tracks.")
+                    metrics.count("spotify_playlist_cache_hits")
+                    return tracks
 
-            tracks = tracks["items"]
-            i = 1
+                metrics.count("spotify_playlist_cache_misses")
 
-            do_extend = len(tracks) == limit
+            fields = "total,items(track(album(name,release_date),artists,id,name,track_number,external_ids))"
 
-            # Get all tracks from the playlist
-            while do_extend:
-                buffer = self.request(
-                    self.sp.playlist_tracks,
-                    playlist_id,
-                    limit=limit,
-                    offset=limit * i,
-                    fields=fields,
-                )["items"]
+            def convert(items):
+                track_list = []
 
-                tracks.extend(buffer)
-                do_extend = len(buffer) == limit
+                for track in [item["track"] for item in items]:
+                    try:
+                        track_list.append(s.spotify_to_songs_dict(track))
+                    except TypeError:
+                        log.error(
+                            f"Could not convert track {(track or {}).get('id')} to ultrasonics format."
+                        )
+                        continue
 
-                i += 1
+                return track_list
 
-            track_list = []
+            log.info(f"Fetching tracks in {playlist_id}.")
 
-            # Convert from Spotify API format to ultrasonics format
-            log.info("Converting tracks to ultrasonics format.")
-            for track in tqdm(
-                [track["track"] for track in tracks],
-                desc=f"Converting tracks in {playlist_id}",
-            ):
-                try:
-                    track_list.append(s.spotify_to_songs_dict(track))
-                except TypeError:
-                    log.error(
-                        f"Could not convert track {track['id']} to ultrasonics format."
-                    )
-                    continue
+            tracks = self.request_pages(
+                self.sp.playlist_tracks, playlist_id, limit=100, convert=convert, fields=fields
+            )
 
-            return track_list
+            if snapshot_id:
+                db.playlist_cache_set(playlist_id, snapshot_id, tracks)
+
+            return tracks
 
         def user_playlist_remove_all_occurrences_of_tracks(self, playlist_id, tracks):
             """
@@ -461,7 +460,7 @@ def run(settings_dict, **kwargs):
     class Database:
         """
         Class for interactions with the up_spotify database.
-        Currently used for storing info about saved songs.
+        Used for storing info about saved songs, and caching the tracks of each playlist by its snapshot_id.
         """
 
         def __init__(self):
@@ -481,6 +480,36 @@ def run(settings_dict, **kwargs):
                 query = "CREATE TABLE IF NOT EXISTS lastrun (applet_id TEXT PRIMARY KEY, time INTEGER)"
                 cursor.execute(query)
 
+                # Create playlist cache table if needed, holding only the latest snapshot of each playlist
+                query = "CREATE TABLE IF NOT EXISTS playlist_cache (playlist_id TEXT PRIMARY KEY, snapshot_id TEXT, tracks TEXT)"
+                cursor.execute(query)
+
+                conn.commit()
+
+        def playlist_cache_get(self, playlist_id, snapshot_id):
+            """
+            Gets the cached tracks of a playlist, or None if the playlist has changed since they were cached.
+            """
+            with sqlite3.connect(self.saved_songs_db) as conn:
+                cursor = conn.cursor()
+
+                query = "SELECT tracks FROM playlist_cache WHERE playlist_id = ? AND snapshot_id = ?"
+                cursor.execute(query, (playlist_id, snapshot_id))
+
+                rows = cursor.fetchone()
+
+                return None if not rows else json.loads(rows[0])
+
+        def playlist_cache_set(self, playlist_id, snapshot_id, tracks):
+            """
+            Caches the tracks of a playlist at the given snapshot, replacing any earlier snapshot.
+            """
+            with sqlite3.connect(self.saved_songs_db) as conn:
+                cursor = conn.cursor()
+
+                query = "REPLACE INTO playlist_cache (playlist_id, snapshot_id, tracks) VALUES (?, ?, ?)"
+                cursor.execute(query, (playlist_id, snapshot_id, json.dumps(tracks)))
+
                 conn.commit()
 
         def lastrun_get(self):
@@ -543,7 +572,7 @@ def run(settings_dict, **kwargs):
     auth = json.loads(database["auth"])
     s.refresh_token = auth["refresh_token"]
 
-    s.sp = spotipy.Spotify(auth=s.token_get(), requests_timeout=60)
+    s.client()
 
     if component == "inputs":
         if settings_dict["mode"] == "playlists":
@@ -553,11 +582,14 @@ def run(settings_dict, **kwargs):
             playlists = s.current_user_playlists()
 
             songs_dict = []
+            snapshots = {}
 
             for playlist in playlists:
                 if not isinstance(playlist, dict) or playlist.get("name") is None or playlist.get("id") is None:
                     continue
 
+                snapshots[playlist["id"]] = playlist.get("snapshot_id")
+
                 item = {"name": playlist["name"], "id": {"spotify": playlist["id"]}}
 
                 songs_dict.append(item)
@@ -568,7 +600,8 @@ def run(settings_dict, **kwargs):
             # 3. Fetch songs from each playlist, build songs_dict
             log.info("Building songs_dict for playlists...")
             for i, playlist in tqdm(enumerate(songs_dict)):
-                tracks = s.playlist_tracks(playlist["id"]["spotify"])
+                playlist_id = playlist["id"]["spotify"]
+                tracks = s.playlist_tracks(playlist_id, snapshots.get(playlist_id))
 
                 songs_dict[i]["songs"] = tracks
 
@@ -641,9 +674,15 @@ def run(settings_dict, **kwargs):
         # Get a list of current user playlists
         current_playlists = s.current_user_playlists()
 
+        fuzzy_ratio = float(database.get("fuzzy_ratio") or 90)
+
+        # Playlists written to during this run, whose snapshot_id in `current_playlists` is out of date
+        updated_playlists = set()
+
         for playlist in songs_dict:
             # Check the playlist already exists in Spotify
             playlist_id = ""
+            existing_tracks = None
             try:
                 if playlist["id"]["spotify"] in [
                     item["id"] for item in current_playlists
@@ -682,48 +721,81 @@ def run(settings_dict, **kwargs):
                 existing_uris = []
 
             # Get all tracks already in the playlist
-            if "existing_tracks" not in vars():
-                existing_tracks = s.playlist_tracks(playlist_id)
+            if existing_tracks is None:
+                snapshot_id = None
+                if playlist_id not in updated_playlists:
+                    snapshot_id = next(
+                        (item.get("snapshot_id") for item in current_playlists if item["id"] == playlist_id), None
+                    )
+
+                existing_tracks = s.playlist_tracks(playlist_id, snapshot_id)
                 existing_uris = [
                     f"spotify:track:{item['id']['spotify']}" for item in existing_tracks
                 ]
 
+                # Playlist is already synced, so only songs changed since the last run need checking
+                diff = playlist.get("diff")
+            else:
+                diff = None
+
+            songs = playlist["songs"] if diff is None else diff["added"]
+            existing_index = fuzzymatch.SongIndex(existing_tracks)
+
             # Add songs which don't already exist in the playlist
             uris = []
             duplicate_uris = []
 
-            log.info("Searching for matching songs in Spotify.")
-            for song in tqdm(
-                playlist["songs"],
-                desc=f"Searching Spotify for songs from {playlist['name']}",
-            ):
-                # First check for fuzzy duplicate without Spotify api search
-                duplicate = False
-                for item in existing_tracks:
-                    score = fuzzymatch.similarity(song, item)
-
-                    if score > float(database.get("fuzzy_ratio") or 90):
-                        # Duplicate was found
-                        duplicate_uris.append(f"spotify:track:{item['id']['spotify']}")
-                        duplicate = True
-                        break
+            # First check for fuzzy duplicates without Spotify api search
+            existing_matches = existing_index.match_many(songs, fuzzy_ratio)
+
+            log.info(f"Searching Spotify for songs from {playlist['name']}.")
+            results = iter(s.search_many(
+                [song for song, item in zip(songs, existing_matches) if item is None]
+            ))
 
-                if duplicate:
+            for song, item in zip(songs, existing_matches):
+                if item is not None:
+                    # Duplicate was found
+                    duplicate_uris.append(f"spotify:track:{item['id']['spotify']}")
                     continue
 
-                uri, confidence = s.search(song)
+                uri, confidence = next(results)
 
                 if uri in existing_uris:
                     duplicate_uris.append(uri)
 
-                if confidence > float(database.get("fuzzy_ratio") or 90):
+                if confidence > fuzzy_ratio:
                     uris.append(uri)
                 else:
                     log.debug(
                         f"Could not find song {song['title']} in Spotify; will not add to playlist."
                     )
 
-            if settings_dict["existing_playlists"] == "Update":
+            if settings_dict["existing_playlists"] == "Update" and diff is not None:
+                # Only remove songs which were removed since the last run
+                remove_uris = []
+
+                removed_matches = existing_index.match_many(diff["removed"], fuzzy_ratio)
+                results = iter(s.search_many(
+                    [song for song, item in zip(diff["removed"], removed_matches) if item is None]
+                ))
+
+                for song, item in zip(diff["removed"], removed_matches):
+                    if item is not None:
+                        uri = f"spotify:track:{item['id']['spotify']}"
+                    else:
+                        uri, confidence = next(results)
+                        if confidence <= fuzzy_ratio:
+                            continue
+
+                    if uri in existing_uris and uri not in uris + duplicate_uris:
+                        remove_uris.append(uri)
+
+                s.user_playlist_remove_all_occurrences_of_tracks(
+                    playlist_id, remove_uris
+                )
+
+            elif settings_dict["existing_playlists"] == "Update":
                 # Remove any songs which aren't in `uris` from the playlist
                 remove_uris = [
                     uri for uri in existing_uris if uri not in uris + duplicate_uris
@@ -733,6 +805,8 @@ def run(settings_dict, **kwargs):
                     playlist_id, remove_uris
                 )
 
+            updated_playlists.add(playlist_id)
+
             # Add tracks to playlist in batches of 100
             while len(uris) > 100:
                 s.request(
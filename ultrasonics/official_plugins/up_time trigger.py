@@ -3,7 +3,10 @@
 up_time trigger
 
 Official trigger plugin. 
-Runs the created applet on the specified interval times starting at the specified date and time.
+Runs the created applet on the specified interval times starting at the specified date and time,
+or on a cron-style schedule such as `0 6 * * 1-5`.
+The scheduler asks `next_fire` when the applet is next due, so idle applets don't hold a thread.
+Runs missed while ultrasonics was stopped are either coalesced into a single run on startup, or skipped.
 
 AspanishDude, 2020
 """
@@ -14,7 +17,7 @@ import math
 import os
 import sqlite3
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from app import _ultrasonics
 from ultrasonics import logs
@@ -31,71 +34,160 @@ handshake = {
         "playlists",
         "songs"
     ],
-    "version": "0.2",
+    "version": "0.4",
+    "trigger": "time",
     "settings": []
 }
 
 
-def run(settings_dict, **kwargs):
+class Runtime:
     """
-    Creates a json file containing the date of creation of the applet / last run of the applet
-    and takes the interval time given by the user to calculate the sleep time which will
-    keep the program on hold until the next applet run.
+    Contains anything related to storage of runtimes.
     """
-    database = kwargs["database"]
-    applet_id = kwargs["applet_id"]
 
-    class Runtime:
+    def __init__(self, applet_id):
         """
-        Contains anything related to storage of runtimes.
+        Create cache file if needed.
         """
-
-        db_file = os.path.join(
+        self.applet_id = applet_id
+        self.db_file = os.path.join(
             _ultrasonics["config_dir"], "up_time trigger", "date_dict.db")
 
-        def __init__(self):
-            """
-            Create cache file if needed, load values from the file.
-            """
-            try:
-                os.mkdir(os.path.dirname(self.db_file))
-            except FileExistsError:
-                pass
+        try:
+            os.mkdir(os.path.dirname(self.db_file))
+        except FileExistsError:
+            pass
+
+        with sqlite3.connect(self.db_file) as conn:
+            cursor = conn.cursor()
+
+            # Create applet table if needed
+            query = "CREATE TABLE IF NOT EXISTS runtimes (applet_id TEXT PRIMARY KEY, lastrun REAL)"
+            cursor.execute(query)
+
+            conn.commit()
+
+    def lastrun(self):
+        """
+        Fetch the last sync date for this applet, or None if it has never run.
+        """
+        with sqlite3.connect(self.db_file) as conn:
+            cursor = conn.cursor()
+
+            query = "SELECT lastrun FROM runtimes WHERE applet_id = ?"
+            cursor.execute(query, (self.applet_id,))
+
+            rows = cursor.fetchone()
+
+        return None if rows is None else rows[0]
+
+    def update_runtime(self, last_sync_date):
+        """
+        Save the given time as the latest runtime for this applet.
+        """
+        with sqlite3.connect(self.db_file) as conn:
+            cursor = conn.cursor()
+
+            query = "REPLACE INTO runtimes (applet_id, lastrun) VALUES (?,?)"
+            cursor.execute(query, (self.applet_id, last_sync_date))
 
-            with sqlite3.connect(self.db_file) as conn:
-                cursor = conn.cursor()
+            conn.commit()
 
-                # Create applet table if needed
-                query = "CREATE TABLE IF NOT EXISTS runtimes (applet_id TEXT PRIMARY KEY, lastrun REAL)"
-                cursor.execute(query)
+        return last_sync_date
 
-                conn.commit()
 
-        def update_runtime(self, firstrun=False):
-            """
-            Save the current time to the latest runtime for this applet.
-            """
-            if firstrun:
-                last_sync_date = start_timestamp_seconds - interval
+class Cron:
+    """
+    Five field cron expression: minute, hour, day of month, month, day of week.
+    Each field can be `*`, a number, a range `a-b`, a step `*/n` or `a-b/n`, or a comma separated list of these.
+    As with cron, if both day fields are restricted, a day matching either is used.
+    A day field starting with `*`, such as `*/2`, counts as unrestricted.
+    """
+
+    # (minimum, maximum) for each field
+    bounds = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression):
+        fields = expression.split()
+
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression must have 5 fields: {expression}")
+
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self.parse(field, *bounds) for field, bounds in zip(fields, self.bounds)]
+
+        # Both 0 and 7 are Sunday
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+
+    @staticmethod
+    def parse(field, minimum, maximum):
+        values = set()
 
+        for part in field.split(","):
+            part, _, step = part.partition("/")
+            step = int(step) if step else 1
+
+            if part == "*":
+                low, high = minimum, maximum
+            elif "-" in part:
+                low, high = [int(value) for value in part.split("-", 1)]
             else:
-                # Take the current time in seconds
-                last_sync_date = (datetime.utcnow() -
-                                datetime(1970, 1, 1)).total_seconds()
+                low = high = int(part)
+
+                # A single value with a step means every step from that value
+                if step > 1:
+                    high = maximum
+
+            if not minimum <= low <= high <= maximum or step < 1:
+                raise ValueError(f"Invalid cron field: {field}")
+
+            values.update(range(low, high + 1, step))
 
-            with sqlite3.connect(self.db_file) as conn:
-                cursor = conn.cursor()
+        return values
 
-                # Create applet table if needed
-                query = "REPLACE INTO runtimes (applet_id, lastrun) VALUES (?,?)"
-                cursor.execute(query, (applet_id, last_sync_date))
+    def day_matches(self, date):
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+    def next(self, after):
+        """
+        The first matching time strictly after the `after` datetime.
+        """
+        date = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+
+        # Four years covers every valid day and month combination
+        limit = date + timedelta(days=4 * 366)
+
+        while date < limit:
+            if date.month not in self.months:
+                date = (date.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return date
 
-                conn.commit()
+        raise ValueError("Cron expression never matches")
 
-            return last_sync_date
 
-    rt = Runtime()
+def schedule(settings_dict):
+    """
+    Read the run interval and first run time from the applet settings.
 
+    @return: interval in seconds, first run timestamp in seconds (or None if not set)
+    """
     interval_multiplier = float(settings_dict["interval_input"])
     interval_selection = settings_dict["update_frequency"]
 
@@ -109,7 +201,8 @@ def run(settings_dict, **kwargs):
     # Get the interval in seconds
     interval = interval_options[interval_selection] * interval_multiplier
 
-    current_time = (datetime.utcnow() - datetime(1970, 1, 1)).total_seconds()
+    if interval <= 0:
+        raise ValueError("Run interval must be greater than 0")
 
     # Create a timestamp object from the input date string in the settings dict
     try:
@@ -119,40 +212,79 @@ def run(settings_dict, **kwargs):
         # Convert the datetime object to seconds
         start_timestamp_seconds = datetime.timestamp(start_timestamp)
 
-    except ValueError:
-        # If no value is added then default is start right now
-        start_timestamp_seconds = current_time
+    except (KeyError, ValueError):
+        # If no value is added then the schedule starts from the last run
+        start_timestamp_seconds = None
+
+    return interval, start_timestamp_seconds
+
+
+def scheduled_after(settings_dict, after):
+    """
+    The first scheduled run time strictly after the `after` timestamp, or the first ever run time if `after` is None.
+    Interval schedules are aligned to the first run time if given, so they don't drift with how long each run takes.
+    """
+    cron = settings_dict.get("cron", "").strip()
 
-    # Fetch the last sync date from the date_dict
-    with sqlite3.connect(rt.db_file) as conn:
-        cursor = conn.cursor()
+    if cron:
+        after = time.time() if after is None else after
+        return Cron(cron).next(datetime.fromtimestamp(after)).timestamp()
 
-        # Create applet table if needed
-        query = "SELECT lastrun FROM runtimes WHERE applet_id = ?"
-        cursor.execute(query, (applet_id,))
+    interval, start_timestamp_seconds = schedule(settings_dict)
 
-        rows = cursor.fetchone()
+    if start_timestamp_seconds is None:
+        # Run straight away the first time, then every interval after the last run
+        return time.time() if after is None else after + interval
+
+    if after is None or after < start_timestamp_seconds:
+        return start_timestamp_seconds
+
+    return start_timestamp_seconds + (math.floor((after - start_timestamp_seconds) / interval) + 1) * interval
+
+
+def next_fire(settings_dict, now=None, **kwargs):
+    """
+    Called by the scheduler to find when the applet should next run, so nothing needs to wait in `run`.
+
+    If the applet was due while ultrasonics was stopped, all missed runs are coalesced into one run now,
+    or skipped if the "catch_up" setting is "Skip".
+
+    @return: unix timestamp of the next run
+    """
+    now = time.time() if now is None else now
+    due = scheduled_after(settings_dict, Runtime(kwargs["applet_id"]).lastrun())
 
-        if rows is None:
-            last_sync_date = rt.update_runtime(firstrun=True)
+    if due < now:
+        if settings_dict.get("catch_up") == "Skip":
+            due = scheduled_after(settings_dict, now)
         else:
-            last_sync_date = rows[0]   
+            log.info(f"Applet {kwargs['applet_id']} missed a run, it will run now")
+            due = now
 
-    if (last_sync_date + interval - current_time) < 0:
-        # Applet is overdue
-        sleep_time = 0
+    return due
 
-    else:
-        # Still time before next run
-        sleep_time = last_sync_date + interval - current_time
 
-    log.info(f"Applet {applet_id} will run in {int(sleep_time)} seconds...")
+def validate(settings_dict, **kwargs):
+    """
+    Called when the applet is saved, so an unusable schedule is rejected then rather than when it is next due.
+    Raises ValueError for an invalid cron expression or run interval.
+    """
+    try:
+        scheduled_after(settings_dict, time.time())
+    except KeyError as e:
+        raise ValueError(f"Missing schedule setting: {e}")
 
-    # Wait until next run time
-    time.sleep(sleep_time)
 
-    # Update the date stored in the json file and set it to the current date (only happens if program not interrupted)
-    rt.update_runtime()
+def run(settings_dict, **kwargs):
+    """
+    Records this run of the applet. The scheduler only calls this once `next_fire` is due, so it never waits.
+    """
+    database = kwargs["database"]
+    applet_id = kwargs["applet_id"]
+
+    Runtime(applet_id).update_runtime(time.time())
+
+    log.info(f"Applet {applet_id} triggered")
 
 
 def builder(**kwargs):
@@ -179,7 +311,7 @@ def builder(**kwargs):
             <div class="field has-addons">
                 <div class="control">
                     <input class="input" type="text" name="interval_input" placeholder="10" min="0"
-                        pattern="\d{1,10}\.*\d{0,4}" required>
+                        pattern="\d{1,10}\.*\d{0,4}">
                 </div>
                 <div class="control">
                     <div class="select">
@@ -271,7 +403,27 @@ def builder(**kwargs):
             }
 
         </script>
-        """
+        """,
+        {
+            "type": "string",
+            "value": "Alternatively, use a cron expression for more precise schedules, such as '0 6 * * 1-5' for 6am on weekdays. If set, the run interval is ignored."
+        },
+        {
+            "type": "text",
+            "label": "Cron Expression",
+            "name": "cron",
+            "value": ""
+        },
+        {
+            "type": "radio",
+            "label": "Missed Runs",
+            "name": "catch_up",
+            "id": "catch_up",
+            "options": [
+                "Run Once",
+                "Skip"
+            ]
+        }
     ]
 
     return settings_dict
@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request
+"""
+up_webhook
+
+Official trigger plugin. Runs the applet when a http request is made to its webhook url.
+All webhooks are served by the main ultrasonics server at /hooks/<applet_id>/<path>, see `webapp.routes.hooks`,
+which pushes runs straight to the scheduler; this plugin only holds the settings.
+"""
 
 from ultrasonics import logs
 
@@ -8,7 +14,7 @@ log = logs.create_log(__name__)
 
 handshake = {
     "name": "webhook",
-    "description": "trigger the applet with a http 'get' request.",
+    "description": "trigger the applet with a http 'get' or 'post' request.",
     "type": [
         "triggers"
     ],
@@ -16,42 +22,20 @@ handshake = {
         "playlists",
         "songs"
     ],
-    "version": "0.1",
+    "version": "0.2",
+    "trigger": "event",
     "settings": []
 }
 
 
 def run(settings_dict, **kwargs):
     """
-    Creates a simple flask webserver which just waits for a single request before exiting.
+    Webhook triggers are event based, so the scheduler never waits on this function.
     """
-
-    database = kwargs["database"]
-    global_settings = kwargs["global_settings"]
-    component = kwargs["component"]
     applet_id = kwargs["applet_id"]
-    songs_dict = kwargs["songs_dict"]
-
-    if not settings_dict['path'].startswith("/"):
-        settings_dict['path'] = "/" + settings_dict['path']
-
-    url = "http://0.0.0.0:" + settings_dict['port'] + settings_dict['path']
-
-    log.info(f"Creating webserver trigger for applet: {applet_id}")
-    log.info(f"The endpoint will be accessible at: {url}")
-
-    app = Flask(applet_id)
 
-    @app.route(settings_dict["path"])
-    def endpoint():
-        func = request.environ.get('werkzeug.server.shutdown')
-        if func is None:
-            raise RuntimeError('Not running with the Werkzeug Server')
-        func()
-        log.info(f"Applet triggered: {applet_id}")
-        return f"Applet triggered: {applet_id}"
-
-    app.run(host="0.0.0.0", port=int(settings_dict["port"]))
+    path = settings_dict.get("path", "").strip("/")
+    log.info(f"The webhook for applet {applet_id} is accessible at: /hooks/{applet_id}/{path}")
 
 
 def builder(**kwargs):
@@ -62,25 +46,28 @@ def builder(**kwargs):
     settings_dict = [
         {
             "type": "string",
-            "value": "This plugin works by spinning up a small webserver, which waits for a single GET request at the specified hostname and port. ☁️"
+            "value": "This plugin runs the applet when a GET or POST request is made to /hooks/<applet_id>/<path> on the ultrasonics server. ☁️"
         },
         {
             "type": "string",
-            "value": "You should make sure whatever is performing this web request has access to the url. You can define a port and root path below, the port cannot be the same as ultrasonics (8080) or any other instance of the webhook trigger."
+            "value": "You should make sure whatever is performing this web request has access to ultrasonics. Requests which arrive while the applet is already running will run it once more afterwards."
         },
         {
             "type": "text",
-            "label": "Port",
-            "name": "port",
-            "value": "5001",
+            "label": "Path",
+            "name": "path",
+            "value": "/",
             "required": True
         },
+        {
+            "type": "string",
+            "value": "If requests come in bursts, the applet can wait until no more have arrived for a number of seconds, and then run once."
+        },
         {
             "type": "text",
-            "label": "Root Path",
-            "name": "path",
-            "value": "/",
-            "required": True
+            "label": "Debounce (s)",
+            "name": "debounce",
+            "value": "0"
         },
     ]
 
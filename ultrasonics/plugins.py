@@ -8,14 +8,23 @@ Original work by XDGFX, 2020
 Updated and modernized by McLain Cronin, 2025
 """
 
+import asyncio
+import contextlib
+import contextvars
+import copy
 import importlib
+import inspect
 import json
 import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from itertools import chain
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, AsyncIterator, Callable, Optional, List
 
-from ultrasonics import database, logs, scheduler
+from ultrasonics import database, logs, metrics, scheduler, snapshots
+from ultrasonics.config import Config
 
 log = logs.create_log(__name__)
 
@@ -23,6 +32,18 @@ log = logs.create_log(__name__)
 found_plugins = {}
 handshakes = []
 
+# Plugins are synchronous, so are run in executors to keep the event loop free.
+# Plugins can opt in to the process pool with "executor": "process" in their handshake,
+# and limit how many instances run at once with "concurrency": n.
+thread_executor = ThreadPoolExecutor(
+    max_workers=Config.PLUGIN_WORKERS, thread_name_prefix="plugin")
+process_executor = None
+
+# Triggers spend most of their time waiting, so get their own pool to avoid starving other plugins
+trigger_executor = ThreadPoolExecutor(
+    max_workers=Config.TRIGGER_WORKERS, thread_name_prefix="trigger")
+plugin_semaphores = {}
+
 # Prefix for all plugins in plugins folder, up stands for ultrasonics plugin ;)
 prefix = "up_"
 
@@ -30,6 +51,8 @@ prefix = "up_"
 dba = database.Applet()
 dbc = database.Core()
 dbp = database.Plugin()
+dbr = database.Run()
+dbs = database.Snapshot()
 
 # Possible plugin locations
 paths = ("./plugins", "./ultrasonics/official_plugins")
@@ -94,6 +117,73 @@ async def plugin_gather():
                     log.info(f"Created new database entry for plugin {title} v{handshake_version}")
 
 
+def _plugin_call(module_name: str, function: str, *args, **kwargs) -> Any:
+    """
+    Call a function from a plugin module. Used as the executor target, so it can be pickled for the process pool.
+    """
+    return getattr(importlib.import_module(module_name), function)(*args, **kwargs)
+
+
+def _plugin_drain(module_name: str, emit: Callable[[Any], None], *args, **kwargs) -> Any:
+    """
+    Call a plugin's `stream` function, passing everything it yields to `emit`. Used as the executor target for streaming.
+    """
+    response = importlib.import_module(module_name).stream(*args, **kwargs)
+
+    if inspect.isgenerator(response):
+        for item in response:
+            emit(item)
+
+        return None
+
+    return response
+
+
+def plugin_semaphore(name: str) -> Any:
+    """
+    Async context manager limiting how many instances of a plugin run at once, from its handshake "concurrency".
+    """
+    concurrency = found_plugins[name].handshake.get("concurrency")
+    if not concurrency:
+        return contextlib.nullcontext()
+
+    if name not in plugin_semaphores:
+        plugin_semaphores[name] = asyncio.Semaphore(int(concurrency))
+
+    return plugin_semaphores[name]
+
+
+async def plugin_execute(name: str, function: str, *args, **kwargs) -> Any:
+    """
+    Run a synchronous plugin function in an executor, respecting the plugin's handshake executor and concurrency settings.
+    Only `run` is sent to the process pool; builders and tests always use threads.
+
+    OUTPUTS
+    response:        the plugin function response
+    measurements:    cpu time, counters, and api calls recorded while the function ran, from `metrics.measure`
+    """
+    global process_executor
+
+    plugin = found_plugins[name]
+    executor = thread_executor
+
+    if function == "run" and "triggers" in plugin.handshake["type"]:
+        executor = trigger_executor
+
+    elif function == "run" and plugin.handshake.get("executor") == "process":
+        if process_executor is None:
+            process_executor = ProcessPoolExecutor(
+                max_workers=Config.PLUGIN_PROCESS_WORKERS)
+        executor = process_executor
+
+    call = partial(metrics.measure, _plugin_call,
+                   plugin.__name__, function, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+
+    async with plugin_semaphore(name):
+        return await loop.run_in_executor(executor, call)
+
+
 async def plugin_load(name: str, version: str) -> Optional[Dict[str, Any]]:
     """
     Load plugin persistent settings.
@@ -112,8 +202,8 @@ async def plugin_build(name: str, version: str, component: str, force: bool = Fa
     if not database and not force:
         return None
 
-    settings_dict = found_plugins[name].builder(
-        database=database, global_settings=global_settings, component=component)
+    settings_dict, _ = await plugin_execute(
+        name, "builder", database=database, global_settings=global_settings, component=component)
     return settings_dict
 
 
@@ -143,11 +233,237 @@ async def plugin_run(name: str, version: str, settings_dict: Dict[str, Any],
     plugin_settings = await dbp.get(name)
     global_settings = await dbc.load(raw=True)
 
-    response = found_plugins[name].run(
-        settings_dict, database=plugin_settings, global_settings=global_settings, 
-        component=component, applet_id=applet_id, songs_dict=songs_dict)
+    # Record this plugin as a stage of the current applet run, if there is one
+    stage = {
+        "plugin": name,
+        "component": component,
+        "songs_in": count_songs(songs_dict)
+    }
+    start = time.perf_counter()
+
+    try:
+        response, measurements = await plugin_execute(
+            name, "run", settings_dict, database=plugin_settings, global_settings=global_settings,
+            component=component, applet_id=applet_id, songs_dict=songs_dict)
+
+        stage.update(measurements)
+        if component in ["inputs", "modifiers"]:
+            stage["songs_out"] = count_songs(response)
+
+        return response
+
+    except Exception as e:
+        stage["error"] = repr(e)
+        raise
+
+    finally:
+        stage["wall"] = time.perf_counter() - start
+
+        stages = metrics.applet_run.get()
+        if stages is not None:
+            stages.append(stage)
+
+
+def count_songs(songs_dict: Optional[List[Dict[str, Any]]]) -> Optional[int]:
+    """
+    Count the songs in all playlists of a songs_dict.
+    """
+    try:
+        return sum(len(playlist.get("songs", [])) for playlist in songs_dict)
+    except (AttributeError, TypeError):
+        return None
+
+
+async def plugin_run_many(plugins: List[Dict[str, Any]], component: str, applet_id: str,
+                          songs_dict: Optional[List[Dict[str, Any]]] = None,
+                          songs_dicts: Optional[List[List[Dict[str, Any]]]] = None) -> List[Any]:
+    """
+    Run several applet plugins concurrently.
+    If songs_dict is supplied, each plugin receives its own copy so plugins can't affect each other.
+    If songs_dicts is supplied instead, each plugin receives a copy of its own songs_dict.
+    A failing plugin is logged, but does not stop the others.
+
+    OUTPUTS
+    responses:       the response from each plugin in order, or the exception it raised
+    """
+    if songs_dicts is None:
+        songs_dicts = [songs_dict] * len(plugins)
+
+    async def run(plugin, songs):
+        return await plugin_run(
+            plugin["plugin"], plugin["version"], plugin["data"], component=component, applet_id=applet_id,
+            songs_dict=None if songs is None else copy.deepcopy(songs))
+
+    responses = await asyncio.gather(*[run(plugin, songs) for plugin, songs in zip(plugins, songs_dicts)],
+                                     return_exceptions=True)
+
+    for plugin, response in zip(plugins, responses):
+        if isinstance(response, Exception):
+            log.error(f"Plugin {plugin['plugin']} failed in {component} of applet {applet_id}",
+                      exc_info=response)
+
+    return responses
+
+
+# Marks the end of a playlist stream
+_end = object()
+
+
+class _StreamError:
+    """
+    Carries an exception from the producer of a playlist stream to its consumer.
+    """
+
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+class _Receiver:
+    """
+    Async iterator over the playlists put in a queue, until `_end`.
+    Closing it takes and discards the rest of the stream, so the producer is never left blocked on a full queue.
+    """
+
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        if self.done:
+            raise StopAsyncIteration
+
+        item = await self.queue.get()
+
+        if item is _end:
+            self.done = True
+            raise StopAsyncIteration
+
+        if isinstance(item, _StreamError):
+            self.done = True
+            raise item.exception
+
+        return item
+
+    async def aclose(self) -> None:
+        with contextlib.suppress(Exception):
+            async for _ in self:
+                pass
+
+
+def plugin_streams(name: str) -> bool:
+    """
+    Whether a plugin supports the streaming protocol, with a `stream` function.
+    Plugins in the process pool can't be fed a stream, so always use `run`.
+    """
+    plugin = found_plugins[name]
+    return callable(getattr(plugin, "stream", None)) and plugin.handshake.get("executor") != "process"
+
+
+async def plugin_stream(name: str, version: str, settings_dict: Dict[str, Any], executor: ThreadPoolExecutor,
+                        component: Optional[str] = None, applet_id: Optional[str] = None,
+                        playlists: Optional[AsyncIterator[Dict[str, Any]]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run a specific plugin as a stream, yielding each playlist from its `stream` generator as soon as it is ready.
+
+    INPUTS
+    executor:        runs the plugin, which holds a thread for the whole stream, so needs a thread for every streaming stage
+    playlists:       for modifiers and outputs, an async iterator of playlists, given to the plugin as a normal iterator
+
+    Playlists are passed through a queue of Config.STREAM_BUFFER, so a slow consumer holds back the plugin instead of using memory.
+    """
+    log.debug(f"Streaming plugin {name} v{version}")
+    plugin_settings = await dbp.get(name)
+    global_settings = await dbc.load(raw=True)
+
+    loop = asyncio.get_running_loop()
+    receiver = _Receiver(asyncio.Queue(maxsize=Config.STREAM_BUFFER))
+
+    # Recorded in the same format as plugin_run
+    stage = {
+        "plugin": name,
+        "component": component,
+        "songs_in": None if playlists is None else 0
+    }
+    if component in ["inputs", "modifiers"]:
+        stage["songs_out"] = 0
+
+    def emit(item):
+        asyncio.run_coroutine_threadsafe(receiver.queue.put(item), loop).result()
+
+    async def upstream():
+        try:
+            return await playlists.__anext__()
+        except StopAsyncIteration:
+            return _end
+
+    # Upstream plugins record their stages in this applet run, so must run in its context rather than the thread's
+    context = contextvars.copy_context()
+
+    def pull():
+        while True:
+            playlist = context.run(asyncio.run_coroutine_threadsafe, upstream(), loop).result()
+            if playlist is _end:
+                return
+
+            stage["songs_in"] += count_songs([playlist]) or 0
+            yield playlist
+
+    kwargs = {
+        "database": plugin_settings,
+        "global_settings": global_settings,
+        "component": component,
+        "applet_id": applet_id
+    }
+    if playlists is not None:
+        kwargs["playlists"] = pull()
+
+    def target():
+        try:
+            response = metrics.measure(_plugin_drain, found_plugins[name].__name__, emit, settings_dict, **kwargs)
+        except Exception as e:
+            emit(_StreamError(e))
+            raise
+
+        emit(_end)
+        return response
+
+    start = time.perf_counter()
+
+    async with plugin_semaphore(name):
+        future = loop.run_in_executor(executor, target)
+
+        try:
+            async for playlist in receiver:
+                if "songs_out" in stage:
+                    stage["songs_out"] += count_songs([playlist]) or 0
+
+                yield playlist
+
+            _, measurements = await future
+            stage.update(measurements)
+
+        except Exception as e:
+            stage["error"] = repr(e)
+            raise
+
+        finally:
+            # If the stream was abandoned, let the plugin finish before closing the stream it was reading
+            await receiver.aclose()
+            with contextlib.suppress(Exception):
+                await future
+
+            if playlists is not None:
+                await playlists.aclose()
+
+            stage["wall"] = time.perf_counter() - start
+
+            stages = metrics.applet_run.get()
+            if stages is not None:
+                stages.append(stage)
 
-    return response
 
 
 async def plugin_test(name: str, version: str, database: Optional[Dict[str, Any]] = None, 
@@ -173,7 +489,7 @@ async def plugin_test(name: str, version: str, database: Optional[Dict[str, Any]
 
         try:
             global_settings = await dbc.load(raw=True)
-            found_plugins[name].test(database, global_settings=global_settings)
+            await plugin_execute(name, "test", database, global_settings=global_settings)
             logs_string = logs.stop_capture(logs_name)
             return {"response": True, "logs": logs_string}
 
@@ -213,33 +529,75 @@ async def applet_build(applet_plans: Dict[str, Any]) -> None:
     applet_id = applet_plans["applet_id"]
     applet_plans.pop("applet_id")
 
-    await dba.update(applet_id, applet_plans)
+    await applet_validate(applet_plans)
+
+    async with database.transaction():
+        if await dba.get(applet_id) is None:
+            await dba.new(applet_id, applet_plans)
+        else:
+            await dba.update(applet_id, applet_plans)
+
+            # Outputs may have changed, so the next run must be a full sync
+            await dbs.delete(applet_id)
+
     await scheduler.applet_submit(applet_id)
 
 
+async def applet_validate(applet_plans: Dict[str, Any]) -> None:
+    """
+    Check the settings of each plugin in an applet with the plugin's optional `validate` function.
+    Raises ValueError if any settings are invalid, so the applet isn't saved.
+    """
+    for component in ["inputs", "modifiers", "outputs", "triggers"]:
+        for plugin in applet_plans.get(component, []):
+            if hasattr(found_plugins.get(plugin["plugin"]), "validate"):
+                await plugin_execute(plugin["plugin"], "validate", plugin["data"], component=component)
+
+
 async def applet_delete(applet_id: str) -> None:
     """
     Remove an applet from the database.
     """
-    await dba.delete(applet_id)
+    async with database.transaction():
+        await dba.delete(applet_id)
+        await dbs.delete(applet_id)
+
+    scheduler.applet_remove(applet_id)
 
 
-async def applet_run(applet_id: str) -> None:
+async def applet_run(applet_id: str, full_sync: bool = False) -> None:
     """
     Run the requested applet in full.
+    Timings and counters for each plugin stage are saved to the run history.
+    Incremental outputs only receive changes since the last run, unless full_sync is set.
     """
     from datetime import datetime
     runtime = datetime.now()
+    start = time.perf_counter()
+
+    # Each plugin_run adds its stage record here
+    stages = []
+    token = metrics.applet_run.set(stages)
 
     log.info(f"Running applet: {applet_id}")
 
     try:
         applet_plans = await dba.get(applet_id)
 
+        # Run independent inputs and outputs at the same time
+        concurrent = applet_plans.get("concurrent")
+        if concurrent is None:
+            concurrent = Config.APPLET_CONCURRENT
+
+        plans = chain(applet_plans["inputs"], applet_plans["modifiers"], applet_plans["outputs"])
+
         if not applet_plans["inputs"] or not applet_plans["outputs"]:
             raise Exception(
                 f"An input or output plugin is missing for applet {applet_id} - will not run.")
 
+        elif any(plugin_streams(plugin["plugin"]) for plugin in plans):
+            await applet_stream(applet_id, applet_plans, concurrent, full_sync)
+
         else:
             songs_dict = []
 
@@ -252,9 +610,25 @@ async def applet_run(applet_id: str) -> None:
 
             "Inputs"
             # Get new songs from input, append to songs list
-            for plugin in applet_plans["inputs"]:
-                for item in await plugin_run(*get_info(plugin), component="inputs", applet_id=applet_id):
-                    songs_dict.append(item)
+            if concurrent:
+                responses = await plugin_run_many(
+                    applet_plans["inputs"], component="inputs", applet_id=applet_id)
+
+                failed = [plugin["plugin"] for plugin, response in zip(applet_plans["inputs"], responses)
+                          if isinstance(response, Exception)]
+
+                # Outputs could remove songs that only a failed input would have supplied
+                if failed:
+                    raise Exception(
+                        f"Input plugin(s) failed for applet {applet_id}: {', '.join(failed)} - outputs will not run.")
+
+                for response in responses:
+                    songs_dict.extend(response)
+
+            else:
+                for plugin in applet_plans["inputs"]:
+                    for item in await plugin_run(*get_info(plugin), component="inputs", applet_id=applet_id):
+                        songs_dict.append(item)
 
             "Modifiers"
             # Replace songs with output from modifier plugin
@@ -263,18 +637,55 @@ async def applet_run(applet_id: str) -> None:
                     *get_info(plugin), songs_dict=songs_dict, component="modifiers", applet_id=applet_id)
 
             "Outputs"
-            # Submit songs dict to output plugin
+            # Incremental outputs only receive the playlists which changed since the last snapshot
+            snapshot = await snapshot_load(applet_id, applet_plans["outputs"], full_sync)
+            outputs, songs_dicts = [], []
+
+            if snapshot is not None:
+                synced = {}
+                changes = snapshots.delta_many(songs_dict, snapshot, synced)
+
             for plugin in applet_plans["outputs"]:
-                await plugin_run(*get_info(plugin), component="outputs",
-                           applet_id=applet_id, songs_dict=songs_dict)
+                if snapshot is None or not plugin_incremental(plugin["plugin"]):
+                    songs_dicts.append(songs_dict)
+                elif changes:
+                    songs_dicts.append(changes)
+                else:
+                    log.info(f"No changes since the last run, skipping output {plugin['plugin']}")
+                    continue
+
+                outputs.append(plugin)
 
-            success = True
+            # Submit songs dict to output plugin
+            if concurrent:
+                responses = await plugin_run_many(
+                    outputs, component="outputs", applet_id=applet_id, songs_dicts=songs_dicts)
+
+                failed = [plugin["plugin"] for plugin, response in zip(outputs, responses)
+                          if isinstance(response, Exception)]
+
+                if failed:
+                    raise Exception(
+                        f"Output plugin(s) failed for applet {applet_id}: {', '.join(failed)}")
+
+            else:
+                for plugin, songs in zip(outputs, songs_dicts):
+                    await plugin_run(*get_info(plugin), component="outputs",
+                               applet_id=applet_id, songs_dict=songs)
+
+            if snapshot is not None:
+                await dbs.save(applet_id, snapshots.saved(synced))
+
+        success = True
 
     except Exception as e:
         log.error(e, exc_info=True)
 
         success = False
 
+    finally:
+        metrics.applet_run.reset(token)
+
     if success:
         log.info(
             f"Applet {applet_id} completed successfully in {datetime.now() - runtime}")
@@ -282,29 +693,206 @@ async def applet_run(applet_id: str) -> None:
         log.warning(
             f"Applet {applet_id} failed in {datetime.now() - runtime}")
 
-    lastrun = {
-        "time": runtime.strftime("%d-%m-%Y %H:%M"),
-        "result": success
-    }
+    # The latest run history entry also serves as the applet's last run
+    await dbr.add(applet_id, started_at=runtime, duration=time.perf_counter() - start,
+                  cpu=sum(stage.get("cpu", 0) for stage in stages), success=success, stats={"stages": stages})
+
+
+async def applet_stream(applet_id: str, applet_plans: Dict[str, Any], concurrent: bool, full_sync: bool = False) -> None:
+    """
+    Run an applet as a stream, used when any of its plugins support streaming.
+    Each playlist flows from the inputs, through the modifiers, to all outputs as soon as it is ready.
+    Plugins without a `stream` function are adapted: inputs yield the playlists they return,
+    and modifiers and outputs collect the full songs_dict before they run.
+    """
+    def info(plugin):
+        return plugin["plugin"], plugin["version"], plugin["data"]
 
-    await dba.lastrun(applet_id, lastrun)
+    async def stream_input(plugin):
+        if plugin_streams(plugin["plugin"]):
+            async for playlist in plugin_stream(*info(plugin), executor, component="inputs", applet_id=applet_id):
+                yield playlist
+        else:
+            for playlist in await plugin_run(*info(plugin), component="inputs", applet_id=applet_id):
+                yield playlist
+
+    async def stream_chain(plugins):
+        for plugin in plugins:
+            async for playlist in stream_input(plugin):
+                yield playlist
+
+    async def stream_merge(plugins):
+        # Playlists from all inputs, in the order they arrive
+        queue = asyncio.Queue(maxsize=Config.STREAM_BUFFER)
+        failed = []
+
+        async def pump(plugin):
+            try:
+                async for playlist in stream_input(plugin):
+                    await queue.put(playlist)
+            except Exception as e:
+                log.error(f"Plugin {plugin['plugin']} failed in inputs of applet {applet_id}", exc_info=e)
+                failed.append(plugin["plugin"])
+            finally:
+                await queue.put(_end)
+
+        pumps = [asyncio.create_task(pump(plugin)) for plugin in plugins]
+        remaining = len(pumps)
+
+        try:
+            while remaining:
+                playlist = await queue.get()
+                if playlist is _end:
+                    remaining -= 1
+                else:
+                    yield playlist
+        finally:
+            for task in pumps:
+                task.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+
+        # Outputs could remove songs that only a failed input would have supplied
+        if failed:
+            raise Exception(
+                f"Input plugin(s) failed for applet {applet_id}: {', '.join(failed)} - outputs will not complete.")
+
+    async def stream_modifier(plugin, playlists):
+        if plugin_streams(plugin["plugin"]):
+            async for playlist in plugin_stream(*info(plugin), executor, component="modifiers",
+                                                applet_id=applet_id, playlists=playlists):
+                yield playlist
+        else:
+            songs_dict = [playlist async for playlist in playlists]
+            for playlist in await plugin_run(*info(plugin), songs_dict=songs_dict, component="modifiers",
+                                             applet_id=applet_id):
+                yield playlist
+
+    async def stream_output(plugin, receiver):
+        if plugin_streams(plugin["plugin"]):
+            async for _ in plugin_stream(*info(plugin), executor, component="outputs",
+                                         applet_id=applet_id, playlists=receiver):
+                pass
+        else:
+            songs_dict = [playlist async for playlist in receiver]
+            await plugin_run(*info(plugin), component="outputs", applet_id=applet_id, songs_dict=songs_dict)
+
+    async def broadcast(playlists, receivers):
+        # Each output gets its own copy of every playlist, so outputs can't affect each other
+        item = _end
+
+        try:
+            async for playlist in playlists:
+                # Playlists which can't be told apart from an earlier one are sent in full
+                unique = snapshot is None or snapshots.record(synced, playlist)
+
+                for receiver, incremental in zip(receivers, incrementals):
+                    # Incremental outputs only receive playlists which changed since the last snapshot
+                    send = snapshots.delta(playlist, snapshot) if incremental and unique else playlist
+
+                    if send is not None:
+                        await receiver.queue.put(copy.deepcopy(send) if len(receivers) > 1 else send)
+
+        except Exception as e:
+            item = _StreamError(e)
+            raise
+
+        finally:
+            for receiver in receivers:
+                await receiver.queue.put(item)
+
+    # Every streaming plugin holds a thread for as long as its stream is open
+    workers = sum(plugin_streams(plugin["plugin"])
+                  for plugin in chain(applet_plans["inputs"], applet_plans["modifiers"], applet_plans["outputs"]))
+    snapshot = await snapshot_load(applet_id, applet_plans["outputs"], full_sync)
+    incrementals = [snapshot is not None and plugin_incremental(plugin["plugin"])
+                    for plugin in applet_plans["outputs"]]
+    synced = {}
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stream")
+
+    try:
+        playlists = (stream_merge if concurrent else stream_chain)(applet_plans["inputs"])
+
+        for plugin in applet_plans["modifiers"]:
+            playlists = stream_modifier(plugin, playlists)
+
+        receivers = [_Receiver(asyncio.Queue(maxsize=Config.STREAM_BUFFER)) for _ in applet_plans["outputs"]]
+        upstream, *responses = await asyncio.gather(
+            broadcast(playlists, receivers),
+            *[stream_output(plugin, receiver) for plugin, receiver in zip(applet_plans["outputs"], receivers)],
+            return_exceptions=True)
+
+    finally:
+        executor.shutdown(wait=False)
+
+    # Inputs or modifiers failed, so every output has failed with them
+    if isinstance(upstream, Exception):
+        raise upstream
+
+    failed = [plugin["plugin"] for plugin, response in zip(applet_plans["outputs"], responses)
+              if isinstance(response, Exception)]
+
+    for plugin, response in zip(applet_plans["outputs"], responses):
+        if isinstance(response, Exception):
+            log.error(f"Plugin {plugin['plugin']} failed in outputs of applet {applet_id}", exc_info=response)
 
+    if failed:
+        raise Exception(
+            f"Output plugin(s) failed for applet {applet_id}: {', '.join(failed)}")
 
-async def applet_trigger_run(applet_id: str) -> None:
+    if snapshot is not None:
+        await dbs.save(applet_id, snapshots.saved(synced))
+
+
+def plugin_incremental(name: str) -> bool:
     """
-    Run the trigger function from the requested applet.
+    Whether an output plugin can be sent only the changes since the last run, from its handshake "incremental".
     """
-    applet_plans = await dba.get(applet_id)
+    return bool(found_plugins[name].handshake.get("incremental"))
+
+
+async def snapshot_load(applet_id: str, outputs: List[Dict[str, Any]],
+                        full_sync: bool = False) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Load the snapshot of the last synced songs_dict, if any outputs are incremental.
+
+    OUTPUTS
+    snapshot:        None if no outputs are incremental, or empty for a full sync
+    """
+    if not any(plugin_incremental(plugin["plugin"]) for plugin in outputs):
+        return None
+
+    if full_sync:
+        log.info(f"Running a full sync of applet {applet_id}")
+        return {}
+
+    return await dbs.get(applet_id)
 
-    if not applet_plans["triggers"]:
-        log.error(
-            f"No trigger is supplied for applet {applet_id} - will not run automatically.")
-        raise Exception
 
-    # This needs to be fixed, currently both triggers must activate before the applet runs (AND not OR)
-    for trigger in applet_plans["triggers"]:
-        name = trigger["plugin"]
-        version = trigger["version"]
-        data = trigger["data"]
+def trigger_mode(name: str) -> str:
+    """
+    How the scheduler waits for a trigger plugin, from its handshake:
+    "time" plugins say when they next fire, "event" plugins have runs pushed to the scheduler,
+    and "blocking" plugins (the default) return from `run` when they trigger.
+    """
+    return found_plugins[name].handshake.get("trigger", "blocking")
+
+
+async def trigger_next_fire(name: str, version: str, settings_dict: Dict[str, Any],
+                            applet_id: str, now: Optional[float] = None) -> Optional[float]:
+    """
+    Ask a time based trigger plugin when it next fires.
+
+    INPUTS
+    now:             unix time to schedule from, defaults to the current time
+
+    OUTPUTS
+    timestamp:       unix time of the next fire, or None if it won't fire again
+    """
+    plugin_settings = await dbp.get(name)
+    global_settings = await dbc.load(raw=True)
 
-        await plugin_run(name, version, data, applet_id=applet_id)
+    timestamp, _ = await plugin_execute(
+        name, "next_fire", settings_dict, now=time.time() if now is None else now, database=plugin_settings,
+        global_settings=global_settings, component="triggers", applet_id=applet_id)
+    return timestamp
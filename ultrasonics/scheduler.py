@@ -4,75 +4,345 @@
 scheduler
 Handles scheduling and execution of applets.
 
+One scheduler task keeps a heap of timers, and a pool of workers takes applet runs from an event queue.
+When an applet is submitted, each of its triggers is registered according to the "trigger" key of its handshake:
+
+    time:       the plugin's `next_fire` function says when it is next due, which is added to the timer heap
+    event:      nothing waits; something else (e.g. a webhook) calls `push(applet_id)` to run the applet
+    blocking:   (default) the plugin's `run` function returns when it triggers, so it waits in the trigger executor
+
+Idle applets therefore cost nothing until a timer is due or an event arrives.
+
 Original work by XDGFX, 2020
 Updated and modernized by McLain Cronin, 2025
 """
 
 import asyncio
-from typing import Dict, Optional
-from datetime import datetime
+import heapq
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from ultrasonics import database, logs, plugins
+from ultrasonics.config import Config
 
 log = logs.create_log(__name__)
 
-# Each applet has its own key, where the value is True if applet should be running, or False if it needs to restart.
-applets_running: Dict[str, bool] = {}
+# Heap of (fire time, sequence, applet_id, token, trigger).
+# Trigger timers have trigger set, and are only valid while token matches `armed`.
+# Deferred runs have trigger None, and are only valid while token matches `generations`.
+timers: List[Tuple[float, int, str, int, Optional[Dict[str, Any]]]] = []
+sequence = itertools.count()
+
+# Applet runs waiting for a worker, and the event used to wake the scheduler when a timer is added
+events: Optional[asyncio.Queue] = None
+wakeup: Optional[asyncio.Event] = None
+loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Changes whenever an applet is resubmitted or removed, so older timers and triggers are ignored
+generations: Dict[str, int] = {}
+
+# Changes whenever an applet's timers are registered, so timers from before its last run are ignored
+armed: Dict[str, int] = {}
+
+# Blocking trigger tasks, by applet_id and trigger index
+blocking: Dict[Tuple[str, int], asyncio.Task] = {}
+
+# Applets waiting for a worker, running, triggered again while waiting or running, or deferred by the cooldown
+queued: Set[str] = set()
+running: Set[str] = set()
+pending: Set[str] = set()
+deferred: Set[str] = set()
+
+# Applets whose next run sends every playlist to incremental outputs in full
+full_syncs: Set[str] = set()
+
+# Once an applet has run, it cannot run again until the trigger_poll setting has passed
+finished: Dict[str, float] = {}
+cooldown = 0
+
+# Strong references to background tasks, which would otherwise be garbage collected
+tasks: Set[asyncio.Task] = set()
+
+# Applets whose triggers failed, waiting to be registered again, and the least seconds to wait before doing so
+retrying: Set[str] = set()
+retry_delay = 60
+
+
+def spawn(coroutine) -> asyncio.Task:
+    """
+    Start a background task, keeping a reference to it until it finishes.
+    """
+    task = asyncio.create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
 
 
 async def scheduler_start():
     """
-    Sets up task scheduling for all applets currently in the database.
+    Starts the scheduler and its workers, and submits all applets currently in the database.
     """
+    global events, wakeup, loop, cooldown
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    wakeup = asyncio.Event()
+    cooldown = await trigger_poll()
+
+    spawn(scheduler_loop())
+    for _ in range(Config.SCHEDULER_WORKERS):
+        spawn(scheduler_worker())
+
     applets = await plugins.applet_gather()
     for applet in applets:
-        applet_id = applet["applet_id"]
-        await applet_submit(applet_id)
+        await applet_submit(applet["applet_id"])
 
 
 async def applet_submit(applet_id: str):
     """
-    Submits an applet to the scheduler if it doesn't already exist.
+    Submits an applet to the scheduler, replacing its triggers if it was already submitted.
     """
-    if applet_id in applets_running:
-        # Signal that trigger should exit
-        applets_running[applet_id] = False
+    applet_remove(applet_id)
+    generations[applet_id] = next(sequence)
 
-        # Resubmit with a delay to allow the applet to exit
-        await asyncio.sleep(await trigger_poll())
-        asyncio.create_task(scheduler_applet_loop(applet_id))
-    else:
-        asyncio.create_task(scheduler_applet_loop(applet_id))
+    log.debug(f"Submitted applet '{applet_id}' to scheduler")
+    await applet_arm(applet_id)
 
 
-async def scheduler_applet_loop(applet_id: str):
+def applet_remove(applet_id: str):
     """
-    Creates the main applet scheduler run loop.
+    Removes an applet from the scheduler. Any of its timers or triggers which later fire are ignored.
     """
-    log.debug(f"Submitted applet '{applet_id}' to scheduler")
-    applets_running[applet_id] = True
+    generations.pop(applet_id, None)
+    armed.pop(applet_id, None)
+    full_syncs.discard(applet_id)
+
+    for key in [key for key in blocking if key[0] == applet_id]:
+        blocking.pop(key).cancel()
+
+
+async def applet_arm(applet_id: str):
+    """
+    Registers the triggers of a submitted applet: timers for time triggers, and a waiting task for blocking triggers.
+    """
+    generation = generations.get(applet_id)
+    if generation is None:
+        return
+
+    applet_plans = await database.Applet().get(applet_id)
+    if applet_plans is None:
+        # Applet no longer exists in the database
+        applet_remove(applet_id)
+        return
+
+    if not applet_plans.get("triggers"):
+        log.error(
+            f"No trigger is supplied for applet {applet_id} - will not run automatically.")
+        return
+
+    token = armed[applet_id] = next(sequence)
+
+    for index, trigger in enumerate(applet_plans["triggers"]):
+        mode = plugins.trigger_mode(trigger["plugin"])
+
+        if mode == "time":
+            try:
+                fire_time = await plugins.trigger_next_fire(
+                    trigger["plugin"], trigger["version"], trigger["data"], applet_id)
+            except ValueError as e:
+                # Invalid settings, e.g. a bad cron expression, won't fix themselves so aren't retried
+                log.error(f"Trigger {trigger['plugin']} of applet {applet_id} is misconfigured "
+                          f"and will not fire until the applet is saved again: {e}")
+                continue
+
+            except Exception as e:
+                log.error(f"Could not schedule trigger {trigger['plugin']} for applet {applet_id}")
+                log.error(e, exc_info=True)
+                trigger_retry(applet_id)
+                continue
+
+            if fire_time is not None:
+                timer_add(fire_time, applet_id, token, trigger)
+
+        elif mode == "blocking":
+            # Blocking triggers keep waiting between runs, so are only restarted once they have fired
+            key = (applet_id, index)
+            if key not in blocking or blocking[key].done():
+                blocking[key] = spawn(trigger_wait(applet_id, generation, trigger))
+
+
+def timer_add(fire_time: float, applet_id: str, token: int, trigger: Optional[Dict[str, Any]] = None):
+    """
+    Add a timer to the heap, waking the scheduler in case it is now the earliest.
+    """
+    heapq.heappush(timers, (fire_time, next(sequence), applet_id, token, trigger))
+    wakeup.set()
+
+
+async def scheduler_loop():
+    """
+    Sleeps until the earliest timer is due, or a new timer is added, then fires all due timers.
+    """
+    while True:
+        wakeup.clear()
+        timeout = max(0, timers[0][0] - time.time()) if timers else None
 
-    while applets_running[applet_id]:
         try:
-            # Run trigger
-            await plugins.applet_trigger_run(applet_id)
-            
-            # Check if applet still exists in the database
-            applet_data = await database.Applet().get(applet_id)
-            if applet_data is None:
-                break
-                
-            # Run applet
-            await plugins.applet_run(applet_id)
-            
-            # Wait for next trigger
-            await asyncio.sleep(await trigger_poll())
-            
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        now = time.time()
+
+        while timers and timers[0][0] <= now:
+            _, _, applet_id, token, trigger = heapq.heappop(timers)
+
+            if trigger is None:
+                deferred.discard(applet_id)
+                if token == generations.get(applet_id):
+                    enqueue(applet_id)
+
+            elif token == armed.get(applet_id):
+                spawn(trigger_fire(applet_id, trigger))
+
+
+async def trigger_fire(applet_id: str, trigger: Dict[str, Any]):
+    """
+    Run a time trigger which is due, so it can record the run, then queue the applet.
+    """
+    try:
+        await plugins.plugin_run(trigger["plugin"], trigger["version"], trigger["data"],
+                                 component="triggers", applet_id=applet_id)
+    except Exception as e:
+        log.error(e, exc_info=True)
+        trigger_retry(applet_id)
+        return
+
+    enqueue(applet_id)
+
+
+async def trigger_wait(applet_id: str, generation: int, trigger: Dict[str, Any]):
+    """
+    Wait for a blocking trigger to return, then queue the applet.
+    """
+    try:
+        await plugins.plugin_run(trigger["plugin"], trigger["version"], trigger["data"],
+                                 component="triggers", applet_id=applet_id)
+    except Exception as e:
+        log.error(e, exc_info=True)
+        trigger_retry(applet_id)
+        return
+
+    if generation == generations.get(applet_id):
+        enqueue(applet_id)
+
+
+def trigger_retry(applet_id: str):
+    """
+    Register an applet's triggers again once its cooldown has passed, after one of them failed.
+    Otherwise the failed trigger's timer or task is gone, and the applet would never run again until resubmitted.
+    """
+    if applet_id in retrying or applet_id not in generations:
+        return
+
+    retrying.add(applet_id)
+    spawn(trigger_rearm(applet_id, generations[applet_id], max(cooldown, retry_delay)))
+
+
+async def trigger_rearm(applet_id: str, generation: int, delay: float):
+    log.warning(f"A trigger of applet {applet_id} failed, registering its triggers again in {delay:.0f}s")
+    await asyncio.sleep(delay)
+    retrying.discard(applet_id)
+
+    # Resubmitted or removed applets were already registered again
+    if generation != generations.get(applet_id):
+        return
+
+    try:
+        await applet_arm(applet_id)
+    except Exception as e:
+        log.error(e, exc_info=True)
+        trigger_retry(applet_id)
+
+
+def push(applet_id: str, full_sync: bool = False):
+    """
+    Trigger a run of an applet, e.g. from an event trigger or the api. Safe to call from any thread.
+    With full_sync, incremental outputs receive every playlist in full on the next run.
+    """
+    if loop is None:
+        log.warning(f"Scheduler is not running, applet {applet_id} was not triggered")
+        return
+
+    loop.call_soon_threadsafe(enqueue, applet_id, full_sync)
+
+
+def enqueue(applet_id: str, full_sync: bool = False):
+    """
+    Queue an applet run for the workers.
+    An applet triggered while already queued or running runs once more afterwards,
+    and one triggered during its cooldown is deferred until the cooldown ends.
+    """
+    if applet_id not in generations:
+        return
+
+    if full_sync:
+        full_syncs.add(applet_id)
+
+    if applet_id in queued or applet_id in running:
+        pending.add(applet_id)
+        return
+
+    if applet_id in deferred:
+        return
+
+    ready = finished.get(applet_id, 0) + cooldown
+    if ready > time.time():
+        deferred.add(applet_id)
+        timer_add(ready, applet_id, generations[applet_id])
+        return
+
+    queued.add(applet_id)
+    events.put_nowait(applet_id)
+
+
+async def scheduler_worker():
+    """
+    Runs queued applets, then registers their triggers again.
+    """
+    global cooldown
+
+    while True:
+        applet_id = await events.get()
+        queued.discard(applet_id)
+        running.add(applet_id)
+
+        full_sync = applet_id in full_syncs
+        full_syncs.discard(applet_id)
+
+        try:
+            await plugins.applet_run(applet_id, full_sync=full_sync)
+
         except Exception as e:
-            # An error has occurred
             log.error(e, exc_info=True)
-            applets_running[applet_id] = False
-            break
+
+        finally:
+            running.discard(applet_id)
+            finished[applet_id] = time.time()
+            events.task_done()
+
+        try:
+            cooldown = await trigger_poll()
+            await applet_arm(applet_id)
+
+        except Exception as e:
+            log.error(e, exc_info=True)
+            trigger_retry(applet_id)
+
+        if applet_id in pending:
+            pending.discard(applet_id)
+            enqueue(applet_id)
 
 
 async def trigger_poll() -> int:
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+snapshots
+Incremental sync between applet runs.
+
+After each successful run, the songs_dict sent to an applet's outputs is saved as a snapshot, keyed by playlist.
+On the next run, outputs with "incremental": True in their handshake only receive the playlists which changed,
+each with a "diff" of the songs added, removed and moved since the snapshot. Unchanged playlists are left out.
+Playlists not in the snapshot are sent in full, without a "diff", so a full resync is just an empty snapshot.
+Playlists which can't be told apart from another in the same run are always sent in full, and left out of the snapshot.
+
+McLain Cronin, 2025
+"""
+
+import bisect
+import copy
+import hashlib
+import json
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set
+
+from ultrasonics import logs
+
+log = logs.create_log(__name__)
+
+
+def playlist_key(playlist: Dict[str, Any]) -> str:
+    """
+    Identifies a playlist between runs, by its input ID and name; a renamed playlist is a new playlist to outputs.
+    """
+    return json.dumps([playlist.get("id"), playlist.get("name")], sort_keys=True)
+
+
+def song_key(song: Dict[str, Any]) -> str:
+    """
+    Canonical form of a song. Any change to a song's fields makes it a different song.
+    """
+    return json.dumps(song, sort_keys=True, default=str)
+
+
+def content_hash(keys: List[str]) -> str:
+    """
+    Hash of a playlist's songs, in order.
+    """
+    return hashlib.sha1("\n".join(keys).encode()).hexdigest()
+
+
+def entry(playlist: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The snapshot entry saved for a playlist.
+    """
+    songs = playlist.get("songs", [])
+    return {"hash": content_hash([song_key(song) for song in songs]), "songs": songs}
+
+
+def record(synced: Dict[str, Any], playlist: Dict[str, Any]) -> bool:
+    """
+    Add a playlist to `synced`, the snapshot being built during a run.
+
+    @return: False if another playlist in this run has the same key. Its changes can't be tracked, so the key is
+             marked with None to be left out of the saved snapshot, and the playlist should be sent in full.
+    """
+    key = playlist_key(playlist)
+
+    if key in synced:
+        if synced[key] is not None:
+            log.warning(f"More than one playlist is named {playlist.get('name')} with the same id, "
+                        f"so they will always be sent to incremental outputs in full")
+
+        synced[key] = None
+        return False
+
+    synced[key] = entry(copy.deepcopy(playlist))
+    return True
+
+
+def saved(synced: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    The snapshot to save from `synced`, without the keys shared by more than one playlist.
+    """
+    return {key: value for key, value in synced.items() if value is not None}
+
+
+def unmoved(sequence: List[int]) -> Set[int]:
+    """
+    Indexes of a longest increasing subsequence of `sequence`, whose values must be distinct.
+    """
+    # Smallest last value of an increasing subsequence of each length so far, and its index
+    tail_values, tails = [], []
+    previous = [None] * len(sequence)
+
+    for index, value in enumerate(sequence):
+        length = bisect.bisect_left(tail_values, value)
+
+        if length:
+            previous[index] = tails[length - 1]
+
+        if length == len(tails):
+            tail_values.append(value)
+            tails.append(index)
+        else:
+            tail_values[length] = value
+            tails[length] = index
+
+    found = set()
+    index = tails[-1] if tails else None
+
+    while index is not None:
+        found.add(index)
+        index = previous[index]
+
+    return found
+
+
+def diff(old: List[Dict[str, Any]], new: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """
+    Compare two versions of a playlist's songs. Repeated songs are counted, so removing one of two copies is a removal.
+
+    @return: dict of
+        added:      songs in `new` but not `old`
+        removed:    songs in `old` but not `new`
+        moved:      {"song", "from", "to"} for songs in both which were moved, i.e. the fewest songs which
+                    could be moved to get from the old order to the new
+    """
+    old_keys = [song_key(song) for song in old]
+    new_keys = [song_key(song) for song in new]
+
+    old_counts, new_counts = Counter(old_keys), Counter(new_keys)
+    added_counts, removed_counts = new_counts - old_counts, old_counts - new_counts
+
+    def take(songs, keys, counts):
+        """Songs whose key is in `counts`, taking each key at most its count times."""
+        counts = counts.copy()
+        taken = []
+
+        for song, key in zip(songs, keys):
+            if counts[key] > 0:
+                counts[key] -= 1
+                taken.append(song)
+
+        return taken
+
+    # Songs in both versions, in their old and new order
+    kept = old_counts & new_counts
+    old_kept = take(range(len(old)), old_keys, kept)
+    new_kept = take(range(len(new)), new_keys, kept)
+
+    # Match each kept song's nth occurrence in the old order with its nth occurrence in the new order
+    occurrences = {}
+    for index in old_kept:
+        occurrences.setdefault(old_keys[index], []).append(index)
+
+    old_indexes = [occurrences[new_keys[index]].pop(0) for index in new_kept]
+
+    # Songs still in the same order relative to each other haven't moved; everything else has
+    stayed = unmoved(old_indexes)
+    moved = [{"song": new[index], "from": old_index, "to": index}
+             for position, (index, old_index) in enumerate(zip(new_kept, old_indexes)) if position not in stayed]
+
+    return {
+        "added": take(new, new_keys, added_counts),
+        "removed": take(old, old_keys, removed_counts),
+        "moved": moved
+    }
+
+
+def delta(playlist: Dict[str, Any], snapshot: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    The version of a playlist sent to incremental outputs.
+
+    @return: None if the playlist is unchanged since the snapshot, the playlist itself if it isn't in the snapshot,
+             or a copy of the playlist with a "diff" key.
+    """
+    previous = snapshot.get(playlist_key(playlist))
+    if previous is None:
+        return playlist
+
+    songs = playlist.get("songs", [])
+    if entry(playlist)["hash"] == previous["hash"]:
+        return None
+
+    return {**playlist, "diff": diff(previous["songs"], songs)}
+
+
+def delta_many(songs_dict: List[Dict[str, Any]], snapshot: Dict[str, Dict[str, Any]],
+               synced: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    The songs_dict sent to incremental outputs: only changed playlists, each with a "diff" where possible.
+    Each playlist is also recorded in `synced`.
+    """
+    changes = []
+
+    for playlist in songs_dict:
+        send = delta(playlist, snapshot) if record(synced, playlist) else playlist
+
+        if send is not None:
+            changes.append(send)
+
+    return changes
@@ -18,33 +18,139 @@ It goes without saying that inaccurate music tags (such as from local files) may
 XDGFX, 2020, updated 2025
 """
 
+import math
 import re
+from collections import namedtuple
+from functools import lru_cache
 
+import numpy as np
 from rapidfuzz import fuzz, process
 
-from ultrasonics import logs
+from ultrasonics import logs, metrics
 
 log = logs.create_log(__name__)
 
 # List of words and patterns to ignore when testing similarity
 cutoff_regex = [
-    r"\[(\[](feat|ft|featuring|original|prod).+?[)\]]",
+    r"[([](feat|ft|featuring|original|prod).+?[)\]]",
     r"[ (\- )\-]+(feat|ft|featuring|original|prod).+?(?=[(\n])"
 ]
 
+cutoff_patterns = [re.compile(pattern, flags=re.IGNORECASE)
+                   for pattern in cutoff_regex]
+
+# Number of normalised songs and strings to keep in memory
+cache_size = 65536
+
+# Maximum number of title scores held at once by SongIndex batch lookups
+matrix_cells = 2 ** 20
+
+# Relative importance of each fuzzy field
+weight = {
+    "isrc": 10,
+    "title": 8,
+    "artist": 8,
+    "album": 2,
+    "date": 1
+}
+
+# Fuzzy fields of a song after normalisation, where missing fields are None
+NormalizedSong = namedtuple(
+    "NormalizedSong", ["title", "album", "date", "artists"])
+
+
+@lru_cache(maxsize=cache_size)
+def clean(string):
+    """
+    Removes featured artists, producers etc. from a title or album string using `cutoff_regex`.
+    """
+    string = cutoff_patterns[0].sub("", string) + "\n"
+    return cutoff_patterns[1].sub(" ", string).strip()
+
+
+def normalize(song):
+    """
+    Returns the fuzzy fields of a song as a hashable `NormalizedSong`: title and album are cleaned, and
+    artists are joined into one lowercase string.
+    Results are cached by field content, so the same song seen again in another playlist or applet run is free.
+    """
+    artists = song.get("artists")
+
+    return _normalize(song.get("title"), song.get("album"), song.get("date"),
+                      None if artists is None else tuple(artists))
+
+
+@lru_cache(maxsize=cache_size)
+def _normalize(title, album, date, artists):
+    return NormalizedSong(
+        title=None if title is None else clean(title),
+        album=None if album is None else clean(album),
+        date=date,
+        artists=None if artists is None else " ".join(artists).lower()
+    )
+
+
+def _weighted(results):
+    """
+    Weighted average of all fuzzy scores in `results`, correcting for any missing fields.
+
+    @return: the total score, or None if there was nothing to compare.
+    """
+    corrector = sum([weight[key] for key in results.keys()])
+
+    if corrector == 0:
+        return None
+
+    total_score = sum([results[key] / 100 * weight[key]
+                       for key in results.keys()])
+
+    return total_score * 100 / corrector
+
+
+def _duplicate_score(a, b):
+    """
+    Fuzzy score used by `duplicate`, comparing two songs from `normalize`.
+    Not counted in metrics, so callers count their comparisons in bulk.
+    """
+    results = {}
+
+    # Name and album scores
+    if a.title is not None and b.title is not None:
+        results["title"] = fuzz.ratio(a.title, b.title)
+
+    if a.album is not None and b.album is not None:
+        results["album"] = fuzz.ratio(a.album, b.album)
+
+    # Date score
+    if a.date is not None and b.date is not None:
+        results["date"] = fuzz.token_set_ratio(a.date, b.date)
+
+    # Artist score can be a partial match; allowing missing artists
+    if a.artists is not None and b.artists is not None:
+        results["artist"] = fuzz.partial_token_sort_ratio(
+            a.artists, b.artists)
+
+    return _weighted(results)
+
+
+def _strip(value):
+    return str(value).strip()
+
 
 def duplicate(song, song_list, threshold):
     """
     Determines if `song` is present in `song_list`, with a supplied fuzziness threshold.
     Uses standard ultrasonics style song dictionaries.
+
+    When checking many songs against the same list, use `SongIndex` instead.
     """
     # Check exact location or isrc match
     for key in ["location", "isrc"]:
         if key in song.keys():
-            test_array = [item[key].strip()
+            test_array = [_strip(item[key])
                           for item in song_list if (key in item)]
 
-            if song[key].strip() in test_array:
+            if _strip(song[key]) in test_array:
                 return True
 
     # Check exact ID match
@@ -54,75 +160,213 @@ def duplicate(song, song_list, threshold):
 
             for item in song_list:
                 if "id" in item.keys() and key in item.get("id"):
-                    test_array.append(item["id"][key].strip())
+                    test_array.append(_strip(item["id"][key]))
 
-            if song["id"][key].strip() in test_array:
+            if _strip(song["id"][key]) in test_array:
                 return True
 
     # Check fuzzy matches
-    results = {}
-    artist_string = " ".join(song["artists"]).lower()
+    normalized = normalize(song)
 
-    for item in song_list:
-        # Name and album scores
-        for key in ["title", "album"]:
+    for compared, item in enumerate(song_list, 1):
+        total_score = _duplicate_score(normalized, normalize(item))
 
-            try:
-                a = re.sub(cutoff_regex[0], "", song[key],
-                           flags=re.IGNORECASE) + "\n"
-                a = re.sub(cutoff_regex[1], " ", a,
-                           flags=re.IGNORECASE).strip()
+        # If threshold is surpassed, no need to keep testing
+        if total_score is not None and total_score > float(threshold):
+            metrics.count("comparisons", compared)
+            return True
 
-                b = re.sub(cutoff_regex[0], "", item[key],
-                           flags=re.IGNORECASE) + "\n"
-                b = re.sub(cutoff_regex[1], " ", b,
-                           flags=re.IGNORECASE).strip()
+    # No match was found
+    metrics.count("comparisons", len(song_list))
+    return False
 
-                results[key] = fuzz.ratio(a, b)
 
-            except KeyError:
-                pass
+class SongIndex:
+    """
+    A reusable index of `song_list`, for checking many songs against the same playlist.
 
-        # Date score
-        try:
-            results["date"] = fuzz.token_set_ratio(song["date"], item["date"])
-        except KeyError:
-            pass
+    `contains` gives the same answer as `duplicate`, and `match` finds the same item as looping over
+    the list with `similarity`. Exact fields (location, ISRC, service ids) are hash lookups.
+    Fuzzy scoring is only run on items whose title score is high enough for the weighted total to
+    still pass the threshold; title scores for a batch of songs are found in one rapidfuzz `cdist` call.
+    """
 
-        # Artist score can be a partial match; allowing missing artists
-        try:
-            results["artist"] = fuzz.partial_token_sort_ratio(
-                artist_string, " ".join(item["artists"]).lower())
-        except KeyError:
-            pass
-
-        weight = {
-            "title": 8,
-            "artist": 8,
-            "album": 2,
-            "date": 1
-        }
-
-        # Fix weightings if values are missing
-        corrector = 0
-        for key in weight.keys():
-            if key in results.keys():
-                corrector += weight[key]
-
-        if corrector == 0:
-            return False
-
-        # Weighted average all scores
-        total_score = sum([results[key] / 100 * weight[key]
-                           for key in results.keys()])
-        total_score = total_score * 100 / corrector
+    def __init__(self, song_list):
+        self.songs = list(song_list)
+        self.normalized = [normalize(item) for item in self.songs]
 
-        # If threshold is surpassed, no need to keep testing
-        if total_score > float(threshold):
-            return True
+        # Exact values as compared by `duplicate`
+        self.exact = {key: {_strip(item[key]) for item in self.songs if key in item}
+                      for key in ["location", "isrc"]}
 
-    # No match was found
-    return False
+        # Exact values as compared by `similarity`, each mapping value: [indexes]
+        self.locations = {}
+        self.isrcs = {}
+        self.ids = {}
+
+        for i, item in enumerate(self.songs):
+            if "location" in item:
+                self.locations.setdefault(item["location"], []).append(i)
+
+            if "isrc" in item:
+                self.isrcs.setdefault(
+                    _strip(item["isrc"]).lower(), []).append(i)
+
+            for key, value in item.get("id", {}).items():
+                self.ids.setdefault(key, {}).setdefault(
+                    _strip(value), []).append(i)
+
+        # Cleaned titles used as the fuzzy block; untitled items can't be ruled out so are always tested
+        self.titled = []
+        self.titles = []
+        self.untitled = []
+
+        for i, normalized in enumerate(self.normalized):
+            if normalized.title:
+                self.titled.append(i)
+                self.titles.append(normalized.title)
+            else:
+                self.untitled.append(i)
+
+        self.titles_lower = [title.lower() for title in self.titles]
+
+    def __len__(self):
+        return len(self.songs)
+
+    def contains(self, song, threshold):
+        """
+        Determines if `song` is present in the index, with a supplied fuzziness threshold.
+        Equivalent to `duplicate(song, song_list, threshold)`.
+        """
+        return self.contains_many([song], threshold)[0]
+
+    def contains_many(self, songs, threshold):
+        """
+        Runs `contains` for every song in `songs`.
+
+        @return: a list of booleans, in the same order as `songs`.
+        """
+        results = []
+
+        for chunk in self._chunks(songs):
+            normalized = [normalize(song) for song in chunk]
+            candidates = self._candidates(
+                [item.title for item in normalized], threshold, self.titles)
+
+            for song, song_normalized, indexes in zip(chunk, normalized, candidates):
+                results.append(self._contains(
+                    song, song_normalized, indexes, threshold))
+
+        return results
+
+    def match(self, song, threshold):
+        """
+        Finds the first item in the index with a `similarity` to `song` greater than `threshold`.
+
+        @return: the matching item, or None if no match was found.
+        """
+        return self.match_many([song], threshold)[0]
+
+    def match_many(self, songs, threshold):
+        """
+        Runs `match` for every song in `songs`.
+
+        @return: a list of matching items (or None), in the same order as `songs`.
+        """
+        matches = []
+
+        for chunk in self._chunks(songs):
+            titles = [normalize(song).title for song in chunk]
+            titles = [None if title is None else title.lower()
+                      for title in titles]
+
+            candidates = self._candidates(titles, threshold, self.titles_lower)
+
+            for song, indexes in zip(chunk, candidates):
+                matches.append(self._match(song, indexes, threshold))
+
+        return matches
+
+    def _contains(self, song, normalized, indexes, threshold):
+        # Check exact location or isrc match
+        for key in ["location", "isrc"]:
+            if key in song and _strip(song[key]) in self.exact[key]:
+                return True
+
+        # Check exact ID match
+        for key, value in song.get("id", {}).items():
+            if _strip(value) in self.ids.get(key, {}):
+                return True
+
+        # Check fuzzy matches
+        for compared, i in enumerate(indexes, 1):
+            total_score = _duplicate_score(normalized, self.normalized[i])
+
+            if total_score is not None and total_score > float(threshold):
+                metrics.count("comparisons", compared)
+                return True
+
+        metrics.count("comparisons", len(indexes))
+        return False
+
+    def _match(self, song, indexes, threshold):
+        # Exact matches are scored by `similarity` alongside the fuzzy candidates, to keep list order
+        candidates = set(indexes)
+        candidates.update(self.locations.get(song.get("location"), []))
+
+        for key, value in song.get("id", {}).items():
+            candidates.update(self.ids.get(key, {}).get(_strip(value), []))
+
+        if "isrc" in song:
+            candidates.update(self.isrcs.get(_strip(song["isrc"]).lower(), []))
+
+        for compared, i in enumerate(sorted(candidates), 1):
+            if similarity(song, self.songs[i]) > float(threshold):
+                metrics.count("comparisons", compared)
+                return self.songs[i]
+
+        metrics.count("comparisons", len(candidates))
+        return None
+
+    def _chunks(self, songs):
+        """
+        Splits `songs` so no more than `matrix_cells` title scores are held at once.
+        """
+        songs = list(songs)
+        rows = max(1, matrix_cells // max(1, len(self.titles)))
+
+        for start in range(0, len(songs), rows):
+            yield songs[start:start + rows]
+
+    def _candidates(self, titles, threshold, choices):
+        """
+        For each title, the indexes of all items which could pass `threshold` given their title score, in list order.
+        Assumes every other field is a perfect match, so no item which could pass is excluded.
+        """
+        others = weight["artist"] + weight["album"] + weight["date"]
+        cutoff = math.floor(((weight["title"] + others) * float(threshold) -
+                             others * 100) / weight["title"])
+
+        # Untitled songs, or a cutoff too low to exclude anything, must be tested against every item
+        candidates = [range(len(self.songs))] * len(titles)
+
+        if cutoff < 1 or not choices:
+            return candidates
+
+        rows = [i for i, title in enumerate(titles) if title]
+
+        if rows:
+            # Scores below the cutoff are returned as 0
+            scores = process.cdist([titles[i] for i in rows], choices, scorer=fuzz.ratio,
+                                   score_cutoff=cutoff, workers=-1)
+            metrics.count("title_comparisons", len(rows) * len(choices))
+            titled = np.array(self.titled)
+
+            for i, row in zip(rows, scores):
+                candidates[i] = sorted(
+                    self.untitled + titled[row > 0].tolist())
+
+        return candidates
 
 
 def similarity(a, b):
@@ -130,7 +374,9 @@ def similarity(a, b):
     Compares song a and song b for similarity
 
     @return: a number between 0 and 100 representing the similarity rating, where 100 is the same song.
+    Not counted in metrics, as it is called for every pair of songs; callers count "comparisons" in bulk.
     """
+
     # Check exact location match
     try:
         if a["location"] == b["location"]:
@@ -160,64 +406,148 @@ def similarity(a, b):
         isrc_match = False
         pass
 
-    # Name and album scores
-    for key in ["title", "album"]:
-        if key == "title" and isrc_match:
-            # Don't bother matching title, only album
-            continue
-        try:
-            cleaned_a = re.sub(
-                cutoff_regex[0], "", a[key], flags=re.IGNORECASE) + "\n"
-            cleaned_a = re.sub(
-                cutoff_regex[1], " ", cleaned_a, flags=re.IGNORECASE).strip().lower()
+    normalized_a = normalize(a)
+    normalized_b = normalize(b)
 
-            cleaned_b = re.sub(
-                cutoff_regex[0], "", b[key], flags=re.IGNORECASE) + "\n"
-            cleaned_b = re.sub(
-                cutoff_regex[1], " ", cleaned_b, flags=re.IGNORECASE).strip().lower()
-
-            results[key] = fuzz.ratio(cleaned_a, cleaned_b)
+    # Name and album scores
+    if not isrc_match and normalized_a.title is not None and normalized_b.title is not None:
+        results["title"] = fuzz.ratio(
+            normalized_a.title.lower(), normalized_b.title.lower())
 
-        except KeyError:
-            pass
+    if normalized_a.album is not None and normalized_b.album is not None:
+        results["album"] = fuzz.ratio(
+            normalized_a.album.lower(), normalized_b.album.lower())
 
     if not isrc_match:
         # Date score
-        try:
-            results["date"] = fuzz.token_set_ratio(a["date"], b["date"])
-        except KeyError:
-            pass
+        if normalized_a.date is not None and normalized_b.date is not None:
+            results["date"] = fuzz.token_set_ratio(
+                normalized_a.date, normalized_b.date)
 
         # Artist score can be a partial match; allowing missing artists
-        try:
-            artists_a = " ".join(a["artists"]).lower()
-            artists_b = " ".join(b["artists"]).lower()
-
+        if normalized_a.artists is not None and normalized_b.artists is not None:
             results["artist"] = fuzz.partial_token_sort_ratio(
-                artists_a, artists_b)
-        except KeyError:
-            pass
-
-    weight = {
-        "isrc": 10,
-        "title": 8,
-        "artist": 8,
-        "album": 2,
-        "date": 1
-    }
-
-    # Fix weightings if values are missing
-    corrector = 0
-    for key in weight.keys():
-        if key in results.keys():
-            corrector += weight[key]
+                normalized_a.artists, normalized_b.artists)
 
-    if corrector == 0:
+    total_score = _weighted(results)
+
+    if total_score is None:
         return False
 
-    # Weighted average all scores
-    total_score = sum([results[key] / 100 * weight[key]
-                       for key in results.keys()])
-    total_score = total_score * 100 / corrector
+    return total_score
+
+
+def _similarity_fields(song):
+    """
+    Pre-processes a song for `similarity_matrix`, in the same way each field is compared by `similarity`.
+    """
+    fields = {}
+
+    if "location" in song:
+        fields["location"] = song["location"]
+
+    if "id" in song:
+        fields["id"] = {key: _strip(value) for key, value in song["id"].items()}
+
+    if "isrc" in song:
+        fields["isrc"] = _strip(song["isrc"]).lower()
+
+    normalized = normalize(song)
+
+    for key in ["title", "album"]:
+        if getattr(normalized, key) is not None:
+            fields[key] = getattr(normalized, key).lower()
+
+    if normalized.date is not None:
+        fields["date"] = normalized.date
+
+    if normalized.artists is not None:
+        fields["artist"] = normalized.artists
+
+    return fields
+
+
+def similarity_matrix(songs_a, songs_b, workers=-1):
+    """
+    Compares every song in `songs_a` with every song in `songs_b` for similarity.
+    Each field is cleaned once per song, and scored for all pairs at once with rapidfuzz `cdist`.
+
+    @return: a numpy array of shape (len(songs_a), len(songs_b)), where [i, j] is `similarity(songs_a[i], songs_b[j])`.
+    """
+    a = [_similarity_fields(song) for song in songs_a]
+    b = [_similarity_fields(song) for song in songs_b]
+    shape = (len(a), len(b))
+    metrics.count("comparisons", len(a) * len(b))
+
+    def present(fields, key):
+        return np.array([key in item for item in fields], dtype=bool)
+
+    def equal(values_a, values_b):
+        """
+        Boolean matrix of exact matches between two lists of values, where None is never matched.
+        """
+        codes = {}
+        codes_a = np.array([-1 if value is None else codes.setdefault(value, len(codes))
+                            for value in values_a], dtype=np.int64)
+        codes_b = np.array([-2 if value is None else codes.get(value, -2)
+                            for value in values_b], dtype=np.int64)
+
+        return codes_a[:, None] == codes_b[None, :]
+
+    def scores(key, scorer):
+        """
+        Fuzzy scores and a mask of pairs where both songs have `key`.
+        """
+        mask_a, mask_b = present(a, key), present(b, key)
+        matrix = np.zeros(shape)
+
+        if mask_a.any() and mask_b.any():
+            matrix[np.ix_(mask_a, mask_b)] = process.cdist(
+                [item[key] for item in a if key in item],
+                [item[key] for item in b if key in item],
+                scorer=scorer, dtype=np.float64, workers=workers)
+
+        return matrix, np.outer(mask_a, mask_b)
+
+    total_score = np.zeros(shape)
+    corrector = np.zeros(shape)
+
+    def add(key, matrix, mask):
+        total_score[mask] += matrix[mask] / 100 * weight[key]
+        corrector[mask] += weight[key]
+
+    # ISRC score
+    isrc_mask = np.outer(present(a, "isrc"), present(b, "isrc"))
+    isrc_match = isrc_mask & equal(
+        [item.get("isrc") for item in a], [item.get("isrc") for item in b])
+    add("isrc", isrc_match * 100.0, isrc_mask)
+
+    # Name and album scores, title is skipped when ISRC matches
+    matrix, mask = scores("title", fuzz.ratio)
+    add("title", matrix, mask & ~isrc_match)
+
+    matrix, mask = scores("album", fuzz.ratio)
+    add("album", matrix, mask)
+
+    # Date and artist scores are also skipped when ISRC matches
+    matrix, mask = scores("date", fuzz.token_set_ratio)
+    add("date", matrix, mask & ~isrc_match)
+
+    matrix, mask = scores("artist", fuzz.partial_token_sort_ratio)
+    add("artist", matrix, mask & ~isrc_match)
+
+    # Weighted average all scores, correcting for missing values
+    np.divide(total_score * 100, corrector,
+              out=total_score, where=corrector > 0)
+
+    # Exact location and ID matches override all fuzzy scores
+    exact = equal([item.get("location") for item in a],
+                  [item.get("location") for item in b])
+
+    for key in {key for item in a for key in item.get("id", {})}:
+        exact |= equal([item.get("id", {}).get(key) for item in a],
+                       [item.get("id", {}).get(key) for item in b])
+
+    total_score[exact] = 100
 
     return total_score
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""
+http_client
+Shared HTTP client for plugins which talk to web services.
+
+Requests go through one pooled session per process, so connections are kept alive between requests and plugin runs.
+Failed requests are retried with exponential backoff and jitter, honouring any Retry-After header, and the number of
+requests in flight to each host at once is limited. Each attempt is recorded with `metrics.api_call`, and each retry
+is counted as "retries.{service}".
+
+Responses are returned whatever their status once retries run out, so plugins check status codes as before.
+
+McLain Cronin, 2025
+"""
+
+import email.utils
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ultrasonics import logs, metrics
+from ultrasonics.config import Config
+
+log = logs.create_log(__name__)
+
+# Statuses retried for any request, and those only retried if the request is safe to repeat
+retry_statuses = {429}
+retry_idempotent_statuses = {500, 502, 503, 504}
+idempotent_methods = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Seconds for the first backoff, and the most to wait before any retry
+backoff_base = 1
+backoff_cap = 60
+retry_after_cap = 600
+
+# Session for this process, and the number of requests allowed in flight to each host
+lock = threading.Lock()
+shared = {"session": None, "pid": None}
+host_limits = {}
+
+
+def session():
+    """
+    The pooled session for the current process, created if needed.
+    """
+    with lock:
+        if shared["session"] is None or shared["pid"] != os.getpid():
+            adapter = HTTPAdapter(pool_connections=Config.HTTP_POOL_SIZE,
+                                  pool_maxsize=Config.HTTP_POOL_SIZE)
+
+            shared["session"] = requests.Session()
+            shared["session"].mount("http://", adapter)
+            shared["session"].mount("https://", adapter)
+            shared["pid"] = os.getpid()
+
+        return shared["session"]
+
+
+def host_limit(host):
+    """
+    Semaphore limiting concurrent requests to `host`.
+    """
+    with lock:
+        if host not in host_limits:
+            host_limits[host] = threading.BoundedSemaphore(Config.HTTP_HOST_CONCURRENCY)
+
+        return host_limits[host]
+
+
+def retry_after(response):
+    """
+    Seconds to wait from the response's Retry-After header, in either seconds or HTTP date format, or None.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(0.0, seconds), retry_after_cap)
+
+
+def backoff(attempt):
+    """
+    Exponential backoff with full jitter, so clients which failed together don't retry together.
+    """
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+
+def should_retry(method, response, retry_if=None):
+    if response.status_code in retry_statuses:
+        return True
+
+    if response.status_code in retry_idempotent_statuses and method in idempotent_methods:
+        return True
+
+    return retry_if is not None and retry_if(response)
+
+
+def request(method, url, service=None, retries=None, retry_if=None, **kwargs):
+    """
+    Make a request through the shared session, retrying if it fails.
+
+    Inputs:
+    method          HTTP method, e.g. "GET"
+    url             Request url
+    service         Name of the api for metrics, defaults to the host
+    retries         Maximum number of retries, defaults to Config.HTTP_RETRIES
+    retry_if        Optional function given the response, returning True if it should be retried
+                    (e.g. rate limits reported in the response body)
+    kwargs          Passed to `requests.Session.request`, with a default timeout
+
+    @return: requests.Response
+    """
+    method = method.upper()
+    host = urlsplit(url).netloc
+    service = service or host
+    retries = Config.HTTP_RETRIES if retries is None else retries
+    kwargs.setdefault("timeout", Config.HTTP_TIMEOUT)
+
+    attempt = 0
+
+    while True:
+        try:
+            with host_limit(host), metrics.api_call(service):
+                response = session().request(method, url, **kwargs)
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries or method not in idempotent_methods:
+                raise
+
+            delay = backoff(attempt)
+            log.warning(f"Request to {service} failed, retrying in {delay:.1f}s: {e}")
+
+        else:
+            if attempt >= retries or not should_retry(method, response, retry_if):
+                return response
+
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff(attempt)
+
+            log.warning(f"{service} returned status {response.status_code}, retrying in {delay:.1f}s")
+
+        metrics.count(f"retries.{service}")
+        attempt += 1
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
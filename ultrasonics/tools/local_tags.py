@@ -6,20 +6,26 @@ Fetches tags from local music files.
 
 Given an input path, the metadata tags will be returned in standard ultrasonics songlist format.
 This is done either by reading directly from the song file, or by reading from a cache if the song has not been modified since last read.
+The cache is checked against each file's modified time and size, and can be read and written in batches with `cached_many` and `store_many`.
 The currently supported audio formats are shown in supported_audio_extensions.
 
 XDGFX, 2020
 """
 
-import hashlib
+import contextvars
+import copy
+import json
 import os
-# import sqlite3
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from mutagen.easyid3 import EasyID3
 from mutagen.mp4 import MP4
 from mutagen.flac import FLAC
 
-from ultrasonics import logs
+from app import _ultrasonics
+from ultrasonics import logs, metrics
 
 log = logs.create_log(__name__)
 
@@ -29,53 +35,208 @@ supported_audio_extensions = [
     ".flac"    
 ]
 
-# db_file = os.path.join(os.path.dirname(__file__), "local_tags.db")
+# Number of paths to look up in the cache with each query
+lookup_batch = 500
 
-# log.debug("Loaded local_tags tool. Initialising database...")
+# One cache connection per thread, and per process in case of a fork
+local = threading.local()
 
-# with sqlite3.connect(db_file) as conn:
-#     cursor = conn.cursor()
 
-#     try:
-#         # Create tracks table if needed
-#         query = "CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, checksum TEXT, tags TEXT)"
-#         cursor.execute(query)
+def connection():
+    """
+    The tag cache database connection for the current thread, created if needed.
+    """
+    conn = getattr(local, "conn", None)
+    if conn is not None and local.pid == os.getpid():
+        return conn
+
+    db_file = os.path.join(_ultrasonics["config_dir"], "local_tags.db")
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    # Create tracks table if needed
+    query = "CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, tags TEXT)"
+    conn.execute(query)
+    conn.commit()
+
+    local.conn = conn
+    local.pid = os.getpid()
+    return conn
+
+
+def signature(song_path):
+    """
+    Modified time and size of a file, which must both match for cached tags to be used.
+    """
+    stat = os.stat(song_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def cached_many(paths):
+    """
+    Look up cached tags for many songs at once.
 
-#         conn.commit()
+    @return: dict of path: song_dict, for songs which are cached and unchanged since.
+    """
+    signatures = {}
+    for path in paths:
+        try:
+            signatures[path] = signature(path)
+        except OSError:
+            pass
 
-#     except sqlite3.Error as e:
-#         log.info("Error while initialising local_tags database", e)
+    found = {}
+    paths = list(signatures)
+    conn = connection()
+
+    for i in range(0, len(paths), lookup_batch):
+        batch = paths[i:i + lookup_batch]
+        query = f"SELECT path, mtime, size, tags FROM tracks WHERE path IN ({','.join('?' * len(batch))})"
+
+        for path, mtime, size, tags in conn.execute(query, batch):
+            if signatures[path] == (mtime, size):
+                found[path] = json.loads(tags)
+
+    return found
+
+
+def store_many(signed_songs):
+    """
+    Save tags read from many songs to the cache at once, as (signature, song_dict) pairs from `read_signed`.
+    Songs whose file was changed or removed since it was read are skipped, as their tags may be out of date.
+    """
+    rows = []
+    for song_signature, song_dict in signed_songs:
+        try:
+            if signature(song_dict["location"]) != song_signature:
+                continue
+        except OSError:
+            continue
+
+        rows.append((song_dict["location"], *song_signature, json.dumps(song_dict)))
+
+    conn = connection()
+    conn.executemany(
+        "REPLACE INTO tracks (path, mtime, size, tags) VALUES (?,?,?,?)", rows)
+    conn.commit()
+
+
+def forget(paths):
+    """
+    Remove songs from the cache, e.g. once their files have been deleted.
+    """
+    conn = connection()
+    conn.executemany("DELETE FROM tracks WHERE path=?", [(path,) for path in paths])
+    conn.commit()
 
 
 def tags(song_path):
     """
     Given an input path accessible by ultrasonics, metadata for the song will be read and returned in standard ultrasonics song_dict format.
+    Tags are read from the cache if the song has not been modified since it was last read.
     """
     # Skip music files which are not supported
     _, ext = os.path.splitext(song_path)
     if ext.lower() not in supported_audio_extensions:
         raise NotImplementedError(song_path)
 
-    # song_mtime = os.stat(song_path).st_mtime
+    # First try to load tags from the cache for speed
+    try:
+        return cached_many([song_path])[song_path]
+    except KeyError:
+        pass
+
+    song_signature, song_dict = read_signed(song_path)
+    store_many([(song_signature, song_dict)])
 
-    # # First try to load tags from the database for speed
-    # with sqlite3.connect(db_file) as conn:
-    #     try:
-    #         cursor = conn.cursor()
+    return song_dict
+
+
+def tags_many(paths, workers=8):
+    """
+    Fetch tags for many songs at once, e.g. every song in every playlist of a run.
+    Each path is only read once however many times it appears, cached songs are looked up together,
+    and the rest are read concurrently by `workers` threads and cached.
+
+    @return: list of song_dicts in the same order as `paths`, with None for any which could not be read.
+    """
+    unique = []
+    for path in dict.fromkeys(paths):
+        # Skip music files which are not supported
+        _, ext = os.path.splitext(path)
+        if ext.lower() not in supported_audio_extensions:
+            log.warning(f"The file {path} is not a supported filetype")
+            continue
+
+        unique.append(path)
+
+    found = cached_many(unique)
+    cached = len(found)
+    unread = [path for path in unique if path not in found]
+
+    def attempt(path):
+        if not os.path.isfile(path):
+            log.debug(f"Skipping missing file: {path}")
+            return None
+
+        try:
+            return read_signed(path)
+        except Exception as e:
+            log.error(f"Could not load tags from song: {path}")
+            log.error(e)
+
+    if unread:
+        # Reads run in copies of this context, so their cpu time is recorded for the current run
+        context = contextvars.copy_context()
+
+        def read_counted(path):
+            return context.copy().run(metrics.worker, attempt, path)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(unread)))) as executor:
+            results = list(executor.map(read_counted, unread))
+
+        read_songs = [result for result in results if result is not None]
+        store_many(read_songs)
+        found.update((song["location"], song) for _, song in read_songs)
+
+    log.debug(f"Fetched tags for {len(found)} song(s), {cached} from the cache.")
 
-    #         query = "SELECT tags FROM tracks WHERE path = ? AND checksum = ?"
-    #         cursor.execute(query, (song_path, song_mtime))
-    #         rows = cursor.fetchall()
+    # Songs appearing more than once are copied, so changes to one playlist don't affect another
+    seen = set()
+    songs = []
 
-    #         if rows != []:
-    #             import ast
-    #             song_dict = rows[0][0]
-    #             song_dict = ast.literal_eval(song_dict)
+    for path in paths:
+        song = found.get(path)
+        if song is not None and path in seen:
+            song = copy.deepcopy(song)
 
-    #             return song_dict
+        seen.add(path)
+        songs.append(song)
 
-    #     except sqlite3.Error as e:
-    #         log.info("Error while accessing local_tags database", e)
+    return songs
+
+
+def read_signed(song_path):
+    """
+    Read the metadata for a song directly from the file, along with the file's signature from before it was read.
+
+    @return: signature, song_dict
+    """
+    song_signature = signature(song_path)
+    return song_signature, read(song_path)
+
+
+def read(song_path):
+    """
+    Read the metadata for a song directly from the file, without using the cache.
+    """
+    # Skip music files which are not supported
+    _, ext = os.path.splitext(song_path)
+    if ext.lower() not in supported_audio_extensions:
+        raise NotImplementedError(song_path)
 
     song_dict = {}
 
@@ -134,15 +295,4 @@ def tags(song_path):
     # Add location of music file to dictionary
     song_dict["location"] = song_path
 
-    # with sqlite3.connect(db_file) as conn:
-    #     cursor = conn.cursor()
-    #     try:
-    #         query = "REPLACE INTO tracks (tags, checksum, path) VALUES(?, ?, ?)"
-    #         cursor.execute(
-    #             query, (str(song_dict), song_mtime, song_path))
-    #         conn.commit()
-
-    #     except sqlite3.Error as e:
-    #         log.info("Error while updating local_tags database", e)
-
     return song_dict
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+resolve_cache
+Persistent cache of songs resolved to the ids of each service.
+
+Searching a service for a song takes several api calls and a round of fuzzy matching, so once a song is resolved,
+the service id and confidence score are saved against every key the song can be recognised by:
+
+    1. 'isrc'                   The song's ISRC
+    2. 'id'                     Any id the song already has on another service
+    3. 'meta'                   The normalised title, artists, album and date
+
+Songs which could not be found are cached too, but only against their most specific key and for a shorter time,
+so a song missing from a service today is searched again once `RESOLVE_CACHE_MISS_TTL` has passed. The same goes for
+songs whose best match scored too low to be accepted, so a wrong match is never kept for the full `RESOLVE_CACHE_TTL`.
+
+McLain Cronin, 2025
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from app import _ultrasonics
+from ultrasonics import logs, metrics
+from ultrasonics.config import Config
+from ultrasonics.tools import fuzzymatch
+
+log = logs.create_log(__name__)
+
+# One connection per thread, and per process in case of a fork
+local = threading.local()
+
+
+def connection():
+    """
+    The cache database connection for the current thread, created if needed.
+    """
+    conn = getattr(local, "conn", None)
+    if conn is not None and local.pid == os.getpid():
+        return conn
+
+    db_file = os.path.join(_ultrasonics["config_dir"], "resolve_cache.db")
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS resolved
+        (
+            service TEXT,
+            key TEXT,
+            service_id TEXT,
+            confidence REAL,
+            expires REAL,
+            PRIMARY KEY (service, key)
+        )
+    """)
+    conn.commit()
+
+    local.conn = conn
+    local.pid = os.getpid()
+    return conn
+
+
+def keys(service, track):
+    """
+    Every key `track` can be recognised by, most specific first.
+    Ids from `service` itself are skipped, as plugins use those directly.
+    """
+    found = []
+
+    if track.get("isrc"):
+        found.append(f"isrc:{track['isrc'].strip().upper()}")
+
+    for name, value in sorted((track.get("id") or {}).items()):
+        if name != service and value:
+            found.append(f"id:{name}:{value}")
+
+    if track.get("title"):
+        found.append("meta:" + json.dumps(fuzzymatch.normalize(track)).lower())
+
+    return found
+
+
+def lookup(service, track):
+    """
+    Find a cached result for `track` on `service`.
+
+    @return: service id (empty if the song was not found), confidence score; or None if not cached.
+    """
+    track_keys = keys(service, track)
+    if not track_keys:
+        return None
+
+    query = f"""
+        SELECT key, service_id, confidence FROM resolved
+        WHERE service=? AND expires>? AND key IN ({','.join('?' * len(track_keys))})
+    """
+    rows = connection().execute(query, (service, time.time(), *track_keys)).fetchall()
+
+    if not rows:
+        metrics.count("resolve_cache_misses")
+        return None
+
+    # Prefer the result from the most specific key
+    results = {key: (service_id, confidence) for key, service_id, confidence in rows}
+    metrics.count("resolve_cache_hits")
+
+    return next(results[key] for key in track_keys if key in results)
+
+
+def store(service, track, service_id, confidence, accepted=True):
+    """
+    Save the result of searching `service` for `track`. An empty `service_id` records that it was not found.
+    If the caller rejected the match, e.g. for scoring below its fuzzy ratio, pass `accepted=False` to store it as a miss.
+    """
+    track_keys = keys(service, track)
+    if not track_keys:
+        return
+
+    if not accepted:
+        service_id, confidence = "", 0
+
+    if service_id:
+        expires = time.time() + Config.RESOLVE_CACHE_TTL
+    else:
+        # Don't let a miss on a specific key hide a match by the less specific ones
+        track_keys = track_keys[:1]
+        expires = time.time() + Config.RESOLVE_CACHE_MISS_TTL
+
+    conn = connection()
+    conn.executemany(
+        "REPLACE INTO resolved (service, key, service_id, confidence, expires) VALUES (?,?,?,?,?)",
+        [(service, key, str(service_id or ""), confidence, expires) for key in track_keys])
+    conn.commit()
+
+
+def forget(service, track):
+    """
+    Remove cached results for `track`, e.g. if the cached id no longer exists on `service`.
+    """
+    track_keys = keys(service, track)
+    if not track_keys:
+        return
+
+    conn = connection()
+    conn.execute(
+        f"DELETE FROM resolved WHERE service=? AND key IN ({','.join('?' * len(track_keys))})",
+        (service, *track_keys))
+    conn.commit()
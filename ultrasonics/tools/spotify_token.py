@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+spotify_token
+Process-wide cache of Spotify access tokens, shared by every Spotify plugin and applet.
+
+Access tokens are kept in memory with their expiry time, keyed by the refresh token they were issued for, so each
+account needs one renewal through the ultrasonics-api proxy per token lifetime, however many applets use it.
+Tokens are renewed shortly before they expire rather than validated against the Spotify api, and are also saved to
+disk so they survive a restart.
+
+McLain Cronin, 2025
+"""
+
+import bz2
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from urllib.parse import urljoin
+
+from app import _ultrasonics
+from ultrasonics import logs, metrics
+from ultrasonics.tools import api_key, http_client
+
+log = logs.create_log(__name__)
+
+# Seconds before expiry at which a token is renewed, so it doesn't expire during a request
+refresh_margin = 300
+
+# Lifetime assumed if the renewal response doesn't include one
+default_lifetime = 3600
+
+# Cached tokens by account, and a lock per account so only one thread renews each token
+lock = threading.Lock()
+tokens = {}
+account_locks = {}
+
+
+def cache_file():
+    return os.path.join(_ultrasonics["config_dir"], "up_spotify", "up_spotify.bz2")
+
+
+def account(refresh_token):
+    """
+    Key for an account's tokens, so refresh tokens are not written to disk in the token cache.
+    """
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+def account_lock(key):
+    with lock:
+        if key not in account_locks:
+            account_locks[key] = threading.Lock()
+
+        return account_locks[key]
+
+
+def fresh(entry):
+    return entry is not None and entry["expires"] - refresh_margin > time.time()
+
+
+def load():
+    """
+    Tokens saved to disk, by account. Files from before tokens were saved with their expiry are ignored.
+    """
+    try:
+        with bz2.BZ2File(cache_file(), "r") as f:
+            saved = json.loads(pickle.load(f))
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return {}
+
+    if not isinstance(saved, dict) or "access_token" in saved:
+        return {}
+
+    return saved
+
+
+def save(key, entry):
+    """
+    Save a token to disk alongside those of other accounts.
+    """
+    with lock:
+        saved = load()
+        saved[key] = entry
+
+        os.makedirs(os.path.dirname(cache_file()), exist_ok=True)
+        temp_file = f"{cache_file()}.{os.getpid()}.tmp"
+
+        with bz2.BZ2File(temp_file, "w") as f:
+            pickle.dump(json.dumps(saved), f)
+
+        os.replace(temp_file, cache_file())
+
+
+def renew(refresh_token, api_url):
+    """
+    Using refresh_token, request a new access token through the ultrasonics-api proxy.
+
+    @return: dict of access_token and expires, a unix time
+    """
+    url = urljoin(api_url, "spotify/auth/renew")
+    data = {
+        "refresh_token": refresh_token,
+        "ultrasonics_auth_hash": api_key.get_hash(True),
+    }
+
+    log.info("Requesting a new Spotify token, this may take a few seconds...")
+
+    # Request with a long timeout to account for free Heroku start-up 😉
+    resp = http_client.post(url, service="ultrasonics-api", data=data, timeout=60)
+
+    if resp.status_code != 200:
+        log.error(resp.text)
+        raise Exception(
+            f"The response `when renewing Spotify token was unexpected: {resp.status_code}"
+        )
+
+    raw = resp.json()
+    token = raw["access_token"]
+
+    log.debug(f"Spotify renew data: {resp.text.replace(token, '***************')}")
+    metrics.count("spotify_token_renewals")
+
+    return {
+        "access_token": token,
+        "expires": time.time() + float(raw.get("expires_in") or default_lifetime),
+    }
+
+
+def get(refresh_token, api_url, stale=None):
+    """
+    A valid access token for the account of `refresh_token`, renewed if it is close to expiry.
+
+    Inputs:
+    refresh_token   Spotify refresh token for the account
+    api_url         ultrasonics-api url, used to renew tokens
+    stale           Optionally, an access token which was rejected by Spotify. It is renewed,
+                    unless another thread has already replaced it.
+    """
+    key = account(refresh_token)
+
+    def usable(entry):
+        return fresh(entry) and entry["access_token"] != stale
+
+    entry = tokens.get(key)
+    if usable(entry):
+        return entry["access_token"]
+
+    with account_lock(key):
+        entry = tokens.get(key)
+        if usable(entry):
+            return entry["access_token"]
+
+        # Another process may have saved a newer token
+        entry = load().get(key)
+        if usable(entry):
+            log.debug("Returning saved token")
+            tokens[key] = entry
+            return entry["access_token"]
+
+        entry = renew(refresh_token, api_url)
+        tokens[key] = entry
+
+        try:
+            save(key, entry)
+        except OSError as e:
+            log.warning(f"Could not save Spotify token: {e}")
+
+        return entry["access_token"]
@@ -2,11 +2,11 @@
 
 """
 routes
-Blueprint registration for all routes.
+Routers for the web application. The Flask blueprints (applets, plugins, settings) are imported by name where used.
 
 McLain Cronin, 2025
 """
 
-from . import applets, plugins, settings
+from . import api, hooks, web
 
-__all__ = ['applets', 'plugins', 'settings'] 
\ No newline at end of file
+__all__ = ['api', 'hooks', 'web'] 
\ No newline at end of file
@@ -12,7 +12,7 @@ from typing import Dict, Any, List, Optional
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 
-from ultrasonics import database, plugins, logs
+from ultrasonics import database, plugins, logs, scheduler
 from ultrasonics.webapp.utils.socket import socket_manager
 
 router = APIRouter()
@@ -25,6 +25,7 @@ class AppletCreate(BaseModel):
     outputs: List[Dict[str, Any]]
     modifiers: List[Dict[str, Any]] = []
     triggers: List[Dict[str, Any]] = []
+    concurrent: Optional[bool] = None
 
 class PluginSettings(BaseModel):
     name: str
@@ -51,6 +52,9 @@ async def create_applet(applet: AppletCreate) -> Dict[str, Any]:
     try:
         await plugins.applet_build(applet.dict())
         return {"status": "success", "message": "Applet created successfully"}
+    except ValueError as e:
+        log.error(f"Invalid applet settings: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         log.error(f"Error creating applet: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -74,14 +78,21 @@ async def delete_applet(applet_id: str) -> Dict[str, Any]:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/applets/{applet_id}/run")
-async def run_applet(applet_id: str) -> Dict[str, Any]:
-    """Run a specific applet."""
-    try:
-        await plugins.applet_run(applet_id)
-        return {"status": "success", "message": "Applet started successfully"}
-    except Exception as e:
-        log.error(f"Error running applet: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+async def run_applet(applet_id: str, full_sync: bool = False) -> Dict[str, Any]:
+    """
+    Queue a run of a specific applet, after any run of it already queued or in progress.
+    With full_sync, incremental outputs receive every playlist in full.
+    """
+    if await database.Applet().get(applet_id) is None:
+        raise HTTPException(status_code=404, detail="Applet not found")
+
+    scheduler.push(applet_id, full_sync=full_sync)
+    return {"status": "success", "message": "Applet queued successfully"}
+
+@router.get("/applets/{applet_id}/runs")
+async def get_applet_runs(applet_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """Get the run history of a specific applet, with per-plugin timings and counters."""
+    return await database.Run().get(applet_id, limit)
 
 @router.get("/plugins/{name}/settings")
 async def get_plugin_settings(name: str) -> Dict[str, Any]:
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+hooks
+Webhook trigger routes, shared by every applet using the webhook trigger plugin.
+
+Requests to /hooks/{applet_id}/{path} are pushed straight into the scheduler queue.
+A burst of requests is coalesced into one run, after the trigger's debounce time has passed since the last request.
+
+McLain Cronin, 2025
+"""
+
+import asyncio
+from typing import Dict, Any, Tuple
+
+from fastapi import APIRouter, HTTPException
+
+from ultrasonics import database, logs, scheduler
+
+router = APIRouter()
+log = logs.create_log(__name__)
+
+# Name of the webhook trigger plugin
+plugin_name = "webhook"
+
+# Debounced runs waiting to be pushed, by applet_id and path
+debounced: Dict[Tuple[str, str], asyncio.TimerHandle] = {}
+
+
+def normalise(path: str) -> str:
+    """Paths are compared without leading or trailing slashes."""
+    return path.strip("/")
+
+
+def debounce_time(trigger: Dict[str, Any]) -> float:
+    """Seconds to wait for more requests before running, from the trigger settings."""
+    try:
+        return max(0.0, float(trigger["data"].get("debounce") or 0))
+    except ValueError:
+        return 0.0
+
+
+@router.api_route("/hooks/{applet_id}", methods=["GET", "POST"], status_code=202)
+@router.api_route("/hooks/{applet_id}/{path:path}", methods=["GET", "POST"], status_code=202)
+async def hook(applet_id: str, path: str = "") -> Dict[str, Any]:
+    """Trigger an applet from its webhook."""
+    applet_plans = await database.Applet().get(applet_id)
+
+    triggers = [trigger for trigger in (applet_plans or {}).get("triggers", [])
+                if trigger["plugin"] == plugin_name
+                and normalise(trigger["data"].get("path", "")) == normalise(path)]
+
+    if not triggers:
+        raise HTTPException(status_code=404, detail="Webhook not found")
+
+    key = (applet_id, normalise(path))
+    delay = debounce_time(triggers[0])
+
+    if key in debounced:
+        debounced.pop(key).cancel()
+
+    if delay:
+        def push():
+            debounced.pop(key, None)
+            scheduler.push(applet_id)
+
+        debounced[key] = asyncio.get_running_loop().call_later(delay, push)
+    else:
+        scheduler.push(applet_id)
+
+    log.info(f"Applet triggered: {applet_id}")
+    return {"status": "success", "message": f"Applet triggered: {applet_id}"}
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 """
-webapp
-Main entry point for the web application.
+server
+Main entry point for the web application, started by app.py.
 
 Original work by XDGFX, 2020
 Updated and modernized by McLain Cronin, 2025
@@ -16,7 +16,7 @@ from fastapi.responses import JSONResponse
 from fastapi.websockets import WebSocket
 from uvicorn import Server, Config
 
-from ultrasonics.webapp.routes import api, web
+from ultrasonics.webapp.routes import api, hooks, web
 from ultrasonics.webapp.utils.socket import socket_manager
 
 app = FastAPI(title="Ultrasonics API")
@@ -31,10 +31,11 @@ app.add_middleware(
 )
 
 # Mount static files
-app.mount("/static", StaticFiles(directory="ultrasonics/webapp/static"), name="static")
+app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "..", "static")), name="static")
 
 # Include routers
 app.include_router(api.router, prefix="/api")
+app.include_router(hooks.router)
 app.include_router(web.router)
 
 # WebSocket connection manager
@@ -64,8 +65,7 @@ async def server_start():
         app,
         host="0.0.0.0",
         port=8080,
-        debug=os.environ.get('FLASK_DEBUG') == "True",
-        log_level="info"
+        log_level="debug" if os.environ.get('FLASK_DEBUG') == "True" else "info"
     )
     server = Server(config)
     await server.serve()